@@ -23,20 +23,29 @@ import os
 import sys
 import glob
 import gzip
+import time
 import shutil
+import logging
 import tempfile
 import random
+import urllib
+import zipfile
+import requests
+import threading
 import subprocess
 import collections
 from lxml import etree
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
 from pyxnat import Interface
 from datetime import datetime
 
 import task
-from dax_settings import DAX_Settings
-DAX_SETTINGS = DAX_Settings()
+from dax_settings import get_settings
+DAX_SETTINGS = get_settings()
 RESULTS_DIR = DAX_SETTINGS.get_results_dir()
 XSITYPE_INCLUDE = DAX_SETTINGS.get_xsitype_include()
+LOGGER = logging.getLogger('dax')
 
 import xml.etree.cElementTree as ET
 
@@ -49,6 +58,39 @@ NS = {'xnat' : 'http://nrg.wustl.edu/xnat',
 # Assessor datatypes
 DEFAULT_FS_DATATYPE = 'fs:fsData'
 DEFAULT_DATATYPE = 'proc:genProcData'
+# Maximum number of requests in flight on one interface
+DEFAULT_MAX_REQUESTS = 8
+# Size of the chunks read when streaming a resource zip
+DOWNLOAD_CHUNK_SIZE = 1024*1024
+# Staging of the spider outputs in the upload directory:
+#  link: hardlink the files, move: rename them, copy: always copy.
+#  link and move fall back to a copy between two filesystems.
+STAGING_MODES = ['link', 'move', 'copy']
+DEFAULT_STAGING = 'link'
+# Threads compressing the .nii/.rec staged by SpiderProcessHandler
+DEFAULT_COMPRESS_WORKERS = 4
+# Extensions compressed by SpiderProcessHandler
+COMPRESSED_EXTENSIONS = ['.nii', '.rec']
+# Request governor shared by the interfaces to one XNAT host (see RequestGovernor):
+#  rate of the requests in requests/second, lowered after each failure
+#  down to the minimum and raised back by one step after each success
+DEFAULT_MAX_RATE = 200.0
+DEFAULT_MIN_RATE = 2.0
+DEFAULT_RATE_STEP = 2.0
+#  retries of a request on 5xx/timeouts, with exponential backoff and jitter
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF_BASE = 1.0
+DEFAULT_BACKOFF_MAX = 60.0
+#  consecutive failures opening the circuit, seconds before one request probes
+#   XNAT again and maximum time a caller waits for the circuit to close
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_OPEN_SECONDS = 30.0
+DEFAULT_MAX_PAUSE = 600.0
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+RETRY_METHODS = ['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS']
+# RequestGovernor of each XNAT host, shared by the interfaces of the process
+GOVERNORS = dict()
+GOVERNORS_LOCK = threading.Lock()
 
 # URI
 PROJECTS_URI     = '/REST/projects'
@@ -126,6 +168,7 @@ class InterfaceTemp(Interface):
                                             user=self.user,
                                             password=self.pwd,
                                             cachedir=self.temp_dir)
+        set_request_governor(self)
 
     def __enter__(self, xnat_host=None, xnat_user=None, xnat_pass=None,
                   temp_dir=None):
@@ -148,6 +191,7 @@ class InterfaceTemp(Interface):
                                             user=self.user,
                                             password=self.pwd,
                                             cachedir=self.temp_dir)
+        set_request_governor(self)
 
     def __exit__(self, type, value, traceback):
         """Exit method for with statement."""
@@ -161,6 +205,373 @@ class InterfaceTemp(Interface):
         self._exec('/data/JSESSION', method='DELETE')
         shutil.rmtree(self.temp_dir)
 
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Custom exception raised when XNAT stays unhealthy longer than a caller can wait"""
+    pass
+
+class RequestGovernor(object):
+    """
+    Rate of the requests sent to one XNAT host, shared by all the interfaces
+     and threads of the process talking to it (see get_request_governor):
+
+    - token bucket: at most rate requests/second, with bursts of one second.
+      The rate is halved after each failure (5xx/timeout) and raised back
+      step by step after each success, so it settles on what XNAT sustains.
+    - circuit breaker: after failure_threshold consecutive failures, the
+      callers are paused for open_seconds. One request then probes XNAT:
+      its success closes the circuit, its failure opens it again.
+    """
+    def __init__(self, max_rate=DEFAULT_MAX_RATE, min_rate=DEFAULT_MIN_RATE,
+                 rate_step=DEFAULT_RATE_STEP,
+                 failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 open_seconds=DEFAULT_OPEN_SECONDS, max_pause=DEFAULT_MAX_PAUSE):
+        """Entry point for the RequestGovernor class.
+
+        :param max_rate: maximum number of requests per second
+        :param min_rate: minimum number of requests per second after failures
+        :param rate_step: requests per second added back after each success
+        :param failure_threshold: consecutive failures opening the circuit
+        :param open_seconds: seconds the circuit stays open
+        :param max_pause: maximum seconds a caller waits for the circuit
+        :return: None
+        """
+        self.max_rate = float(max_rate)
+        self.min_rate = float(min(min_rate, max_rate))
+        self.rate_step = float(rate_step)
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.max_pause = max_pause
+        self.rate = self.max_rate
+        self.tokens = self.max_rate
+        self.last_refill = time.time()
+        self.failures = 0
+        self.open_until = 0
+        self.probing = False
+        self.condition = threading.Condition()
+
+    def is_open(self):
+        """
+        Check if the callers are paused because XNAT is unhealthy
+
+        :return: True if the circuit is open, False otherwise
+        """
+        with self.condition:
+            return self.failures >= self.failure_threshold
+
+    def acquire(self):
+        """
+        Wait for the circuit to be closed and for a token of the bucket
+         before sending a request
+
+        :raises: CircuitOpenError if the circuit stays open max_pause seconds
+        :return: None
+        """
+        deadline = time.time() + self.max_pause
+        with self.condition:
+            while True:
+                now = time.time()
+                if now < self.open_until or self.probing:
+                    if now >= deadline:
+                        raise CircuitOpenError('XNAT unhealthy for more than %d seconds, request not sent' % self.max_pause)
+                    if now < self.open_until:
+                        timeout = self.open_until - now
+                    else:
+                        timeout = self.open_seconds
+                    self.condition.wait(min(timeout, deadline - now))
+                    continue
+                if self.failures >= self.failure_threshold:
+                    # Half-open: this request probes XNAT, the others wait for its result
+                    self.probing = True
+                    return
+                self.tokens = min(self.rate, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                self.condition.wait((1 - self.tokens) / self.rate)
+
+    def record_success(self):
+        """
+        Close the circuit and raise the rate by one step after a success
+
+        :return: None
+        """
+        with self.condition:
+            if self.failures >= self.failure_threshold:
+                LOGGER.info('XNAT is responding again, resuming the requests')
+            self.failures = 0
+            self.probing = False
+            self.rate = min(self.max_rate, self.rate + self.rate_step)
+            self.condition.notify_all()
+
+    def record_failure(self):
+        """
+        Halve the rate after a failure and open the circuit after
+         failure_threshold consecutive failures
+
+        :return: None
+        """
+        with self.condition:
+            self.failures += 1
+            self.probing = False
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, self.rate)
+            if self.failures >= self.failure_threshold:
+                self.open_until = time.time() + self.open_seconds
+                LOGGER.warn('XNAT unhealthy after %d failures, pausing the requests for %d seconds'
+                            % (self.failures, self.open_seconds))
+            self.condition.notify_all()
+
+    def release(self):
+        """
+        Let another request probe XNAT when a probe ended without telling
+         anything about the health of XNAT (e.g. invalid request)
+
+        :return: None
+        """
+        with self.condition:
+            if self.probing:
+                self.probing = False
+                self.condition.notify_all()
+
+class GovernedHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter sending the requests of a requests.Session through a
+     RequestGovernor and retrying them with backoff on 5xx and timeouts.
+
+    Only the requests that can be sent twice are retried: GET/HEAD/PUT/
+     DELETE/OPTIONS without a body or with a str body. A streamed body
+     (file, iterator, generator) is consumed by the first attempt, so these
+     failures are returned (or raised) to the caller after being counted by
+     the governor and the caller has to restart the upload.
+    """
+    def __init__(self, governor, request_retries=DEFAULT_MAX_RETRIES,
+                 backoff_base=DEFAULT_BACKOFF_BASE, **kwargs):
+        """Entry point for the GovernedHTTPAdapter class.
+
+        :param governor: RequestGovernor of the host
+        :param request_retries: number of retries of a failed request
+        :param backoff_base: delay of the first retry in seconds
+        :param kwargs: arguments of requests.adapters.HTTPAdapter
+        :return: None
+        """
+        self.governor = governor
+        self.request_retries = request_retries
+        self.backoff_base = backoff_base
+        super(GovernedHTTPAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        """
+        Send the request when the governor allows it, retrying it on failure
+
+        :param request: requests.PreparedRequest
+        :param kwargs: arguments of requests.adapters.HTTPAdapter.send
+        :return: requests.Response
+        """
+        retry = request.method in RETRY_METHODS and \
+                (request.body is None or isinstance(request.body, (str, bytes)))
+        attempt = 0
+        while True:
+            self.governor.acquire()
+            try:
+                response = super(GovernedHTTPAdapter, self).send(request, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as err:
+                self.governor.record_failure()
+                if not retry or attempt >= self.request_retries:
+                    raise
+                reason = str(err)
+            except Exception:
+                self.governor.release()
+                raise
+            else:
+                if response.status_code not in RETRY_STATUS_CODES:
+                    self.governor.record_success()
+                    return response
+                self.governor.record_failure()
+                if not retry or attempt >= self.request_retries:
+                    return response
+                reason = 'HTTP %d' % response.status_code
+                response.close()
+            delay = backoff_delay(attempt, base=self.backoff_base)
+            LOGGER.debug('%s %s failed (%s), retry in %.1f seconds'
+                         % (request.method, request.url, reason, delay))
+            time.sleep(delay)
+            attempt += 1
+
+class XnatRequestPool(object):
+    """
+    Thread pool running XnatUtils calls concurrently on one interface with a
+     bounded number of requests in flight.
+
+    Each call returns a multiprocessing AsyncResult: result.get() waits for
+     the call and gives its value or raises its exception.
+
+    Example:
+        with XnatRequestPool(xnat, 16) as pool:
+            results = [pool.list_sessions(proj) for proj in projects]
+            sessions = [result.get() for result in results]
+    """
+    def __init__(self, intf, max_requests=DEFAULT_MAX_REQUESTS):
+        """Entry point for the XnatRequestPool class.
+
+        :param intf: pyxnat.Interface object shared by the threads
+        :param max_requests: maximum number of requests in flight
+        :return: None
+
+        """
+        self.intf = intf
+        self.max_requests = max(1, max_requests)
+        set_max_connections(intf, self.max_requests)
+        self.pool = ThreadPool(self.max_requests)
+
+    def __enter__(self):
+        """Enter method for with statement."""
+        return self
+
+    def __exit__(self, type, value, traceback):
+        """Exit method for with statement."""
+        self.close()
+
+    def close(self):
+        """Wait for the calls submitted and stop the threads.
+
+        :return: None
+        """
+        self.pool.close()
+        self.pool.join()
+
+    def submit(self, function, *args, **kwargs):
+        """Run function(*args, **kwargs) in the pool.
+
+        :param function: function to call
+        :return: AsyncResult
+        """
+        return self.pool.apply_async(function, args, kwargs)
+
+    def map_calls(self, function, args_list):
+        """Call function for each tuple of arguments and wait for the results.
+
+        :param function: function to call
+        :param args_list: list of tuples of arguments
+        :return: list of the results in the order of args_list
+        """
+        results = [self.submit(function, *args) for args in args_list]
+        return [result.get() for result in results]
+
+    def get_json(self, uri):
+        """intf._get_json(uri) in the pool.
+
+        :param uri: URI of the listing
+        :return: AsyncResult
+        """
+        return self.submit(self.intf._get_json, uri)
+
+    def get_json_list(self, uris):
+        """Get several listings and wait for them.
+
+        :param uris: list of URIs
+        :return: list of the results of intf._get_json in the order of uris
+        """
+        return self.map_calls(self.intf._get_json, [(uri,) for uri in uris])
+
+    def list_subjects(self, projectid=None):
+        """list_subjects in the pool. :return: AsyncResult"""
+        return self.submit(list_subjects, self.intf, projectid)
+
+    def list_sessions(self, projectid=None, subjectid=None):
+        """list_sessions in the pool. :return: AsyncResult"""
+        return self.submit(list_sessions, self.intf, projectid, subjectid)
+
+    def list_scans(self, projectid, subjectid, sessionid):
+        """list_scans in the pool. :return: AsyncResult"""
+        return self.submit(list_scans, self.intf, projectid, subjectid, sessionid)
+
+    def list_assessors(self, projectid, subjectid, sessionid):
+        """list_assessors in the pool. :return: AsyncResult"""
+        return self.submit(list_assessors, self.intf, projectid, subjectid, sessionid)
+
+    def list_project_scans(self, projectid, include_shared=True, filters=None):
+        """list_project_scans in the pool. :return: AsyncResult"""
+        return self.submit(list_project_scans, self.intf, projectid,
+                           include_shared, filters)
+
+    def list_project_assessors(self, projectid, filters=None):
+        """list_project_assessors in the pool. :return: AsyncResult"""
+        return self.submit(list_project_assessors, self.intf, projectid, filters)
+
+    def list_resources(self, projectid, subjectid=None, sessionid=None,
+                       scanid=None, assessorid=None):
+        """list_*_resources in the pool for the deepest level given.
+
+        :return: AsyncResult
+        """
+        if assessorid:
+            return self.submit(list_assessor_out_resources, self.intf,
+                               projectid, subjectid, sessionid, assessorid)
+        elif scanid:
+            return self.submit(list_scan_resources, self.intf, projectid,
+                               subjectid, sessionid, scanid)
+        elif sessionid:
+            return self.submit(list_session_resources, self.intf, projectid,
+                               subjectid, sessionid)
+        elif subjectid:
+            return self.submit(list_subject_resources, self.intf, projectid,
+                               subjectid)
+        return self.submit(list_project_resources, self.intf, projectid)
+
+    def get_attrs(self, obj_dict, attrs):
+        """Get attributes of the object of an XnatUtils listing dictionary.
+
+        :param obj_dict: dictionary from one of the list_* functions
+        :param attrs: list of attributes (e.g: ['proc:genProcData/procstatus'])
+        :return: AsyncResult of the list of values
+        """
+        return self.submit(get_obj_attrs, self.intf, obj_dict, attrs)
+
+    def set_attrs(self, obj_dict, attrs):
+        """Set attributes of the object of an XnatUtils listing dictionary.
+
+        :param obj_dict: dictionary from one of the list_* functions
+        :param attrs: dictionary attribute -> value
+        :return: AsyncResult
+        """
+        return self.submit(set_obj_attrs, self.intf, obj_dict, attrs)
+
+    def download_file(self, directory, resource_obj, fname=None):
+        """download_file_from_obj in the pool. :return: AsyncResult"""
+        return self.submit(download_file_from_obj, directory, resource_obj, fname)
+
+    def download_files(self, directory, resource_obj):
+        """Download the files of a resource with one request per file.
+
+        :param directory: directory where the files are downloaded
+        :param resource_obj: pyxnat resource object
+        :return: AsyncResult of the list of files downloaded
+        """
+        return self.submit(self._download_files, directory, resource_obj)
+
+    def _download_files(self, directory, resource_obj):
+        """Download the files of a resource concurrently (in the pool)."""
+        fnames = resource_obj.files().get()
+        # Downloads running in other threads of the pool: no nested wait
+        pool = ThreadPool(min(self.max_requests, max(1, len(fnames))))
+        try:
+            return pool.map(lambda fname: download_file_from_obj(
+                directory, resource_obj, fname), fnames)
+        finally:
+            pool.close()
+            pool.join()
+
+    def download_resource_zip(self, directory, resource_obj):
+        """download_resource_zip in the pool. :return: AsyncResult"""
+        return self.submit(download_resource_zip, self.intf, directory, resource_obj)
+
+    def upload_file(self, filepath, resource_obj, remove=False,
+                    removeall=False, fname=None):
+        """upload_file_to_obj in the pool. :return: AsyncResult"""
+        return self.submit(upload_file_to_obj, filepath, resource_obj,
+                           remove, removeall, fname)
+
 class AssessorHandler:
     """
     Class to intelligently deal with the Assessor labels and to hopefully make the splitting of the strings easier.
@@ -256,7 +667,9 @@ class SpiderProcessHandler:
     """
     Class to handle the uploading of results from a spider to the upload directory
     """
-    def __init__(self, script_name, suffix, project, subject, experiment, scan=None, time_writer=None):
+    def __init__(self, script_name, suffix, project, subject, experiment, scan=None,
+                 time_writer=None, staging=DEFAULT_STAGING, compress=True,
+                 compress_workers=DEFAULT_COMPRESS_WORKERS):
         """
         Entry point to the SpiderProcessHandler Class
 
@@ -267,13 +680,25 @@ class SpiderProcessHandler:
         :param experiment: Session on XNAT
         :param scan: Scan (if needed) On Xnat
         :param time_writer: TimedWriter object if wanted
+        :param staging: how the outputs are put in the upload directory
+         (see STAGING_MODES). With 'link', the outputs must not be modified
+         after being added. With 'move', they are removed from the jobdir.
+        :param compress: gzip the .nii/.rec files added with add_file
+        :param compress_workers: number of threads compressing the files
         :return: None
 
         """
+        if staging not in STAGING_MODES:
+            raise ValueError('staging must be one of %s' % ', '.join(STAGING_MODES))
         #Variables:
         self.error = 0
         self.has_pdf = 0
         self.time_writer = time_writer
+        self.staging = staging
+        self.compress = compress
+        self.compress_workers = compress_workers
+        # Files compressed at the end (see compress_files)
+        self.files_to_compress = list()
         # Get the process name and the version
         if len(script_name.split('/')) > 1:
             script_name = os.path.basename(script_name)
@@ -394,11 +819,11 @@ class SpiderProcessHandler:
         :return: None
 
         """
-        self.print_msg('''  -Copying {label}: {src} to {dest}'''.format(label=label, src=src, dest=dest))
+        self.print_msg('''  -Copying {label}: {src} to {dest} ({mode})'''.format(label=label, src=src, dest=dest, mode=self.staging))
 
     def add_pdf(self, filepath):
         """
-        Add the PDF and run ps2pdf on the file if it ends with .ps
+        Add the PDF and convert the file with ghostscript if it ends with .ps
 
         :param filepath: Full path to the PDF/PS file
         :return: None
@@ -408,9 +833,13 @@ class SpiderProcessHandler:
             #Check if it's a ps:
             if filepath.lower().endswith('.ps'):
                 pdf_path = os.path.splitext(filepath)[0]+'.pdf'
-                ps2pdf_cmd = '''ps2pdf {ps} {pdf}'''.format(ps=filepath, pdf=pdf_path)
-                self.print_msg('''  -Convertion {cmd} ...'''.format(cmd=ps2pdf_cmd))
-                os.system(ps2pdf_cmd)
+                # Same conversion as ps2pdf without the shell and the wrapper script
+                ps2pdf_cmd = ['gs', '-q', '-dSAFER', '-dNOPAUSE', '-dBATCH',
+                              '-sDEVICE=pdfwrite', '-sOutputFile=%s' % pdf_path,
+                              filepath]
+                self.print_msg('''  -Convertion {cmd} ...'''.format(cmd=' '.join(ps2pdf_cmd)))
+                if subprocess.call(ps2pdf_cmd) != 0:
+                    self.print_err('''conversion of {ps} to pdf failed.'''.format(ps=filepath))
             else:
                 pdf_path = filepath
             self.add_file(pdf_path, 'PDF')
@@ -441,12 +870,14 @@ class SpiderProcessHandler:
             respath = os.path.join(self.directory, resource)
             if not os.path.exists(respath):
                 os.mkdir(respath)
-            #mv the file
+            #link/mv/copy the file
             self.print_copying_statement(resource, filepath, respath)
-            shutil.copy(filepath, respath)
-            #if it's a nii or a rec file, gzip it:
-            if filepath.lower().endswith('.nii') or filepath.lower().endswith('.rec'):
-                os.system('gzip '+os.path.join(respath, os.path.basename(filepath)))
+            dest = os.path.join(respath, os.path.basename(filepath))
+            stage_file(filepath, dest, self.staging)
+            #if it's a nii or a rec file, gzip it at the end:
+            if self.compress and \
+               os.path.splitext(filepath.lower())[1] in COMPRESSED_EXTENSIONS:
+                self.files_to_compress.append(dest)
 
     def add_folder(self, folderpath, resource_name=None):
         """
@@ -467,7 +898,7 @@ class SpiderProcessHandler:
             dest = os.path.join(self.directory, res)
 
             try:
-                shutil.copytree(folderpath, dest)
+                stage_tree(folderpath, dest, self.staging)
                 self.print_copying_statement(res, folderpath, dest)
             # Directories are the same
             except shutil.Error as excep:
@@ -476,6 +907,29 @@ class SpiderProcessHandler:
             except OSError as excep:
                 self.print_err('Directory not copied. Error: %s' % excep)
 
+    def compress_files(self):
+        """
+        Gzip the .nii/.rec files added, in parallel threads (zlib releases the
+         GIL). Called by done().
+
+        :return: None
+
+        """
+        if not self.files_to_compress:
+            return
+        self.print_msg('''  -Compressing {nb} files ...'''.format(nb=len(self.files_to_compress)))
+        pool = ThreadPool(max(1, min(self.compress_workers, len(self.files_to_compress))))
+        try:
+            results = pool.map(compress_staged_file, self.files_to_compress)
+        finally:
+            pool.close()
+            pool.join()
+        for fpath, error in zip(self.files_to_compress, results):
+            if error:
+                self.set_error()
+                self.print_err('''gzip of {file} failed: {error}'''.format(file=fpath, error=error))
+        self.files_to_compress = list()
+
     def set_assessor_status(self, status):
         """
         Set the status of the assessor based on passed value
@@ -485,6 +939,7 @@ class SpiderProcessHandler:
         :return: None
         """
         # Connection to Xnat
+        xnat = None
         try:
             xnat = get_interface()
             assessor = self.assr_handler.select_assessor(xnat)
@@ -499,11 +954,15 @@ class SpiderProcessHandler:
                 else:
                     assessor.attrs.set(DEFAULT_DATATYPE+'/procstatus', status)
                     self.print_msg('  -status set for assessor to '+str(status))
-        except:
+        except Exception as err:
             # fail to access XNAT -- let dax_upload set the status
-            pass
+            self.print_msg('  -failed to set the status of the assessor, left to dax_upload: %s' % err)
         finally:
-            if 'xnat' in locals() or xnat != None: xnat.disconnect()
+            if xnat is not None:
+                try:
+                    xnat.disconnect()
+                except Exception:
+                    pass
 
     def done(self):
         """
@@ -513,6 +972,7 @@ class SpiderProcessHandler:
         :return: None
 
         """
+        self.compress_files()
         #creating the version file to give the spider version:
         f_obj = open(os.path.join(self.directory, 'version.txt'), 'w')
         f_obj.write(self.version)
@@ -634,7 +1094,7 @@ def list_subject_resources(intf, projectid, subjectid):
     resource_list = intf._get_json(post_uri)
     return resource_list
 
-def list_sessions(intf, projectid=None, subjectid=None):
+def list_sessions(intf, projectid=None, subjectid=None, pool=None):
     """
     List all the sessions that you have access to. Or, alternatively, list the session
      in a single project (and single subject) based on passed project ID (/subject ID)
@@ -642,6 +1102,8 @@ def list_sessions(intf, projectid=None, subjectid=None):
     :param intf: pyxnat.Interface object
     :param projectid: ID of a project on XNAT
     :param subjectid: ID/label of a subject
+    :param pool: XnatRequestPool sending the listings concurrently (not to
+     be called from one of its threads). One after the other by default.
     :return: List of sessions
     """
     type_list = []
@@ -656,6 +1118,10 @@ def list_sessions(intf, projectid=None, subjectid=None):
     else:
         return None
 
+    #Get the subjects list to get the subject ID (while listing the types):
+    if pool is not None:
+        subj_result = pool.list_subjects(projectid)
+
     # First get a list of all experiment types
     post_uri_types = post_uri+'?columns=xsiType'
     sess_list = intf._get_json(post_uri_types)
@@ -664,18 +1130,23 @@ def list_sessions(intf, projectid=None, subjectid=None):
         if sess_type not in type_list:
             type_list.append(sess_type)
 
-    #Get the subjects list to get the subject ID:
-    subj_list = list_subjects(intf, projectid)
-    subj_id2lab = dict((subj['ID'], [subj['handedness'], subj['gender'], subj['yob'], subj['dob']]) for subj in subj_list)
-
     # Get list of sessions for each type since we have to specific about last_modified field
+    uris = list()
     for sess_type in type_list:
         if sess_type.startswith('xnat:') and 'session' in sess_type:
-            post_uri_type = post_uri + SESSION_POST_URI.format(stype=sess_type)
+            uris.append(post_uri + SESSION_POST_URI.format(stype=sess_type))
         else:
-            post_uri_type = post_uri + NO_MOD_SESSION_POST_URI.format(stype=sess_type)
-        sess_list = intf._get_json(post_uri_type)
+            uris.append(post_uri + NO_MOD_SESSION_POST_URI.format(stype=sess_type))
+    if pool is not None:
+        sess_lists = pool.get_json_list(uris)
+        subj_list = subj_result.get()
+    else:
+        sess_lists = [intf._get_json(uri) for uri in uris]
+        subj_list = list_subjects(intf, projectid)
+
+    subj_id2lab = dict((subj['ID'], [subj['handedness'], subj['gender'], subj['yob'], subj['dob']]) for subj in subj_list)
 
+    for sess_type, sess_list in zip(type_list, sess_lists):
         for sess in sess_list:
             # Override the project returned to be the one we queried
             if projectid:
@@ -765,13 +1236,47 @@ def list_scans(intf, projectid, subjectid, sessionid):
 
     return sorted(new_list, key=lambda k: k['label'])
 
-def list_project_scans(intf, projectid, include_shared=True):
+def get_filters_query(filters):
+    """
+    Query string filtering a listing on XNAT side: the rows are kept if the
+     column has one of the values.
+
+    :param filters: dictionary column (or xsiType) -> list of values
+    :return: string to add to the listing URI
+    """
+    if not filters:
+        return ''
+    query = ''
+    for column, values in sorted(filters.items()):
+        values = ','.join(urllib.quote(str(value), safe='') for value in values)
+        if column == 'xsiType':
+            query += '&xsiType='+values
+        else:
+            query += '&%s=%s' % (column, values)
+    return query
+
+def get_scan_proj_post_uri(post_uri, filters):
+    """
+    Add the filters to a listing URI of the project scans
+
+    :param post_uri: SCAN_PROJ_POST_URI or SCAN_PROJ_INCLUDED_POST_URI formatted
+    :param filters: dictionary column (or xsiType) -> list of values
+    :return: URI
+    """
+    if filters and 'xsiType' in filters:
+        post_uri = post_uri.replace('&xsiType=xnat:imageSessionData', '')
+    return post_uri + get_filters_query(filters)
+
+def list_project_scans(intf, projectid, include_shared=True, filters=None):
     """
     List all the scans that you have access to based on passed project.
 
     :param intf: pyxnat.Interface object
     :param projectid: ID of a project on XNAT
     :param include_shared: include the shared data in this project
+    :param filters: dictionary column -> list of values to only list the
+     scans matching on XNAT side. E.G: {'xnat:imagescandata/type': ['T1']}.
+     xsiType replaces the session type (default xnat:imageSessionData).
     :return: List of all the scans for the project
     """
     scans_dict = dict()
@@ -781,7 +1286,8 @@ def list_project_scans(intf, projectid, include_shared=True):
     sess_id2mod = dict((sess['session_id'], [sess['handedness'], sess['gender'], sess['yob'], sess['age'], sess['last_modified'], sess['last_updated']]) for sess in session_list)
 
     post_uri = SE_ARCHIVE_URI
-    post_uri += SCAN_PROJ_POST_URI.format(project=projectid)
+    post_uri += get_scan_proj_post_uri(SCAN_PROJ_POST_URI.format(project=projectid),
+                                       filters)
     scan_list = intf._get_json(post_uri)
 
     for scan in scan_list:
@@ -824,7 +1330,8 @@ def list_project_scans(intf, projectid, include_shared=True):
 
     if include_shared:
         post_uri = SE_ARCHIVE_URI
-        post_uri += SCAN_PROJ_INCLUDED_POST_URI.format(project=projectid)
+        post_uri += get_scan_proj_post_uri(SCAN_PROJ_INCLUDED_POST_URI.format(project=projectid),
+                                           filters)
         scan_list = intf._get_json(post_uri)
 
         for scan in scan_list:
@@ -886,7 +1393,7 @@ def list_scan_resources(intf, projectid, subjectid, sessionid, scanid):
     resource_list = intf._get_json(post_uri)
     return resource_list
 
-def list_assessors(intf, projectid, subjectid, sessionid):
+def list_assessors(intf, projectid, subjectid, sessionid, pool=None):
     """
     List all the assessors that you have access to based on passed session/subject/project.
 
@@ -894,18 +1401,29 @@ def list_assessors(intf, projectid, subjectid, sessionid):
     :param projectid: ID of a project on XNAT
     :param subjectid: ID/label of a subject
     :param sessionid: ID/label of a session
+    :param pool: XnatRequestPool sending the listings concurrently (not to
+     be called from one of its threads). One after the other by default.
     :return: List of all the assessors
 
     """
     new_list = list()
+    datatypes = intf.inspect.datatypes()
+    post_uri = ASSESSORS_URI.format(project=projectid,
+                                    subject=subjectid,
+                                    session=sessionid)
+    uris = list()
+    if DEFAULT_FS_DATATYPE in datatypes:
+        uris.append(post_uri+ASSESSOR_FS_POST_URI.format(fstype=DEFAULT_FS_DATATYPE))
+    if DEFAULT_DATATYPE in datatypes:
+        uris.append(post_uri+ASSESSOR_PR_POST_URI.format(pstype=DEFAULT_DATATYPE))
+    if pool is not None:
+        assessor_lists = pool.get_json_list(uris)
+    else:
+        assessor_lists = [intf._get_json(uri) for uri in uris]
 
-    if has_fs_datatypes(intf):
+    if DEFAULT_FS_DATATYPE in datatypes:
         # First get FreeSurfer
-        post_uri = ASSESSORS_URI.format(project=projectid,
-                                        subject=subjectid,
-                                        session=sessionid)
-        post_uri += ASSESSOR_FS_POST_URI.format(fstype=DEFAULT_FS_DATATYPE)
-        assessor_list = intf._get_json(post_uri)
+        assessor_list = assessor_lists.pop(0)
 
         for asse in assessor_list:
             anew = {}
@@ -926,13 +1444,9 @@ def list_assessors(intf, projectid, subjectid, sessionid):
             anew['xsiType'] = asse['xsiType']
             new_list.append(anew)
 
-    if has_genproc_datatypes(intf):
+    if DEFAULT_DATATYPE in datatypes:
         # Then add genProcData
-        post_uri = ASSESSORS_URI.format(project=projectid,
-                                        subject=subjectid,
-                                        session=sessionid)
-        post_uri += ASSESSOR_PR_POST_URI.format(pstype=DEFAULT_DATATYPE)
-        assessor_list = intf._get_json(post_uri)
+        assessor_list = assessor_lists.pop(0)
 
         for asse in assessor_list:
             anew = {}
@@ -955,29 +1469,61 @@ def list_assessors(intf, projectid, subjectid, sessionid):
 
     return sorted(new_list, key=lambda k: k['label'])
 
-def list_project_assessors(intf, projectid):
+def list_project_assessors(intf, projectid, filters=None, pool=None):
     """
     List all the assessors that you have access to based on passed project.
 
     :param intf: pyxnat.Interface object
     :param projectid: ID of a project on XNAT
+    :param filters: dictionary field -> list of values to only list the
+     assessors matching on XNAT side. The fields are the ones of the
+     assessor datatypes: procstatus, proctype, validation/status...
+     The FreeSurfer assessors (proctype FreeSurfer*) are not filtered
+     on proctype.
+    :param pool: XnatRequestPool sending the listings concurrently (not to
+     be called from one of its threads). A pool is made for the call by default.
     :return: List of all the assessors for the project
     """
     assessors_dict = dict()
-
-    #Get the sessions list to get the different variables needed:
-    session_list = list_sessions(intf, projectid)
+    datatypes = intf.inspect.datatypes()
+    fs_filters = pr_filters = None
+    if filters:
+        pr_filters = dict(('%s/%s' % (DEFAULT_DATATYPE, field), values)
+                          for field, values in filters.items())
+        fs_filters = dict(('%s/%s' % (DEFAULT_FS_DATATYPE, field), values)
+                          for field, values in filters.items()
+                          if field != 'proctype')
+        if 'proctype' in filters and \
+           not [proctype for proctype in filters['proctype']
+                if proctype.startswith('FreeSurfer')]:
+            datatypes = [dtype for dtype in datatypes if dtype != DEFAULT_FS_DATATYPE]
+
+    # Sessions and assessors listings requested at the same time
+    own_pool = pool is None
+    if own_pool:
+        pool = XnatRequestPool(intf)
+    try:
+        fs_result = None
+        if DEFAULT_FS_DATATYPE in datatypes:
+            fs_result = pool.get_json(SE_ARCHIVE_URI + ASSESSOR_FS_PROJ_POST_URI.format(
+                project=projectid, fstype=DEFAULT_FS_DATATYPE) + get_filters_query(fs_filters))
+        pr_result = None
+        if DEFAULT_DATATYPE in datatypes:
+            pr_result = pool.get_json(SE_ARCHIVE_URI + ASSESSOR_PR_PROJ_POST_URI.format(
+                project=projectid, pstype=DEFAULT_DATATYPE) + get_filters_query(pr_filters))
+        #Get the sessions list to get the different variables needed:
+        session_list = list_sessions(intf, projectid, pool=pool)
+    finally:
+        if own_pool:
+            pool.close()
     sess_id2mod = dict((sess['session_id'], [sess['subject_label'],
                         sess['type'], sess['handedness'], sess['gender'],
                         sess['yob'], sess['age'], sess['last_modified'],
                         sess['last_updated']]) for sess in session_list)
 
-    if has_fs_datatypes(intf):
+    if fs_result is not None:
         # First get FreeSurfer
-        post_uri = SE_ARCHIVE_URI
-        post_uri += ASSESSOR_FS_PROJ_POST_URI.format(project=projectid,
-                                                     fstype=DEFAULT_FS_DATATYPE)
-        assessor_list = intf._get_json(post_uri)
+        assessor_list = fs_result.get()
 
         for asse in assessor_list:
             if asse['label']:
@@ -1022,12 +1568,9 @@ def list_project_assessors(intf, projectid):
                     anew['resources'] = [asse['fs:fsdata/out/file/label']]
                     assessors_dict[key] = anew
 
-    if has_genproc_datatypes(intf):
+    if pr_result is not None:
         # Then add genProcData
-        post_uri = SE_ARCHIVE_URI
-        post_uri += ASSESSOR_PR_PROJ_POST_URI.format(project=projectid,
-                                                     pstype=DEFAULT_DATATYPE)
-        assessor_list = intf._get_json(post_uri)
+        assessor_list = pr_result.get()
 
         for asse in assessor_list:
             if asse['label']:
@@ -1102,6 +1645,20 @@ def get_resource_lastdate_modified(intf, resource_obj):
     :param resource: resource pyxnat Eobject
     :return: date of last modified data with the format %Y%m%d%H%M%S
     """
+    res_date = get_resource_catalog_date(intf, resource_obj)
+    if res_date is None:
+        res_date = ('{:%Y%m%d%H%M%S}'.format(datetime.now()))
+    return res_date
+
+def get_resource_catalog_date(intf, resource_obj):
+    """
+    Get the most recent created/modified time of the files in the catalog
+     of a resource
+
+    :param intf: pyxnat.Interface object
+    :param resource: resource pyxnat Eobject
+    :return: date with the format %Y%m%d%H%M%S, None if the catalog has no time
+    """
     # xpaths for times in resource xml
     created_dicom_xpath = "/cat:DCMCatalog/cat:entries/cat:entry/@createdTime"
     modified_dicom_xpath = "/cat:DCMCatalog/cat:entries/cat:entry/@modifiedTime"
@@ -1121,13 +1678,10 @@ def get_resource_lastdate_modified(intf, resource_obj):
         mod_times = root.xpath(modified_dicom_xpath, namespaces=root.nsmap)
     # Find the most recent time
     all_times = create_times + mod_times
-    if all_times:
-        max_time = max(all_times)
-        date = max_time.split('.')[0]
-        res_date = date.split('T')[0].replace('-', '')+date.split('T')[1].replace(':', '')
-    else:
-        res_date = ('{:%Y%m%d%H%M%S}'.format(datetime.now()))
-    return res_date
+    if not all_times:
+        return None
+    date = max(all_times).split('.')[0]
+    return date.split('T')[0].replace('-', '')+date.split('T')[1].replace(':', '')
 
 def select_assessor(intf, assessor_label):
     """
@@ -1177,6 +1731,106 @@ def get_full_object(intf, obj_dict):
     else:
         return intf.select('/project/')  #Return non existing object: obj.exists() -> False
 
+def get_obj_attrs(intf, obj_dict, attrs):
+    """
+    Get attributes of the object described by a dictionary from a listing
+
+    :param intf: pyxnat.Interface object
+    :param obj_dict: dictionary from one of the list_* functions
+    :param attrs: list of attributes (e.g: ['proc:genProcData/procstatus'])
+    :return: list of the values in the order of attrs
+    """
+    return get_full_object(intf, obj_dict).attrs.mget(attrs)
+
+def set_obj_attrs(intf, obj_dict, attrs):
+    """
+    Set attributes of the object described by a dictionary from a listing
+
+    :param intf: pyxnat.Interface object
+    :param obj_dict: dictionary from one of the list_* functions
+    :param attrs: dictionary attribute -> value
+    :return: None
+    """
+    get_full_object(intf, obj_dict).attrs.mset(attrs)
+
+def set_max_connections(intf, max_connections):
+    """
+    Keep up to max_connections connections open to XNAT for the threads
+     sharing the interface (requests keeps 10 by default)
+
+    :param intf: pyxnat.Interface object
+    :param max_connections: number of connections
+    :return: None
+    """
+    http = getattr(intf, '_http', None)
+    if http is None or getattr(intf, 'max_connections', 0) >= max_connections:
+        return
+    governor = getattr(intf, 'governor', None)
+    if governor is None:
+        governor = get_request_governor(intf._server)
+        intf.governor = governor
+    adapter = GovernedHTTPAdapter(governor, pool_maxsize=max_connections)
+    http.mount('http://', adapter)
+    http.mount('https://', adapter)
+    intf.max_connections = max_connections
+
+def set_request_governor(intf):
+    """
+    Send the requests of the interface through the RequestGovernor of its
+     host: rate limit, retries with backoff and circuit breaker
+
+    :param intf: pyxnat.Interface object
+    :return: None
+    """
+    http = getattr(intf, '_http', None)
+    if http is None:
+        return
+    intf.governor = get_request_governor(intf._server)
+    adapter = GovernedHTTPAdapter(intf.governor,
+                                  pool_maxsize=getattr(intf, 'max_connections', 10))
+    http.mount('http://', adapter)
+    http.mount('https://', adapter)
+
+def get_request_governor(host):
+    """
+    Get the RequestGovernor shared by all the interfaces of the process
+     talking to host, creating it on the first call
+
+    :param host: URL of XNAT
+    :return: RequestGovernor object
+    """
+    key = host.rstrip('/').lower()
+    with GOVERNORS_LOCK:
+        if key not in GOVERNORS:
+            GOVERNORS[key] = RequestGovernor()
+        return GOVERNORS[key]
+
+def backoff_delay(attempt, base=DEFAULT_BACKOFF_BASE, maximum=DEFAULT_BACKOFF_MAX):
+    """
+    Exponential backoff with full jitter: a random delay up to base*2^attempt
+     so that the callers failing together do not retry together
+
+    :param attempt: number of the retry, starting at 0
+    :param base: delay of the first retry in seconds
+    :param maximum: maximum delay in seconds
+    :return: delay in seconds
+    """
+    return random.uniform(0, min(maximum, base * (2 ** attempt)))
+
+def get_json_list(intf, uris, max_requests=DEFAULT_MAX_REQUESTS):
+    """
+    Get several listings from XNAT concurrently
+
+    :param intf: pyxnat.Interface object
+    :param uris: list of URIs
+    :param max_requests: maximum number of requests in flight
+    :return: list of the results of intf._get_json in the order of uris
+    """
+    if len(uris) < 2:
+        return [intf._get_json(uri) for uri in uris]
+    with XnatRequestPool(intf, min(max_requests, len(uris))) as pool:
+        return pool.get_json_list(uris)
+
 def get_assessor(xnat, projid, subjid, sessid, assrid):
     """
     Run Interface.select down to the assessor level
@@ -1656,6 +2310,35 @@ def download_files_from_obj(directory, resource_obj):
 
     return fpaths
 
+def download_resource_zip(intf, directory, resource_obj, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """
+    Download all the files of a resource as one zip and extract it in-process.
+     The zip is streamed by chunks to a temporary file in the directory
+     instead of being held in memory.
+
+    :param intf: pyxnat.Interface object
+    :param directory: Full path to the directory where the zip is extracted
+    :param resource_obj: Pyxnat EObject of the resource
+    :param chunk_size: size of the chunks read from the response
+    :return: List of all the files extracted (paths from the zip: the
+     hierarchy of XNAT under directory)
+
+    """
+    uri = '%s%s/files?format=zip' % (intf._server, resource_obj._uri)
+    response = intf._http.get(uri, stream=True)
+    try:
+        response.raise_for_status()
+        with tempfile.TemporaryFile(dir=directory) as zip_file:
+            for chunk in response.iter_content(chunk_size):
+                zip_file.write(chunk)
+            zip_file.seek(0)
+            archive = zipfile.ZipFile(zip_file)
+            archive.extractall(directory)
+            names = archive.namelist()
+    finally:
+        response.close()
+    return [os.path.join(directory, name) for name in names if not name.endswith('/')]
+
 def download_files(directory, resource, project_id=None, subject_id=None,
                    session_id=None, scan_id=None, assessor_id=None):
     """
@@ -2867,20 +3550,22 @@ class CachedResource():
 
         return res_info
 ####################### File Utils ######################################################
-def gzip_file(file_not_zipped):
+def gzip_file(file_not_zipped, compresslevel=9):
     """
     Method to gzip a file using the gzip python package
 
     :param file_not_zipped: Full path to a file to gzip
+    :param compresslevel: gzip compression level (1-9)
     :return: Full path to the gzipped file
 
     """
     file_out = list()
-    content = open(file_not_zipped, 'rb')
-    content = content.read()
-    fout = gzip.open(file_not_zipped + '.gz', 'wb')
-    fout.write(content)
-    fout.close()
+    with open(file_not_zipped, 'rb') as f_in:
+        fout = gzip.open(file_not_zipped + '.gz', 'wb', compresslevel)
+        try:
+            shutil.copyfileobj(f_in, fout, 1024*1024)
+        finally:
+            fout.close()
     file_out.append(file_not_zipped + '.gz')
     os.remove(file_not_zipped)
     return file_out
@@ -2899,6 +3584,100 @@ def gunzip_file(file_zipped):
     open(file_zipped[:-3],'w').write(gzdata)
 
 
+def compress_staged_file(fpath):
+    """
+    Gzip a file staged by SpiderProcessHandler with the level of the gzip
+     command line (worker of SpiderProcessHandler.compress_files)
+
+    :param fpath: Full path to the file
+    :return: None, or the error message if it failed
+    """
+    try:
+        gzip_file(fpath, compresslevel=6)
+    except (IOError, OSError) as err:
+        return str(err)
+    return None
+
+def stage_file(src, dest, mode=DEFAULT_STAGING):
+    """
+    Put a file at dest without copying its data when src and dest are on the
+     same filesystem (hardlink or rename), copy it otherwise
+
+    :param src: Full path to the file
+    :param dest: Full path of the destination file (replaced if it exists)
+    :param mode: 'link', 'move' or 'copy' (see STAGING_MODES)
+    :return: the mode used ('link', 'move' or 'copy')
+    """
+    if os.path.exists(dest) and os.path.samefile(src, dest):
+        same_path = os.path.realpath(src) == os.path.realpath(dest)
+        # Already in place: removing dest would remove the data when it is
+        #  the same path. A hardlink is only replaced to get a real copy.
+        if same_path or mode != 'copy':
+            if mode == 'move' and not same_path:
+                os.remove(src)
+            return mode
+    if os.path.lexists(dest):
+        os.remove(dest)
+    if mode != 'copy' and same_filesystem(src, os.path.dirname(dest)):
+        try:
+            if mode == 'link':
+                os.link(src, dest)
+            else:
+                os.rename(src, dest)
+            return mode
+        except OSError:
+            # e.g. hardlinks not allowed on the filesystem
+            pass
+    shutil.copy(src, dest)
+    if mode == 'move':
+        os.remove(src)
+    return 'copy'
+
+def stage_tree(src, dest, mode=DEFAULT_STAGING):
+    """
+    Same as stage_file for a directory tree. dest must not exist (like
+     shutil.copytree).
+
+    :param src: Full path to the directory
+    :param dest: Full path of the destination directory
+    :param mode: 'link', 'move' or 'copy' (see STAGING_MODES)
+    :except OSError: dest exists or src can't be read
+    :return: None
+    """
+    if mode == 'copy':
+        shutil.copytree(src, dest)
+    elif mode == 'move':
+        if os.path.exists(dest):
+            raise OSError('Destination %s already exists' % dest)
+        # rename on the same filesystem, copy and remove otherwise
+        shutil.move(src, dest)
+    else:
+        os.makedirs(dest)
+        for name in os.listdir(src):
+            src_path = os.path.join(src, name)
+            dest_path = os.path.join(dest, name)
+            if os.path.islink(src_path):
+                os.symlink(os.readlink(src_path), dest_path)
+            elif os.path.isdir(src_path):
+                stage_tree(src_path, dest_path, mode)
+            else:
+                stage_file(src_path, dest_path, mode)
+        shutil.copystat(src, dest)
+
+def same_filesystem(path1, path2):
+    """
+    Check if two existing paths are on the same filesystem
+
+    :param path1: first path
+    :param path2: second path
+    :return: True if they are on the same device, False otherwise
+    """
+    try:
+        return os.stat(path1).st_dev == os.stat(path2).st_dev
+    except OSError:
+        return False
+
+
 ####################### DEPRECATED Methods still in used in different Spiders ##########################
 # It will need to be removed when the spiders are updated
 def list_experiments(intf, projectid=None, subjectid=None):
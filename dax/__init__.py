@@ -4,7 +4,7 @@ import XnatUtils
 from .task import Task
 from .cluster import PBS
 from .launcher import Launcher
-from .dax_settings import DAX_Settings
+from .dax_settings import DAX_Settings, get_settings
 from .version import VERSION as __version__
 from .XnatUtils import SpiderProcessHandler
 from .modules import ScanModule, SessionModule
@@ -0,0 +1,309 @@
+""" benchmark.py
+
+Scale benchmark of Launcher.build, Launcher.update_tasks and
+Launcher.launch_jobs against a MockXnatServer with synthetic projects and the
+fake scheduler of fake_cluster.py. Each step runs in its own python process
+with a temporary HOME holding the .dax_settings.ini of the benchmark. The
+wall time, the number of requests received by the mock server and the peak
+memory of the process are reported for each step.
+"""
+
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__copyright__ = 'Copyright 2013 Vanderbilt University. All Rights Reserved'
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import tempfile
+import subprocess
+import ConfigParser
+
+import fake_cluster
+from dax_settings import DAX_MANAGER_DEFAULTS
+from mock_xnat import MockXnat, MockXnatServer
+from processors import ScanProcessor, SessionProcessor
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+DEFAULT_QUEUE_LIMIT = 1000
+BENCH_PROJECT = 'BENCH'
+BENCH_USER = 'bench'
+# Steps run for each size: a first build creating the assessors, update,
+# launch, update with the jobs done, then a build without any change
+STEPS = ['build', 'update', 'launch', 'update', 'build']
+STEP_CODE = {'build': 'bin.build(sys.argv[1], sys.argv[2], False)',
+             'update': 'bin.update_tasks(sys.argv[1], sys.argv[2], False)',
+             'launch': 'bin.launch_jobs(sys.argv[1], sys.argv[2], False)'}
+SETTINGS_TEMPLATE = """from dax import Launcher
+from dax.benchmark import BenchmarkScanProcessor, BenchmarkSessionProcessor
+
+scan_proc = BenchmarkScanProcessor('{spider_dir}')
+session_proc = BenchmarkSessionProcessor('{spider_dir}')
+myLauncher = Launcher({{'{project}': [scan_proc, session_proc]}},
+                      {{'{project}': []}},
+                      priority_project=None,
+                      queue_limit={queue_limit},
+                      root_job_dir='{root_job_dir}',
+                      xnat_user='{user}', xnat_pass='{user}',
+                      xnat_host='{host}',
+                      job_email=None)
+"""
+
+#Logger to print logs
+LOGGER = logging.getLogger('dax')
+
+class BenchmarkScanProcessor(ScanProcessor):
+    """ Scan processor with inputs on every T1 and a job doing nothing """
+    def __init__(self, spider_dir):
+        """
+        Entry point for the BenchmarkScanProcessor class
+
+        :param spider_dir: directory of the (unused) spider
+        :return: None
+        """
+        super(BenchmarkScanProcessor, self).__init__(
+            ['T1'], '00:10:00', 1024,
+            os.path.join(spider_dir, 'Spider_BenchScan_v1_0_0.py'))
+
+    def has_inputs(self, cscan):
+        """
+        Inputs are always there
+
+        :param cscan: CachedImageScan object from XnatUtils
+        :return: 1, None
+        """
+        return 1, None
+
+    def get_cmds(self, assessor, jobdir):
+        """
+        Commands of the job
+
+        :param assessor: pyxnat assessor object
+        :param jobdir: directory of the job
+        :return: list of commands
+        """
+        return ['echo %s' % jobdir]
+
+class BenchmarkSessionProcessor(SessionProcessor):
+    """ Session processor with inputs on every session """
+    def __init__(self, spider_dir):
+        """
+        Entry point for the BenchmarkSessionProcessor class
+
+        :param spider_dir: directory of the (unused) spider
+        :return: None
+        """
+        super(BenchmarkSessionProcessor, self).__init__(
+            '00:10:00', 1024,
+            os.path.join(spider_dir, 'Spider_BenchSession_v1_0_0.py'))
+
+    def has_inputs(self, csess):
+        """
+        Inputs are always there
+
+        :param csess: CachedImageSession object from XnatUtils
+        :return: 1, None
+        """
+        return 1, None
+
+    def get_cmds(self, assessor, jobdir):
+        """
+        Commands of the job
+
+        :param assessor: pyxnat assessor object
+        :param jobdir: directory of the job
+        :return: list of commands
+        """
+        return ['echo %s' % jobdir]
+
+class Benchmark(object):
+    """ Benchmark of the launcher steps for one project size """
+    def __init__(self, nb_sessions, work_dir, queue_limit=DEFAULT_QUEUE_LIMIT):
+        """
+        Entry point for the Benchmark class
+
+        :param nb_sessions: number of sessions of the synthetic project
+        :param work_dir: directory for the files of the benchmark
+        :param queue_limit: queue limit of the launcher
+        :return: None
+        """
+        self.nb_sessions = nb_sessions
+        self.work_dir = work_dir
+        self.queue_limit = queue_limit
+        self.home = os.path.join(work_dir, 'home')
+        self.results_dir = os.path.join(work_dir, 'results')
+        self.settings_path = os.path.join(work_dir, 'bench_settings.py')
+        self.logfile = os.path.join(work_dir, 'bench.log')
+        self.mock = MockXnat()
+        self.server = None
+
+    def setup(self):
+        """
+        Start the mock server and write the settings of the benchmark
+
+        :return: None
+        """
+        for directory in [self.home, self.results_dir,
+                          os.path.join(self.results_dir, 'FlagFiles'),
+                          os.path.join(self.work_dir, 'jobs'),
+                          os.path.join(self.work_dir, 'cluster')]:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+        LOGGER.info('benchmark: creating %d sessions' % self.nb_sessions)
+        self.mock.populate(self.nb_sessions, [BENCH_PROJECT])
+        self.server = MockXnatServer(self.mock)
+        self.server.start()
+        self.write_settings()
+
+    def write_settings(self):
+        """
+        Write the .dax_settings.ini in the HOME of the benchmark and the
+         project settings file
+
+        :return: None
+        """
+        cluster_dir = os.path.join(self.work_dir, 'cluster')
+        fake_cluster.write_config(cluster_dir, queued_seconds=0,
+                                  run_seconds=0, results_dir=self.results_dir)
+        cluster_options = fake_cluster.write_cluster_templates(cluster_dir)
+        cluster_options.update({'results_dir': self.results_dir,
+                                'root_job_dir': os.path.join(self.work_dir, 'jobs'),
+                                'queue_limit': str(self.queue_limit),
+                                'max_age': '14', 'email_opts': 'a',
+                                'gateway': 'localhost'})
+        config = ConfigParser.RawConfigParser()
+        config.add_section('admin')
+        for option in ['user_home', 'admin_email', 'smtp_host', 'smtp_from',
+                       'smtp_pass', 'xsitype_include']:
+            config.set('admin', option, '')
+        config.set('admin', 'user_home', self.home)
+        config.set('admin', 'xsitype_include', 'proc:genProcData')
+        # Read when importing dax.bin
+        config.add_section('dax_manager')
+        for option in DAX_MANAGER_DEFAULTS:
+            config.set('dax_manager', option, '')
+        config.add_section('cluster')
+        for option, value in sorted(cluster_options.items()):
+            config.set('cluster', option, value)
+        with open(os.path.join(self.home, '.dax_settings.ini'), 'w') as f_obj:
+            config.write(f_obj)
+        with open(self.settings_path, 'w') as f_obj:
+            f_obj.write(SETTINGS_TEMPLATE.format(
+                spider_dir=self.work_dir, project=BENCH_PROJECT,
+                queue_limit=self.queue_limit,
+                root_job_dir=os.path.join(self.work_dir, 'jobs'),
+                user=BENCH_USER, host=self.server.url))
+
+    def run_step(self, step):
+        """
+        Run one step in a new python process
+
+        :param step: 'build', 'update' or 'launch'
+        :return: dictionary with the measures of the step
+        """
+        env = dict(os.environ)
+        env['HOME'] = self.home
+        env['PYTHONPATH'] = os.pathsep.join(
+            [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] +
+            [path for path in [env.get('PYTHONPATH')] if path])
+        code = 'import sys\nfrom dax import bin\n'+STEP_CODE[step]
+        self.mock.reset_stats()
+        start = time.time()
+        with open(os.devnull, 'w') as devnull:
+            proc = subprocess.Popen([sys.executable, '-c', code,
+                                     self.settings_path, self.logfile],
+                                    env=env, stdout=devnull)
+            _, status, rusage = os.wait4(proc.pid, 0)
+        seconds = time.time() - start
+        stats = self.mock.get_stats()
+        return {'sessions': self.nb_sessions,
+                'step': step,
+                'seconds': round(seconds, 2),
+                'requests': stats['total'],
+                # ru_maxrss is in kilobytes on Linux
+                'peak_mb': round(rusage.ru_maxrss/1024.0, 1),
+                'exit_code': os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1,
+                'routes': stats['routes']}
+
+    def run(self, steps=None):
+        """
+        Run the steps
+
+        :param steps: list of steps (default: STEPS)
+        :return: list of dictionaries with the measures of each step
+        """
+        results = list()
+        for step in steps or STEPS:
+            LOGGER.info('benchmark: %d sessions, running %s'
+                        % (self.nb_sessions, step))
+            results.append(self.run_step(step))
+            if results[-1]['exit_code'] != 0:
+                LOGGER.error('benchmark: %s failed, see %s'
+                             % (step, self.logfile))
+        return results
+
+    def teardown(self):
+        """
+        Stop the mock server
+
+        :return: None
+        """
+        if self.server is not None:
+            self.server.stop()
+            self.server = None
+
+def run_benchmarks(sizes=None, steps=None, queue_limit=DEFAULT_QUEUE_LIMIT,
+                   work_dir=None):
+    """
+    Run the benchmark for each size
+
+    :param sizes: list of numbers of sessions (default: DEFAULT_SIZES)
+    :param steps: list of steps (default: STEPS)
+    :param queue_limit: queue limit of the launcher
+    :param work_dir: directory kept for the files of the benchmark.
+     By default, a temporary directory removed at the end.
+    :return: list of dictionaries with the measures of each step
+    """
+    results = list()
+    for size in sizes or DEFAULT_SIZES:
+        size_dir = tempfile.mkdtemp(prefix='dax_bench_%d_' % size, dir=work_dir)
+        bench = Benchmark(size, size_dir, queue_limit)
+        try:
+            bench.setup()
+            results.extend(bench.run(steps))
+        finally:
+            bench.teardown()
+            if work_dir is None:
+                shutil.rmtree(size_dir, ignore_errors=True)
+    return results
+
+def format_results(results):
+    """
+    Table of the results
+
+    :param results: list of dictionaries returned by run_benchmarks
+    :return: string
+    """
+    lines = ['%10s  %-8s %10s %10s %10s %5s' % ('sessions', 'step', 'seconds',
+                                                'requests', 'peak_mb', 'exit')]
+    for result in results:
+        lines.append('%10d  %-8s %10.2f %10d %10.1f %5d'
+                     % (result['sessions'], result['step'], result['seconds'],
+                        result['requests'], result['peak_mb'],
+                        result['exit_code']))
+    return '\n'.join(lines)
+
+def write_json(results, json_path):
+    """
+    Write the results as JSON to compare two runs
+
+    :param results: list of dictionaries returned by run_benchmarks
+    :param json_path: path to the JSON file
+    :return: None
+    """
+    with open(json_path, 'w') as f_obj:
+        json.dump(results, f_obj, indent=2, sort_keys=True)
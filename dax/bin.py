@@ -4,14 +4,14 @@
 
 import os
 import imp
-import redcap
 import logging
 from datetime import datetime
 
 import log
+import daemon
 import XnatUtils
-from dax_settings import DAX_Settings
-DAX_SETTINGS = DAX_Settings()
+from dax_settings import get_settings
+DAX_SETTINGS = get_settings()
 API_URL = DAX_SETTINGS.get_api_url()
 API_KEY_DAX = DAX_SETTINGS.get_api_key_dax()
 REDCAP_VAR = DAX_SETTINGS.get_dax_manager_config()
@@ -32,7 +32,7 @@ def set_logger(logfile, debug):
         logger = log.setup_info_logger('dax', logfile)
     return logger
 
-def launch_jobs(settings_path, logfile, debug, projects=None, sessions=None, writeonly=False, pbsdir=None):
+def launch_jobs(settings_path, logfile, debug, projects=None, sessions=None, writeonly=False, pbsdir=None, nb_workers=None):
     """
     Method to launch jobs on the grid
 
@@ -43,6 +43,7 @@ def launch_jobs(settings_path, logfile, debug, projects=None, sessions=None, wri
     :param sessions: Session(s) that need to be updated
     :param writeonly:  write the job files without submitting them
     :param pbsdir: folder to store the pbs file
+    :param nb_workers: number of projects to launch at the same time
     :return: None
 
     """
@@ -58,10 +59,12 @@ def launch_jobs(settings_path, logfile, debug, projects=None, sessions=None, wri
 
     # Run the updates
     logger.info('running update, Start Time:'+str(datetime.now()))
+    if nb_workers:
+        settings.myLauncher.nb_workers = nb_workers
     settings.myLauncher.launch_jobs(lockfile_prefix, projects, sessions, writeonly, pbsdir)
     logger.info('finished update, End Time: '+str(datetime.now()))
 
-def build(settings_path, logfile, debug, projects=None, sessions=None):
+def build(settings_path, logfile, debug, projects=None, sessions=None, queued=False, nb_workers=None):
     """
     Method that is responsible for running all modules and putting assessors
      into the database
@@ -71,6 +74,9 @@ def build(settings_path, logfile, debug, projects=None, sessions=None):
     :param debug: Should debug mode be used
     :param projects: Project(s) that need to be launched
     :param sessions: Session(s) that need to be updated
+    :param queued: only build the sessions where the inputs of a processor
+     changed
+    :param nb_workers: number of projects to build at the same time
     :return: None
 
     """
@@ -86,10 +92,15 @@ def build(settings_path, logfile, debug, projects=None, sessions=None):
 
     # Run the updates
     logger.info('running update, Start Time:'+str(datetime.now()))
-    settings.myLauncher.build(lockfile_prefix, projects, sessions)
+    if nb_workers:
+        settings.myLauncher.nb_workers = nb_workers
+    if queued:
+        settings.myLauncher.build_queued(lockfile_prefix)
+    else:
+        settings.myLauncher.build(lockfile_prefix, projects, sessions)
     logger.info('finished update, End Time: '+str(datetime.now()))
 
-def update_tasks(settings_path, logfile, debug, projects=None, sessions=None):
+def update_tasks(settings_path, logfile, debug, projects=None, sessions=None, nb_workers=None):
     """
     Method that is responsible for updating a Task.
 
@@ -98,6 +109,7 @@ def update_tasks(settings_path, logfile, debug, projects=None, sessions=None):
     :param debug: Should debug mode be used
     :param projects: Project(s) that need to be launched
     :param sessions: Session(s) that need to be updated
+    :param nb_workers: number of projects to update at the same time
     :return: None
 
     """
@@ -113,9 +125,37 @@ def update_tasks(settings_path, logfile, debug, projects=None, sessions=None):
 
     # Run the update
     logger.info('updating open tasks, Start Time:'+str(datetime.now()))
+    if nb_workers:
+        settings.myLauncher.nb_workers = nb_workers
     settings.myLauncher.update_tasks(lockfile_prefix, projects, sessions)
     logger.info('finished open tasks, End Time: '+str(datetime.now()))
 
+def run_daemon(settings_path, logfile, debug, intervals=None, socket_path=None,
+               projects=None, sessions=None):
+    """
+    Method running build/update/launch/upload continuously from one process
+
+    :param settings_path: Path to the project settings file
+    :param logfile: Full file of the file used to log to
+    :param debug: Should debug mode be used
+    :param intervals: dictionary task name -> seconds between two runs
+    :param socket_path: path for the status socket
+    :param projects: Project(s) that need to be run
+    :param sessions: Session(s) that need to be run
+    :return: None
+
+    """
+    #Logger for logs
+    logger = set_logger(logfile, debug)
+
+    logger.info('Current Process ID: '+str(os.getpid()))
+    logger.info('Current Process Name: dax.bin.run_daemon('+settings_path+')')
+    dax_daemon = daemon.DaxDaemon(settings_path, intervals, socket_path,
+                                  projects, sessions)
+    logger.info('starting daemon, Start Time:'+str(datetime.now()))
+    dax_daemon.run()
+    logger.info('daemon stopped, End Time: '+str(datetime.now()))
+
 def pi_from_project(project):
     """
     Get the last name of PI who owns the project on XNAT
@@ -148,6 +188,8 @@ def upload_update_date_redcap(project_list, type_update, start_end):
     """
     logger = logging.getLogger('dax')
     if API_URL and API_KEY_DAX and REDCAP_VAR:
+        # imported here: only needed when dax_manager is used
+        import redcap
         redcap_project = None
         try:
             redcap_project = redcap.Project(API_URL, API_KEY_DAX)
@@ -9,13 +9,17 @@ Cluster functionality
 __copyright__ = 'Copyright 2013 Vanderbilt University. All Rights Reserved'
 
 import os
+import re
 import time
+import random
+import getpass
 import logging
 import subprocess
+from abc import ABCMeta, abstractmethod
 from datetime import datetime
 from subprocess import CalledProcessError
-from dax_settings import DAX_Settings
-DAX_SETTINGS = DAX_Settings()
+from dax_settings import get_settings
+DAX_SETTINGS = get_settings()
 DEFAULT_EMAIL_OPTS = DAX_SETTINGS.get_email_opts()
 JOB_TEMPLATE = DAX_SETTINGS.get_job_template()
 CMD_SUBMIT = DAX_SETTINGS.get_cmd_submit()
@@ -29,11 +33,102 @@ QUEUE_STATUS = DAX_SETTINGS.get_queue_status()
 COMPLETE_STATUS = DAX_SETTINGS.get_complete_status()
 PREFIX_JOBID = DAX_SETTINGS.get_prefix_jobid()
 SUFFIX_JOBID = DAX_SETTINGS.get_suffix_jobid()
+CLUSTER_TYPE = DAX_SETTINGS.get_cluster_type()
 MAX_TRACE_DAYS = 30
+# Number of job ids given to the scheduler in one command
+MAX_JOBIDS_PER_CALL = 200
+# Seconds during which a bulk status/usage answer is reused
+JOB_CACHE_TIMEOUT = 300
+# Backoff in seconds between two failed counts of the jobs (doubled each time, with jitter)
+COUNT_JOBS_BACKOFF_BASE = 2
+COUNT_JOBS_BACKOFF_MAX = 120
+# Attempts to count the jobs before giving up (ClusterCountJobsException)
+COUNT_JOBS_MAX_ATTEMPTS = 8
 
 #Logger to print logs
 LOGGER = logging.getLogger('dax')
 
+class JobCache(object):
+    """ Cache of the information returned by a bulk query to the scheduler """
+    def __init__(self, timeout=JOB_CACHE_TIMEOUT):
+        """
+        Entry point for the JobCache class
+
+        :param timeout: seconds before an entry is considered outdated
+        :return: None
+        """
+        self.timeout = timeout
+        self.entries = dict()
+
+    def get(self, jobid):
+        """
+        Get the cached value for a job
+
+        :param jobid: job id to check
+        :return: value if cached and not outdated, None otherwise
+        """
+        entry = self.entries.get(jobid)
+        if entry is None or time.time() - entry[0] > self.timeout:
+            return None
+        return entry[1]
+
+    def update(self, values):
+        """
+        Store the values returned by the scheduler
+
+        :param values: dictionary jobid -> value
+        :return: None
+        """
+        now = time.time()
+        for jobid, value in values.items():
+            if value is not None:
+                self.entries[jobid] = (now, value)
+
+    def clear(self):
+        """
+        Remove all the entries
+
+        :return: None
+        """
+        self.entries.clear()
+
+JOB_STATUS_CACHE = JobCache()
+JOB_USAGE_CACHE = JobCache()
+
+def cache_jobs_status(jobids):
+    """
+    Query the scheduler once for the status of all the jobs given and keep
+     the answers for job_status()
+
+    :param jobids: list of job ids
+    :return: dictionary jobid -> status ('R', 'Q', 'C' or None)
+    """
+    jobids = [jobid for jobid in set(jobids) if jobid and jobid != '0']
+    if not jobids:
+        return dict()
+    statuses = get_cluster_backend().jobs_status(jobids)
+    JOB_STATUS_CACHE.update(statuses)
+    return statuses
+
+def cache_jobs_usage(jobs):
+    """
+    Query the scheduler once for the resources used by all the jobs given
+     and keep the answers for tracejob_info()
+
+    :param jobs: list of tuples (jobid, jobstartdate)
+    :return: dictionary jobid -> dictionary from tracejob_info
+    """
+    jobs = [(jobid, jobdate) for jobid, jobdate in jobs
+            if jobid and jobid != '0' and jobdate and
+            is_traceable_date(jobdate)]
+    if not jobs:
+        return dict()
+    diff_days = max([get_diff_days(jobdate) for _, jobdate in jobs])
+    usages = get_cluster_backend().jobs_usage([jobid for jobid, _ in jobs],
+                                              diff_days)
+    JOB_USAGE_CACHE.update(usages)
+    return usages
+
 def c_output(output):
     """
     Check if the output value is an integer
@@ -53,14 +148,33 @@ def count_jobs():
     """
     Count the number of jobs in the queue on the cluster
 
+    :raises: ClusterCountJobsException if the cluster does not answer
+    :return: number of jobs in the queue
+    """
+    return get_cluster_backend().count_jobs()
+
+def template_count_jobs():
+    """
+    Count the number of jobs in the queue on the cluster using the
+     cmd_count_nb_jobs command from the settings
+
+    :raises: ClusterCountJobsException after COUNT_JOBS_MAX_ATTEMPTS failures
     :return: number of jobs in the queue
     """
     cmd = CMD_COUNT_NB_JOBS
     output = subprocess.check_output(cmd, shell=True)
     error = c_output(output)
+    attempt = 0
     while error:
-        LOGGER.info('     try again to access number of jobs in 2 seconds.')
-        time.sleep(2)
+        if attempt+1 >= COUNT_JOBS_MAX_ATTEMPTS:
+            LOGGER.error('     number of jobs not available after %d attempts.'
+                         % COUNT_JOBS_MAX_ATTEMPTS)
+            raise ClusterCountJobsException()
+        # Exponential backoff with jitter so the dax processes do not retry together
+        delay = random.uniform(0, min(COUNT_JOBS_BACKOFF_MAX, COUNT_JOBS_BACKOFF_BASE*(2**attempt)))
+        LOGGER.info('     try again to access number of jobs in %.1f seconds.' % delay)
+        time.sleep(delay)
+        attempt += 1
         output = subprocess.check_output(cmd, shell=True)
         error = c_output(output)
     if int(output) < 0:
@@ -72,6 +186,23 @@ def job_status(jobid):
     """
     Get the status for a job on the cluster
 
+    Use the answer of the last bulk query (see cache_jobs_status) if the
+    job was part of it.
+
+    :param jobid: job id to check
+    :return: job status
+
+    """
+    cached = JOB_STATUS_CACHE.get(jobid)
+    if cached is not None:
+        return cached
+    return get_cluster_backend().jobs_status([jobid]).get(jobid)
+
+def template_job_status(jobid):
+    """
+    Get the status for a job on the cluster using the cmd_get_job_status
+    command from the settings
+
     :param jobid: job id to check
     :return: job status
 
@@ -113,8 +244,21 @@ def tracejob_info(jobid, jobdate):
     :param jobdate: launching date of the job
     :return: dictionary object with 'mem_used', 'walltime_used', 'jobnode'
     """
-    time_s = datetime.strptime(jobdate, "%Y-%m-%d")
-    diff_days = (datetime.today()-time_s).days+1
+    cached = JOB_USAGE_CACHE.get(jobid)
+    if cached is not None:
+        return cached
+    diff_days = get_diff_days(jobdate)
+    return get_cluster_backend().jobs_usage([jobid], diff_days)[jobid]
+
+def template_tracejob_info(jobid, diff_days):
+    """
+    Trace the job information from the cluster using the commands
+    cmd_get_job_memory/walltime/node from the settings
+
+    :param jobid: job id to check
+    :param diff_days: difference of days between starting date and now
+    :return: dictionary object with 'mem_used', 'walltime_used', 'jobnode'
+    """
     jobinfo = dict()
     jobinfo['mem_used'] = get_job_mem_used(jobid, diff_days)
     jobinfo['walltime_used'] = get_job_walltime_used(jobid, diff_days)
@@ -122,6 +266,16 @@ def tracejob_info(jobid, jobdate):
 
     return jobinfo
 
+def get_diff_days(jobdate):
+    """
+    Get the number of days since the job started (used by tracejob)
+
+    :param jobdate: launching date of the job
+    :return: number of days + 1
+    """
+    time_s = datetime.strptime(jobdate, "%Y-%m-%d")
+    return (datetime.today()-time_s).days+1
+
 def get_job_mem_used(jobid, diff_days):
     """
     Get the memory used for the task from cluster
@@ -276,21 +430,502 @@ class PBS:   #The script file generator class
 
         :return: None
         """
-        try:
-            cmd = CMD_SUBMIT +' '+ self.filename
-            proc = subprocess.Popen(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            output, error = proc.communicate()
-            if output:
-                LOGGER.info('    '+output)
-            if error:
+        return get_cluster_backend().submit(self.filename)
+
+def run_cmd(cmd):
+    """
+    Run a scheduler command without going through a shell
+
+    :param cmd: list of arguments
+    :return: tuple (return code, stdout, stderr)
+    """
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        output, error = proc.communicate()
+    except OSError as err:
+        LOGGER.error('failed to run %s: %s' % (cmd[0], err))
+        return -1, '', str(err)
+    return proc.returncode, output, error
+
+def chunks(jobids, size=MAX_JOBIDS_PER_CALL):
+    """
+    Split a list of job ids in lists small enough for one command line
+
+    :param jobids: list of job ids
+    :param size: maximum number of job ids per list
+    :return: generator of lists
+    """
+    jobids = list(jobids)
+    for index in range(0, len(jobids), size):
+        yield jobids[index:index+size]
+
+def get_memory_in_kb(mem_str):
+    """
+    Convert a memory string from the scheduler (e.g: 1024K, 2.5G, 100kb)
+     into kilobytes
+
+    :param mem_str: memory string
+    :return: string of the memory in kb, empty string if not parsable
+    """
+    match = re.match(r'^\s*([0-9.]+)\s*([kKmMgGtT]?)[bB]?\s*$', mem_str)
+    if not match:
+        return ''
+    factor = {'': 1, 'k': 1, 'm': 1024, 'g': 1024**2, 't': 1024**3}
+    value = float(match.group(1)) * factor[match.group(2).lower()]
+    return str(int(value))
+
+def get_cluster_backend():
+    """
+    Get the scheduler backend set by the option cluster_type in the settings
+
+    :return: ClusterBackend object
+    """
+    global CLUSTER_BACKEND
+    if CLUSTER_BACKEND is None:
+        backend_class = BACKENDS.get((CLUSTER_TYPE or '').upper(),
+                                     TemplateBackend)
+        CLUSTER_BACKEND = backend_class()
+    return CLUSTER_BACKEND
+
+class ClusterBackend(object):
+    """
+    Base class for the scheduler backends.
+
+    The status and usage methods take a list of job ids so one command to
+    the scheduler answers for every job dax is following.
+    """
+    __metaclass__ = ABCMeta
+    cmd_submit = None
+    cmd_cancel = None
+    array_index_var = None
+    array_first_index = 0
+
+    def __init__(self):
+        """
+        Entry point for the ClusterBackend class
+
+        :return: None
+        """
+        self.user = getpass.getuser()
+
+    def submit(self, filename, options=None):
+        """
+        Submit a job file to the cluster
+
+        :param filename: path to the job file
+        :param options: list of extra arguments for the submit command
+        :return: job id, '0' if the submission failed
+        """
+        cmd = (self.cmd_submit or CMD_SUBMIT).split()
+        cmd.extend(options or [])
+        cmd.append(filename)
+        _, output, error = run_cmd(cmd)
+        if output:
+            LOGGER.info('    '+output)
+        if error:
+            LOGGER.error(error)
+        jobid = self.parse_jobid(output)
+        return jobid.strip() if jobid else '0'
+
+    def parse_jobid(self, output):
+        """
+        Extract the job id from the submit command output
+
+        :param output: output of the submit command
+        :return: job id
+        """
+        return get_specific_str(output, PREFIX_JOBID, SUFFIX_JOBID)
+
+    def submit_array(self, filenames, array_file):
+        """
+        Submit several job files as one job array.
+
+        The resources requested by the first job file are used for every
+        element of the array.
+
+        :param filenames: list of paths to the job files
+        :param array_file: path to the array job file to write
+        :return: list of job ids in the same order than filenames
+        """
+        if not self.array_index_var:
+            return [self.submit(filename) for filename in filenames]
+        self.write_array_file(filenames, array_file)
+        first = self.array_first_index
+        last = first + len(filenames) - 1
+        jobid = self.submit(array_file, self.array_options(first, last))
+        if jobid == '0':
+            return ['0'] * len(filenames)
+        return [self.array_jobid(jobid, first+index)
+                for index in range(len(filenames))]
+
+    def write_array_file(self, filenames, array_file):
+        """
+        Write the array job file running one of the job files per element
+
+        :param filenames: list of paths to the job files
+        :param array_file: path to the array job file to write
+        :return: None
+        """
+        with open(filenames[0], 'r') as f_obj:
+            header = [line for line in f_obj.read().splitlines()
+                      if line.startswith('#!') or
+                      line.startswith(self.directive_prefix())]
+        lines = header + ['', 'JOB_FILES=(']
+        lines.extend(filenames)
+        lines.append(')')
+        lines.append('bash "${JOB_FILES[$((%s-%d))]}"'
+                     % (self.array_index_var, self.array_first_index))
+        with open(array_file, 'w') as f_obj:
+            f_obj.write('\n'.join(lines)+'\n')
+
+    def directive_prefix(self):
+        """
+        Prefix of the lines setting the job resources in a job file
+
+        :return: string
+        """
+        return '#PBS'
+
+    def array_options(self, first, last):
+        """
+        Arguments for the submit command to submit a job array
+
+        :param first: first index of the array
+        :param last: last index of the array
+        :return: list of arguments
+        """
+        return ['-t', '%d-%d' % (first, last)]
+
+    def array_jobid(self, jobid, index):
+        """
+        Job id of one element of a job array
+
+        :param jobid: job id of the array
+        :param index: index of the element
+        :return: job id
+        """
+        return '%s[%d]' % (jobid, index)
+
+    def cancel(self, jobids):
+        """
+        Cancel jobs on the cluster
+
+        :param jobids: list of job ids
+        :return: True if the scheduler accepted the command, False otherwise
+        """
+        if not self.cmd_cancel:
+            LOGGER.warn('cancel not supported for cluster_type %s'
+                        % CLUSTER_TYPE)
+            return False
+        success = True
+        for jobids_chunk in chunks(jobids):
+            code, _, error = run_cmd([self.cmd_cancel] + jobids_chunk)
+            if code != 0:
                 LOGGER.error(error)
-            #output = subprocess.check_output(cmd, stderr=subprocess.STDOUT, shell=True)
-            jobid = get_specific_str(output, PREFIX_JOBID, SUFFIX_JOBID)
-        except CalledProcessError as err:
-            LOGGER.error(err)
-            jobid = '0'
+                success = False
+        return success
+
+    @abstractmethod
+    def count_jobs(self):
+        """
+        Count the number of jobs in the queue on the cluster
+
+        :raises: ClusterCountJobsException if the cluster does not answer
+        :return: number of jobs in the queue
+        """
+        raise NotImplementedError()
 
-        return jobid.strip()
+    @abstractmethod
+    def jobs_status(self, jobids):
+        """
+        Get the status of several jobs on the cluster
+
+        :param jobids: list of job ids
+        :return: dictionary jobid -> 'R', 'Q', 'C' or None if unknown
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def jobs_usage(self, jobids, diff_days):
+        """
+        Get the resources used by several jobs on the cluster
+
+        :param jobids: list of job ids
+        :param diff_days: number of days to look back for the jobs
+        :return: dictionary jobid -> dictionary with 'mem_used',
+         'walltime_used', 'jobnode'
+        """
+        raise NotImplementedError()
+
+    @staticmethod
+    def empty_usage(diff_days):
+        """
+        Usage returned for a job unknown to the scheduler
+
+        :param diff_days: number of days since the job started
+        :return: dictionary with 'mem_used', 'walltime_used', 'jobnode'
+        """
+        walltime = 'NotFound' if diff_days > 3 else ''
+        return {'mem_used': '', 'walltime_used': walltime, 'jobnode': ''}
+
+class TemplateBackend(ClusterBackend):
+    """ Backend using the commands set in the cluster section (one call
+    to the scheduler per job) """
+    def count_jobs(self):
+        return template_count_jobs()
+
+    def jobs_status(self, jobids):
+        return dict((jobid, template_job_status(jobid)) for jobid in jobids)
+
+    def jobs_usage(self, jobids, diff_days):
+        return dict((jobid, template_tracejob_info(jobid, diff_days))
+                    for jobid in jobids)
+
+    @property
+    def cmd_cancel(self):
+        """ Guess the cancel command from cmd_submit """
+        submit = CMD_SUBMIT.split()[0] if CMD_SUBMIT else ''
+        return {'qsub': 'qdel', 'sbatch': 'scancel'}.get(submit)
+
+class PBSBackend(ClusterBackend):
+    """ Backend for PBS/Torque (and MOAB on top of Torque) """
+    cmd_submit = 'qsub'
+    cmd_cancel = 'qdel'
+    array_index_var = 'PBS_ARRAYID'
+    running_states = ['R', 'E']
+    queued_states = ['Q', 'H', 'W', 'T', 'S']
+
+    def parse_jobid(self, output):
+        return output.strip().split('.')[0]
+
+    def count_jobs(self):
+        code, output, error = run_cmd(['qstat', '-u', self.user])
+        if code != 0:
+            LOGGER.error(error)
+            raise ClusterCountJobsException()
+        states = [line.split()[-2] for line in output.splitlines()
+                  if line[:1].isdigit() and len(line.split()) > 2]
+        return len([state for state in states if state != 'C'])
+
+    def jobs_status(self, jobids):
+        statuses = dict()
+        for jobids_chunk in chunks(jobids):
+            code, output, error = run_cmd(['qstat', '-t'] + jobids_chunk)
+            found = dict()
+            for line in output.splitlines():
+                fields = line.split()
+                if len(fields) > 2 and line[:1].isdigit():
+                    found[fields[0].split('.')[0]] = fields[-2]
+            failed = code != 0 and not found and 'Unknown Job' not in error
+            for jobid in jobids_chunk:
+                if failed:
+                    statuses[jobid] = None
+                elif jobid not in found or found[jobid] == 'C':
+                    statuses[jobid] = 'C'
+                elif found[jobid] in self.running_states:
+                    statuses[jobid] = 'R'
+                elif found[jobid] in self.queued_states:
+                    statuses[jobid] = 'Q'
+                else:
+                    statuses[jobid] = None
+        return statuses
+
+    def jobs_usage(self, jobids, diff_days):
+        usages = dict()
+        for jobids_chunk in chunks(jobids):
+            _, output, _ = run_cmd(['qstat', '-f', '-t'] + jobids_chunk)
+            for block in output.split('Job Id:')[1:]:
+                lines = block.splitlines()
+                jobid = lines[0].strip().split('.')[0]
+                info = dict()
+                for line in lines[1:]:
+                    if '=' in line:
+                        key, value = line.split('=', 1)
+                        info[key.strip()] = value.strip()
+                usages[jobid] = {
+                    'mem_used': get_memory_in_kb(
+                        info.get('resources_used.mem', '')),
+                    'walltime_used': info.get('resources_used.walltime', ''),
+                    'jobnode': info.get('exec_host', '').split('/')[0]}
+        # Jobs purged from qstat: fall back on tracejob from the settings
+        for jobid in jobids:
+            if jobid not in usages or not usages[jobid]['walltime_used']:
+                usages[jobid] = template_tracejob_info(jobid, diff_days)
+        return usages
+
+class SLURMBackend(ClusterBackend):
+    """ Backend for SLURM """
+    cmd_submit = 'sbatch'
+    cmd_cancel = 'scancel'
+    array_index_var = 'SLURM_ARRAY_TASK_ID'
+    running_states = ['R', 'CG', 'CF']
+    queued_states = ['PD', 'S', 'RQ', 'RS', 'RH', 'SE']
+
+    def parse_jobid(self, output):
+        return get_specific_str(output, 'Submitted batch job ', '\n')
+
+    def directive_prefix(self):
+        return '#SBATCH'
+
+    def array_options(self, first, last):
+        return ['--array=%d-%d' % (first, last)]
+
+    def array_jobid(self, jobid, index):
+        return '%s_%d' % (jobid, index)
+
+    def count_jobs(self):
+        code, output, error = run_cmd(['squeue', '-h', '-u', self.user,
+                                       '-o', '%i'])
+        if code != 0:
+            LOGGER.error(error)
+            raise ClusterCountJobsException()
+        return len([line for line in output.splitlines() if line.strip()])
+
+    def jobs_status(self, jobids):
+        statuses = dict()
+        for jobids_chunk in chunks(jobids):
+            code, output, error = run_cmd(['squeue', '-h', '-o', '%i %t',
+                                           '-j', ','.join(jobids_chunk)])
+            found = dict(line.split()[:2] for line in output.splitlines()
+                         if len(line.split()) >= 2)
+            failed = code != 0 and 'Invalid job id' not in error
+            for jobid in jobids_chunk:
+                if failed:
+                    statuses[jobid] = None
+                elif jobid not in found:
+                    statuses[jobid] = 'C'
+                elif found[jobid] in self.running_states:
+                    statuses[jobid] = 'R'
+                elif found[jobid] in self.queued_states:
+                    statuses[jobid] = 'Q'
+                else:
+                    statuses[jobid] = 'C'
+        return statuses
+
+    def jobs_usage(self, jobids, diff_days):
+        usages = dict()
+        for jobids_chunk in chunks(jobids):
+            _, output, _ = run_cmd(['sacct', '-n', '-P', '-j',
+                                    ','.join(jobids_chunk), '--format',
+                                    'JobID,MaxRSS,Elapsed,NodeList'])
+            for line in output.splitlines():
+                fields = line.split('|')
+                if len(fields) < 4 or not fields[0].endswith('.batch'):
+                    continue
+                usages[fields[0][:-len('.batch')]] = {
+                    'mem_used': get_memory_in_kb(fields[1]),
+                    'walltime_used': fields[2].strip(),
+                    'jobnode': fields[3].strip()}
+        for jobid in jobids:
+            if jobid not in usages:
+                usages[jobid] = self.empty_usage(diff_days)
+        return usages
+
+class SGEBackend(ClusterBackend):
+    """ Backend for Sun/Open Grid Engine """
+    cmd_submit = 'qsub'
+    cmd_cancel = 'qdel'
+    array_index_var = 'SGE_TASK_ID'
+    array_first_index = 1
+
+    def parse_jobid(self, output):
+        match = re.search(r'Your job(?:-array)? (\d+)', output)
+        return match.group(1) if match else ''
+
+    def directive_prefix(self):
+        return '#$'
+
+    def array_jobid(self, jobid, index):
+        return '%s.%d' % (jobid, index)
+
+    def get_user_jobs(self):
+        """
+        Get the state of all the jobs of the user from qstat
+
+        :return: dictionary jobid -> state, None if qstat failed
+        """
+        code, output, error = run_cmd(['qstat', '-u', self.user])
+        if code != 0:
+            LOGGER.error(error)
+            return None
+        jobs = dict()
+        for line in output.splitlines()[2:]:
+            fields = line.split()
+            if len(fields) < 5:
+                continue
+            jobs[fields[0]] = fields[4]
+            # array tasks: last column is the task id (or range)
+            if fields[-1].isdigit() and len(fields) > 8:
+                jobs['%s.%s' % (fields[0], fields[-1])] = fields[4]
+        return jobs
+
+    def count_jobs(self):
+        jobs = self.get_user_jobs()
+        if jobs is None:
+            raise ClusterCountJobsException()
+        return len([jobid for jobid in jobs if '.' not in jobid])
+
+    def jobs_status(self, jobids):
+        jobs = self.get_user_jobs()
+        statuses = dict()
+        for jobid in jobids:
+            state = jobs.get(jobid) if jobs is not None else None
+            if jobs is None or (state and 'E' in state):
+                statuses[jobid] = None
+            elif state is None or state.startswith('d'):
+                statuses[jobid] = 'C'
+            elif 'r' in state or 't' in state:
+                statuses[jobid] = 'R'
+            else:
+                statuses[jobid] = 'Q'
+        return statuses
+
+    def jobs_usage(self, jobids, diff_days):
+        # qacct only accepts one job at a time
+        usages = dict()
+        for jobid in jobids:
+            _, output, _ = run_cmd(['qacct', '-j', jobid.split('.')[0]])
+            info = dict()
+            for line in output.splitlines():
+                fields = line.split(None, 1)
+                if len(fields) == 2:
+                    info[fields[0]] = fields[1].strip()
+            if not info:
+                usages[jobid] = self.empty_usage(diff_days)
+                continue
+            walltime = info.get('ru_wallclock', '').rstrip('s')
+            try:
+                seconds = int(float(walltime))
+                walltime = '%02d:%02d:%02d' % (seconds//3600,
+                                               seconds%3600//60, seconds%60)
+            except ValueError:
+                pass
+            usages[jobid] = {'mem_used': get_memory_in_kb(
+                                 info.get('maxvmem', '')),
+                             'walltime_used': walltime,
+                             'jobnode': info.get('hostname', '')}
+        return usages
+
+    def cancel(self, jobids):
+        success = True
+        for jobid in jobids:
+            cmd = [self.cmd_cancel, jobid]
+            if '.' in jobid:
+                cmd = [self.cmd_cancel, jobid.split('.')[0], '-t',
+                       jobid.split('.')[1]]
+            code, _, error = run_cmd(cmd)
+            if code != 0:
+                LOGGER.error(error)
+                success = False
+        return success
+
+BACKENDS = {'PBS': PBSBackend,
+            'TORQUE': PBSBackend,
+            'MOAB': PBSBackend,
+            'SLURM': SLURMBackend,
+            'SGE': SGEBackend}
+CLUSTER_BACKEND = None
 
 class ClusterLaunchException(Exception):
     """Custom exception raised when launch on the grid failed"""
@@ -0,0 +1,407 @@
+""" daemon.py
+
+Long-running process hosting a Launcher: build/update/launch/upload run as
+periodic tasks with their own interval and their own warm XNAT connection.
+A local unix socket gives the state of the daemon.
+"""
+
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__copyright__ = 'Copyright 2013 Vanderbilt University. All Rights Reserved'
+
+import os
+import imp
+import json
+import time
+import errno
+import select
+import signal
+import socket
+import logging
+import threading
+import subprocess
+from datetime import datetime
+
+from dax_settings import get_settings
+DAX_SETTINGS = get_settings()
+RESULTS_DIR = DAX_SETTINGS.get_results_dir()
+
+# Intervals in seconds by default for each periodic task
+DEFAULT_INTERVALS = {'build': 600, 'rebuild': 60, 'update': 120,
+                     'launch': 60, 'upload': 60}
+SOCKET_SUFFIX = 'dax_daemon.sock'
+SOCKET_TIMEOUT = 5
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+# Seconds waited for a running task when stopping (the threads are daemonic,
+#  a task stuck on XNAT is abandoned after that)
+STOP_TIMEOUT = 120
+
+#Logger to print logs
+LOGGER = logging.getLogger('dax')
+
+class PeriodicTask(object):
+    """ Task running a function every interval seconds in its own thread """
+    def __init__(self, name, interval, function, connect=None):
+        """
+        Entry point for the PeriodicTask class
+
+        :param name: name of the task
+        :param interval: seconds between the start of two runs
+        :param function: function to run. Called with the XNAT interface
+         if connect is set, without arguments otherwise.
+        :param connect: function returning a new XNAT interface for the task
+        :return: None
+        """
+        self.name = name
+        self.interval = interval
+        self.function = function
+        self.connect = connect
+        self.xnat = None
+        self.thread = None
+        self.next_run = time.time()
+        self.last_start = None
+        self.last_end = None
+        self.last_error = None
+        self.nb_runs = 0
+
+    def is_running(self):
+        """
+        Check if the task is currently running
+
+        :return: True if running, False otherwise
+        """
+        return self.thread is not None and self.thread.is_alive()
+
+    def is_due(self, now):
+        """
+        Check if the task needs to start
+
+        :param now: current time in seconds
+        :return: True if the task needs to start, False otherwise
+        """
+        return not self.is_running() and now >= self.next_run
+
+    def start(self):
+        """
+        Start a run of the task in a new thread
+
+        :return: None
+        """
+        self.last_start = time.time()
+        self.next_run = self.last_start + self.interval
+        self.thread = threading.Thread(target=self.run, name=self.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        """
+        Run the function once, keeping the XNAT connection for the next run
+
+        :return: None
+        """
+        LOGGER.info('daemon: starting %s' % self.name)
+        try:
+            if self.connect is None:
+                self.function()
+            else:
+                if self.xnat is None:
+                    self.xnat = self.connect()
+                self.function(self.xnat)
+            self.last_error = None
+        except SystemExit:
+            # init_script exits when the flag file is already there
+            self.last_error = 'exited (already running?)'
+        except Exception as err:
+            LOGGER.exception('daemon: %s failed' % self.name)
+            self.last_error = str(err)
+            # Start from a new connection on the next run
+            self.disconnect()
+        self.nb_runs += 1
+        self.last_end = time.time()
+        LOGGER.info('daemon: %s done in %.1fs' % (self.name,
+                                                 self.last_end-self.last_start))
+
+    def disconnect(self):
+        """
+        Close the XNAT connection of the task
+
+        :return: None
+        """
+        if self.xnat is not None:
+            try:
+                self.xnat.disconnect()
+            except Exception:
+                pass
+            self.xnat = None
+
+    def status(self):
+        """
+        Get the state of the task
+
+        :return: dictionary
+        """
+        return {'interval': self.interval,
+                'running': self.is_running(),
+                'runs': self.nb_runs,
+                'last_start': format_time(self.last_start),
+                'last_end': format_time(self.last_end),
+                'next_run': format_time(self.next_run),
+                'last_error': self.last_error}
+
+class DaxDaemon(object):
+    """ Daemon running the Launcher of a settings file continuously """
+    def __init__(self, settings_path, intervals=None, socket_path=None,
+                 projects=None, sessions=None):
+        """
+        Entry point for the DaxDaemon class
+
+        :param settings_path: Path to the project settings file
+        :param intervals: dictionary task name -> seconds between two runs.
+         A task with an interval of 0 is disabled.
+        :param socket_path: path for the status socket
+        :param projects: Project to run locally
+        :param sessions: Session(s) to run locally
+        :return: None
+        """
+        LOGGER.info('loading settings from:'+settings_path)
+        self.settings = imp.load_source('settings', settings_path)
+        self.launcher = self.settings.myLauncher
+        self.lockfile_prefix = os.path.splitext(
+            os.path.basename(settings_path))[0]
+        self.projects = projects
+        self.sessions = sessions
+        if not socket_path:
+            socket_path = get_socket_path(settings_path)
+        self.socket_path = socket_path
+        self.server = None
+        self.stopped = False
+        self.started = time.time()
+        self.upload_proc = None
+
+        _intervals = dict(DEFAULT_INTERVALS)
+        _intervals.update(intervals or dict())
+        self.tasks = dict()
+        runs = [('build', self.build, True),
+                ('rebuild', self.rebuild, True),
+                ('update', self.update, True),
+                ('launch', self.launch, True),
+                ('upload', self.upload, False)]
+        for name, function, use_xnat in runs:
+            if _intervals[name] > 0:
+                connect = self.launcher.connect_xnat if use_xnat else None
+                self.tasks[name] = PeriodicTask(name, _intervals[name],
+                                                function, connect)
+
+    def build(self, xnat):
+        """ Run dax_build with the warm connection """
+        self.launcher.build(self.lockfile_prefix, self.projects,
+                            self.sessions, xnat=xnat)
+
+    def rebuild(self, xnat):
+        """ Build the sessions where the inputs of a processor changed """
+        self.launcher.build_queued(self.lockfile_prefix, xnat=xnat)
+
+    def update(self, xnat):
+        """ Run dax_update_tasks with the warm connection """
+        self.launcher.update_tasks(self.lockfile_prefix, self.projects,
+                                   self.sessions, xnat=xnat)
+
+    def launch(self, xnat):
+        """ Run dax_launch with the warm connection """
+        self.launcher.launch_jobs(self.lockfile_prefix, self.projects,
+                                  self.sessions, xnat=xnat)
+
+    def upload(self):
+        """ Run dax_upload with the credentials of the launcher """
+        env = dict(os.environ)
+        env['XNAT_HOST'] = self.launcher.xnat_host
+        env['XNAT_USER'] = self.launcher.xnat_user
+        env['XNAT_PASS'] = self.launcher.xnat_pass
+        cmd = ['dax_upload', '--nodebug']
+        if self.projects:
+            cmd.extend(['-p', self.projects])
+        self.upload_proc = subprocess.Popen(cmd, env=env)
+        code = self.upload_proc.wait()
+        if code != 0:
+            raise Exception('dax_upload exited with code %d' % code)
+
+    def run(self):
+        """
+        Main loop: start the tasks when due and answer the status socket
+
+        :return: None
+        """
+        self.open_socket()
+        try:
+            signal.signal(signal.SIGTERM, self.handle_signal)
+            signal.signal(signal.SIGINT, self.handle_signal)
+            LOGGER.info('daemon: running, status socket %s' % self.socket_path)
+            while not self.stopped:
+                now = time.time()
+                for name in sorted(self.tasks):
+                    if self.tasks[name].is_due(now):
+                        self.tasks[name].start()
+                next_run = min([task.next_run for task in self.tasks.values()
+                                if not task.is_running()] or [now+1])
+                timeout = min(max(next_run-time.time(), 0), 1)
+                try:
+                    readable, _, _ = select.select([self.server], [], [],
+                                                   timeout)
+                except select.error as err:
+                    if err.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if readable:
+                    self.handle_client()
+        finally:
+            self.close()
+
+    def handle_signal(self, signum, _):
+        """ Stop the main loop on SIGTERM/SIGINT """
+        LOGGER.info('daemon: received signal %d, stopping' % signum)
+        self.stopped = True
+
+    def open_socket(self):
+        """
+        Create the unix socket answering the status requests
+
+        :return: None
+        """
+        if os.path.exists(self.socket_path):
+            if is_daemon_running(self.socket_path):
+                raise DaemonRunningException(self.socket_path)
+            os.remove(self.socket_path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        self.server.listen(5)
+
+    def handle_client(self):
+        """
+        Answer one request on the status socket.
+
+        Requests: 'status', 'run <task>' or 'stop'.
+
+        :return: None
+        """
+        conn, _ = self.server.accept()
+        try:
+            conn.settimeout(SOCKET_TIMEOUT)
+            request = conn.recv(1024).strip().split()
+            if not request or request[0] == 'status':
+                answer = self.status()
+            elif request[0] == 'run' and len(request) > 1 and \
+                 request[1] in self.tasks:
+                self.tasks[request[1]].next_run = time.time()
+                answer = {'scheduled': request[1]}
+            elif request[0] == 'stop':
+                self.stopped = True
+                answer = {'stopping': True}
+            else:
+                answer = {'error': 'unknown request %s' % ' '.join(request)}
+            conn.sendall(json.dumps(answer, indent=2, sort_keys=True)+'\n')
+        except socket.error as err:
+            LOGGER.warn('daemon: status socket error: %s' % err)
+        finally:
+            conn.close()
+
+    def status(self):
+        """
+        Get the state of the daemon
+
+        :return: dictionary
+        """
+        return {'pid': os.getpid(),
+                'started': format_time(self.started),
+                'xnat_host': self.launcher.xnat_host,
+                'tasks': dict((name, task.status())
+                              for name, task in self.tasks.items())}
+
+    def close(self):
+        """
+        Close the socket and the XNAT connections
+
+        :return: None
+        """
+        if self.server is not None:
+            self.server.close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+        if self.upload_proc is not None and self.upload_proc.poll() is None:
+            self.upload_proc.terminate()
+        deadline = time.time() + STOP_TIMEOUT
+        for task in self.tasks.values():
+            if task.is_running():
+                LOGGER.info('daemon: waiting for %s to finish' % task.name)
+                task.thread.join(max(deadline-time.time(), 0))
+                if task.is_running():
+                    LOGGER.warn('daemon: %s still running after %ds, abandoned'
+                                % (task.name, STOP_TIMEOUT))
+                    continue
+            task.disconnect()
+        LOGGER.info('daemon: stopped')
+
+def format_time(seconds):
+    """
+    Format a time in seconds for the status
+
+    :param seconds: time in seconds since the epoch or None
+    :return: string of the date, None if seconds is None
+    """
+    if seconds is None:
+        return None
+    return datetime.fromtimestamp(seconds).strftime(DATE_FORMAT)
+
+def get_socket_path(settings_path):
+    """
+    Default path for the status socket of a settings file
+
+    :param settings_path: Path to the project settings file
+    :return: path in RESULTS_DIR/FlagFiles
+    """
+    prefix = os.path.splitext(os.path.basename(settings_path))[0]
+    return os.path.join(RESULTS_DIR, 'FlagFiles',
+                        prefix+'_'+SOCKET_SUFFIX)
+
+def send_request(socket_path, request='status'):
+    """
+    Send a request to a running daemon
+
+    :param socket_path: path to the status socket
+    :param request: 'status', 'run <task>' or 'stop'
+    :return: answer from the daemon (JSON string)
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(SOCKET_TIMEOUT)
+    try:
+        client.connect(socket_path)
+        client.sendall(request+'\n')
+        chunks = list()
+        while True:
+            data = client.recv(4096)
+            if not data:
+                break
+            chunks.append(data)
+        return ''.join(chunks)
+    finally:
+        client.close()
+
+def is_daemon_running(socket_path):
+    """
+    Check if a daemon answers on the socket
+
+    :param socket_path: path to the status socket
+    :return: True if a daemon answered, False otherwise
+    """
+    try:
+        send_request(socket_path)
+        return True
+    except socket.error:
+        return False
+
+class DaemonRunningException(Exception):
+    """Custom exception raised when a daemon already uses the socket"""
+    def __init__(self, socket_path):
+        Exception.__init__(self, 'ERROR: a dax daemon is already running '
+                                 'on %s.' % socket_path)
@@ -38,11 +38,33 @@ DAX_MANAGER_DEFAULTS = OrderedDict([
     ('max_age', 'dax_max_age'),
     ('admin_email', 'dax_email_address')])
 
+# Settings shared by all the modules of the process (see get_settings)
+SETTINGS_CACHE = dict()
+
+
+def get_settings(ini_settings_file=None):
+    """Process-wide DAX_Settings object for a settings file.
+
+    The modules of dax share the same object so that the INI file is only
+    read once per process, the first time an option is needed.
+
+    :param ini_settings_file: path to the INI file (default: ~/.dax_settings.ini)
+    :return: DAX_Settings object
+    """
+    if ini_settings_file is None:
+        ini_settings_file = os.path.join(os.path.expanduser('~'),
+                                         '.dax_settings.ini')
+    if ini_settings_file not in SETTINGS_CACHE:
+        SETTINGS_CACHE[ini_settings_file] = DAX_Settings(ini_settings_file)
+    return SETTINGS_CACHE[ini_settings_file]
+
 
 class DAX_Settings(object):
     """Class for DAX settings based on INI file.
 
     Note that dax_settings should be in the home directory.
+    The file is read the first time the config_parser is used. Use
+    get_settings() to share the object instead of creating a new one.
     """
 
     def __init__(self, ini_settings_file=os.path.join(os.path.expanduser('~'),
@@ -50,12 +72,22 @@ class DAX_Settings(object):
         """Entry Point for Class Dax_settings."""
         # Variables
         self.ini_settings_file = ini_settings_file
-        self.config_parser = ConfigParser.SafeConfigParser(allow_no_value=True)
+        self._config_parser = None
 
-        if self.exists():
-            self.__read__()
-        else:
-            sys.stdout.write('Warning: No settings.ini file found.')
+    @property
+    def config_parser(self):
+        """ConfigParser of the INI file, read on first access.
+
+        :return: ConfigParser.SafeConfigParser object
+        """
+        if self._config_parser is None:
+            self._config_parser = ConfigParser.SafeConfigParser(
+                allow_no_value=True)
+            if self.exists():
+                self.__read__()
+            else:
+                sys.stdout.write('Warning: No settings.ini file found.')
+        return self._config_parser
 
     def exists(self):
         """Check if ini file exists.
@@ -71,7 +103,7 @@ class DAX_Settings(object):
         :return: None. config_parser is read in place
         """
         try:
-            self.config_parser.read(self.ini_settings_file)
+            self._config_parser.read(self.ini_settings_file)
         except ConfigParser.MissingSectionHeaderError as MSHE:
             self._print_error_as_warning('Missing header bracket detected. '
                                          'Please check your file.\n', MSHE)
@@ -304,6 +336,18 @@ class DAX_Settings(object):
         """
         return self.get('cluster', 'cmd_submit')
 
+    def get_cluster_type(self):
+        """Get the cluster_type value from the cluster section.
+
+        One of PBS, SLURM or SGE to use the scheduler backend querying all
+        the jobs at once. Optional: the cmd_* templates are used if empty.
+
+        :return: String of the cluster_type value, None if empty
+        """
+        if not self.config_parser.has_option('cluster', 'cluster_type'):
+            return None
+        return self.get('cluster', 'cluster_type')
+
     def get_prefix_jobid(self):
         """Get the prefix_jobid value from the cluster section.
 
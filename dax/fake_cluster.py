@@ -0,0 +1,240 @@
+""" fake_cluster.py
+
+Fake scheduler answering the cmd_* templates of the cluster section of
+dax_settings.ini. Jobs are not run: they stay queued then running for a
+given number of seconds and end by writing the READY_TO_UPLOAD flag of the
+assessor like a successful spider would.
+
+Usage (no dax import, the file can be called directly by the templates):
+    python fake_cluster.py --dir STATE_DIR submit JOB_FILE
+    python fake_cluster.py --dir STATE_DIR count
+    python fake_cluster.py --dir STATE_DIR status|memory|walltime|node JOBID
+"""
+
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__copyright__ = 'Copyright 2013 Vanderbilt University. All Rights Reserved'
+
+import os
+import sys
+import time
+import fcntl
+from argparse import ArgumentParser
+
+JOBS_FILE = 'jobs.txt'
+CONFIG_FILE = 'config.txt'
+JOB_EXTENSION = '.pbs'
+# Same strings as the PBS statuses set in the settings written below
+QUEUE_STATUS = 'Q'
+RUNNING_STATUS = 'R'
+COMPLETE_STATUS = 'C'
+SUBMIT_PREFIX = 'Submitted job'
+SUBMIT_SUFFIX = '.'
+READY_FLAG = 'READY_TO_UPLOAD.txt'
+
+JOB_TEMPLATE = """#!/bin/bash
+#FAKE -l nodes=1:ppn=${job_ppn}
+#FAKE -l walltime=${job_walltime}
+#FAKE -l mem=${job_memory}mb
+#FAKE -o ${job_output_file}
+export XNAT_HOST=${xnat_host}
+${job_cmds}
+"""
+
+class FakeCluster(object):
+    """ Jobs of the fake scheduler stored in a directory """
+    def __init__(self, state_dir):
+        """
+        Entry point for the FakeCluster class
+
+        :param state_dir: directory holding the jobs and the configuration
+        :return: None
+        """
+        self.state_dir = state_dir
+        self.jobs_file = os.path.join(state_dir, JOBS_FILE)
+        self.config = read_config(os.path.join(state_dir, CONFIG_FILE))
+
+    def submit(self, job_file):
+        """
+        Add a job to the queue
+
+        :param job_file: path to the job file
+        :return: job id
+        """
+        label = os.path.splitext(os.path.basename(job_file))[0]
+        with open(self.jobs_file, 'a+') as f_obj:
+            fcntl.flock(f_obj, fcntl.LOCK_EX)
+            try:
+                f_obj.seek(0)
+                jobid = sum(1 for _ in f_obj) + 1
+                f_obj.write('%d %f %s\n' % (jobid, time.time(), label))
+            finally:
+                fcntl.flock(f_obj, fcntl.LOCK_UN)
+        return str(jobid)
+
+    def jobs(self):
+        """
+        Read the jobs submitted
+
+        :return: dictionary jobid -> (submit time, label)
+        """
+        jobs = dict()
+        if not os.path.isfile(self.jobs_file):
+            return jobs
+        with open(self.jobs_file, 'r') as f_obj:
+            for line in f_obj:
+                fields = line.split()
+                if len(fields) == 3:
+                    jobs[fields[0]] = (float(fields[1]), fields[2])
+        return jobs
+
+    def get_status(self, submitted, now):
+        """
+        Status of a job from the time since its submission
+
+        :param submitted: submission time in seconds
+        :param now: current time in seconds
+        :return: QUEUE_STATUS, RUNNING_STATUS or COMPLETE_STATUS
+        """
+        elapsed = now - submitted
+        if elapsed < self.config['queued_seconds']:
+            return QUEUE_STATUS
+        elif elapsed < self.config['queued_seconds']+self.config['run_seconds']:
+            return RUNNING_STATUS
+        return COMPLETE_STATUS
+
+    def count(self):
+        """
+        Number of jobs queued or running
+
+        :return: integer
+        """
+        now = time.time()
+        return len([1 for submitted, _ in self.jobs().values()
+                    if self.get_status(submitted, now) != COMPLETE_STATUS])
+
+    def status(self, jobid):
+        """
+        Status of a job. A job ending writes its READY_TO_UPLOAD flag.
+
+        :param jobid: job id
+        :return: status string, '' for an unknown job
+        """
+        job = self.jobs().get(jobid)
+        if job is None:
+            return ''
+        status = self.get_status(job[0], time.time())
+        if status == COMPLETE_STATUS and self.config['results_dir']:
+            flag_dir = os.path.join(self.config['results_dir'], job[1])
+            if not os.path.exists(flag_dir):
+                os.makedirs(flag_dir)
+            open(os.path.join(flag_dir, READY_FLAG), 'w').close()
+        return status
+
+def read_config(config_file):
+    """
+    Read the configuration of the fake scheduler
+
+    :param config_file: path to the file written by write_config
+    :return: dictionary
+    """
+    config = {'queued_seconds': 0.0, 'run_seconds': 60.0, 'results_dir': ''}
+    if os.path.isfile(config_file):
+        with open(config_file, 'r') as f_obj:
+            for line in f_obj:
+                if '=' in line:
+                    key, value = line.strip().split('=', 1)
+                    if key in ['queued_seconds', 'run_seconds']:
+                        value = float(value)
+                    config[key] = value
+    return config
+
+def write_config(state_dir, queued_seconds=0, run_seconds=60, results_dir=''):
+    """
+    Write the configuration of the fake scheduler
+
+    :param state_dir: directory holding the jobs
+    :param queued_seconds: seconds a job stays queued
+    :param run_seconds: seconds a job stays running after being queued
+    :param results_dir: RESULTS_DIR where the ending jobs write their flag
+    :return: None
+    """
+    if not os.path.exists(state_dir):
+        os.makedirs(state_dir)
+    with open(os.path.join(state_dir, CONFIG_FILE), 'w') as f_obj:
+        f_obj.write('queued_seconds=%s\n' % queued_seconds)
+        f_obj.write('run_seconds=%s\n' % run_seconds)
+        f_obj.write('results_dir=%s\n' % results_dir)
+
+def write_cluster_templates(state_dir, python=sys.executable):
+    """
+    Write the template files for the cluster section of dax_settings.ini
+
+    :param state_dir: directory holding the jobs and the templates
+    :param python: python executable used by the commands
+    :return: dictionary option -> value for the cluster section
+    """
+    script = os.path.abspath(__file__)
+    if script.endswith('.pyc'):
+        script = script[:-1]
+    cmd = '%s %s --dir %s' % (python, script, state_dir)
+    templates = {'cmd_count_nb_jobs': cmd+' count',
+                 'cmd_get_job_status': cmd+' status ${jobid}',
+                 'cmd_get_job_memory': cmd+' memory ${jobid}',
+                 'cmd_get_job_walltime': cmd+' walltime ${jobid}',
+                 'cmd_get_job_node': cmd+' node ${jobid}',
+                 'job_template': JOB_TEMPLATE}
+    options = {'cluster_type': '',
+               'cmd_submit': cmd+' submit',
+               'prefix_jobid': SUBMIT_PREFIX,
+               'suffix_jobid': SUBMIT_SUFFIX,
+               'queue_status': QUEUE_STATUS,
+               'running_status': RUNNING_STATUS,
+               'complete_status': COMPLETE_STATUS,
+               'job_extension_file': JOB_EXTENSION}
+    for option, template in templates.items():
+        template_file = os.path.join(state_dir, option+'.txt')
+        with open(template_file, 'w') as f_obj:
+            f_obj.write(template)
+        options[option] = template_file
+    return options
+
+def parse_args():
+    """
+    Method to parse arguments base on ArgumentParser
+
+    :return: parser object parsed
+    """
+    argp = ArgumentParser(prog='fake_cluster', description='Fake scheduler for the dax cmd templates.')
+    argp.add_argument('--dir', dest='state_dir', required=True, help='Directory holding the jobs.')
+    argp.add_argument(dest='command', choices=['submit', 'count', 'status', 'memory', 'walltime', 'node'])
+    argp.add_argument(dest='arg', nargs='?', default=None, help='Job file for submit, job id otherwise.')
+    return argp.parse_args()
+
+def main():
+    """
+    Run one command of the fake scheduler
+
+    :return: exit code
+    """
+    args = parse_args()
+    fake = FakeCluster(args.state_dir)
+    if args.command == 'submit':
+        print '%s %s%s' % (SUBMIT_PREFIX, fake.submit(args.arg), SUBMIT_SUFFIX)
+    elif args.command == 'count':
+        print fake.count()
+    elif args.command == 'status':
+        print fake.status(args.arg)
+    elif args.arg not in fake.jobs():
+        return 1
+    elif args.command == 'memory':
+        print '1048576'
+    elif args.command == 'walltime':
+        print '00:%02d:00' % min(int(fake.config['run_seconds']/60)+1, 59)
+    else:
+        print 'fakenode%02d' % (int(args.arg) % 10)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
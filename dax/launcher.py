@@ -6,7 +6,13 @@ __copyright__ = 'Copyright 2013 Vanderbilt University. All Rights Reserved'
 
 import os
 import sys
+import json
+import time
+import errno
+import fcntl
+import socket
 import logging
+import multiprocessing
 from datetime import datetime, timedelta
 
 import processors
@@ -16,18 +22,28 @@ import task
 import cluster
 import bin
 from task import Task
-from dax_settings import DAX_Settings
-DAX_SETTINGS = DAX_Settings()
+from dax_settings import get_settings
+DAX_SETTINGS = get_settings()
 RESULTS_DIR = DAX_SETTINGS.get_results_dir()
 DEFAULT_ROOT_JOB_DIR = DAX_SETTINGS.get_root_job_dir()
 DEFAULT_QUEUE_LIMIT = DAX_SETTINGS.get_queue_limit()
 DEFAULT_MAX_AGE = DAX_SETTINGS.get_max_age()
 
+# Number of launches before counting again the jobs on the cluster
+RECOUNT_JOBS_EVERY = 50
+
 UPDATE_PREFIX = 'updated--'
 UPDATE_FORMAT = "%Y-%m-%d %H:%M:%S"
 BUILD_SUFFIX = 'BUILD_RUNNING.txt'
 UPDATE_SUFFIX = 'UPDATE_RUNNING.txt'
 LAUNCH_SUFFIX = 'LAUNCHER_RUNNING.txt'
+REBUILD_QUEUE_SUFFIX = 'REBUILD_QUEUE.txt'
+UPSTREAM_STATUS_SUFFIX = 'UPSTREAM_STATUS.json'
+PROJECT_LOCK_EXT = '.lock'
+# Guard shared by the flagfiles of a folder while checking a stale flagfile
+GUARD_FILE = '.flagfiles.guard'
+# Seconds between two checks on the project processes
+WORKERS_POLL = 0.5
 
 #Logger to print logs
 LOGGER = logging.getLogger('dax')
@@ -37,7 +53,8 @@ class Launcher(object):
     def __init__(self, project_process_dict, project_modules_dict, priority_project=None,
                  queue_limit=DEFAULT_QUEUE_LIMIT, root_job_dir=DEFAULT_ROOT_JOB_DIR,
                  xnat_user=None, xnat_pass=None, xnat_host=None,
-                 job_email=None, job_email_options='bae', max_age=DEFAULT_MAX_AGE):
+                 job_email=None, job_email_options='bae', max_age=DEFAULT_MAX_AGE,
+                 nb_workers=1):
         """
         Entry point for the Launcher class
 
@@ -52,6 +69,8 @@ class Launcher(object):
         :param job_email: job email address for report
         :param job_email_options: email options for the jobs
         :param max_age: maximum time before updating again a session
+        :param nb_workers: number of projects to build/update/launch at
+         the same time (one process per project)
         :return: None
         """
         self.queue_limit = queue_limit
@@ -62,6 +81,7 @@ class Launcher(object):
         self.job_email = job_email
         self.job_email_options = job_email_options
         self.max_age = max_age
+        self.nb_workers = nb_workers
 
         #Creating Folders for flagfile/pbs/outlog in RESULTS_DIR
         if not os.path.exists(RESULTS_DIR):
@@ -103,7 +123,7 @@ class Launcher(object):
             sys.exit(1)
 
     ################## LAUNCH Main Method ##################
-    def launch_jobs(self, lockfile_prefix, project_local, sessions_local, writeonly=False, pbsdir=None):
+    def launch_jobs(self, lockfile_prefix, project_local, sessions_local, writeonly=False, pbsdir=None, xnat=None):
         """
         Main Method to launch the tasks
 
@@ -113,6 +133,8 @@ class Launcher(object):
          associated to the project locally
         :param writeonly: write the job files without submitting them
         :param pbsdir: folder to store the pbs file
+        :param xnat: pyxnat.Interface object to use (kept open at the end).
+         By default, connect to XNAT and disconnect at the end.
         :return: None
 
         """
@@ -120,27 +142,79 @@ class Launcher(object):
 
         flagfile = os.path.join(RESULTS_DIR, 'FlagFiles', lockfile_prefix+'_'+LAUNCH_SUFFIX)
         project_list = self.init_script(flagfile, project_local, type_update=3, start_end=1)
+        keep_xnat = xnat is not None
 
         try:
-            LOGGER.info('Connecting to XNAT at '+self.xnat_host)
-            xnat = XnatUtils.get_interface(self.xnat_host, self.xnat_user, self.xnat_pass)
-
-            if not XnatUtils.has_dax_datatypes(xnat):
-                raise Exception('error: dax datatypes are not installed on your xnat <%s>' % (self.xnat_host))
+            if not keep_xnat:
+                xnat = self.connect_xnat()
+
+            if self.is_concurrent(project_list):
+                # Jobs in the queue shared between the project processes
+                try:
+                    cur_job_count = cluster.count_jobs()
+                except cluster.ClusterCountJobsException:
+                    LOGGER.error('cannot get count of jobs from cluster')
+                    return
+                job_count = multiprocessing.Value('i', cur_job_count)
+                launch_project = lambda _xnat, project_id: self.launch_project(
+                    _xnat, project_id, sessions_local, writeonly, pbsdir, job_count)
+                self.run_projects(project_list, 'launch', launch_project, xnat)
+                return
+
+            locked_list = [project_id for project_id in project_list
+                           if self.lock_project(project_id, 'launch')]
+            if not locked_list:
+                return
+            try:
+                LOGGER.info('Getting launchable tasks list...')
+                task_list = self.get_tasks(xnat,
+                                           self.is_launchable_tasks,
+                                           locked_list,
+                                           sessions_local)
+
+                LOGGER.info(str(len(task_list))+' tasks that need to be launched found')
+
+                #Launch the task that need to be launch
+                self.launch_tasks(task_list, writeonly, pbsdir)
+            finally:
+                for project_id in locked_list:
+                    self.unlock_flagfile(self.get_project_flagfile(project_id, 'launch'))
 
-            LOGGER.info('Getting launchable tasks list...')
-            task_list = self.get_tasks(xnat,
-                                       self.is_launchable_tasks,
-                                       project_list,
-                                       sessions_local)
-
-            LOGGER.info(str(len(task_list))+' tasks that need to be launched found')
+        finally:
+            self.finish_script(xnat, flagfile, project_list, 3, 2, project_local, keep_xnat)
 
-            #Launch the task that need to be launch
-            self.launch_tasks(task_list, writeonly, pbsdir)
+    def launch_project(self, xnat, project_id, sessions_local, writeonly,
+                       pbsdir, job_count):
+        """
+        Launch the tasks of one project, counting the jobs in job_count
 
-        finally:
-            self.finish_script(xnat, flagfile, project_list, 3, 2, project_local)
+        :param xnat: pyxnat.Interface object
+        :param project_id: project ID on XNAT
+        :param sessions_local: list of sessions to launch tasks
+         associated to the project locally
+        :param writeonly: write the job files without submitting them
+        :param pbsdir: folder to store the pbs file
+        :param job_count: multiprocessing.Value shared by the projects
+         with the number of jobs in the queue
+        :return: None
+        """
+        task_list = self.get_project_tasks(xnat, project_id, sessions_local,
+                                           self.is_launchable_tasks)
+        LOGGER.info(str(len(task_list))+' tasks that need to be launched found')
+        while task_list:
+            # Reserve a place in the queue before launching
+            with job_count.get_lock():
+                if job_count.value >= self.queue_limit and not writeonly:
+                    break
+                job_count.value += 1
+                cur_job_count = job_count.value
+            cur_task = task_list.pop()
+            LOGGER.info('  +Launching job:%s, currently %d jobs in cluster queue'
+                        % (cur_task.assessor_label, cur_job_count))
+            success = cur_task.launch(self.root_job_dir, self.job_email, self.job_email_options, self.xnat_host, writeonly, pbsdir)
+            if not success:
+                LOGGER.error('ERROR:failed to launch job')
+                raise cluster.ClusterLaunchException
 
     @staticmethod
     def is_launchable_tasks(assr_info):
@@ -162,13 +236,15 @@ class Launcher(object):
         :return: None
         """
         # Check number of jobs on cluster
-        cur_job_count = cluster.count_jobs()
-        if cur_job_count == -1:
+        try:
+            cur_job_count = cluster.count_jobs()
+        except cluster.ClusterCountJobsException:
             LOGGER.error('cannot get count of jobs from cluster')
             return
 
         LOGGER.info(str(cur_job_count)+' jobs currently in queue')
 
+        nb_launched = 0
         # Launch until we reach cluster limit or no jobs left to launch
         while (cur_job_count < self.queue_limit or writeonly) and len(task_list) > 0:
             cur_task = task_list.pop()
@@ -192,13 +268,21 @@ class Launcher(object):
                 LOGGER.error('ERROR:failed to launch job')
                 raise cluster.ClusterLaunchException
 
-            cur_job_count = cluster.count_jobs()
-            if cur_job_count == -1:
-                LOGGER.error('ERROR:cannot get count of jobs from cluster')
-                raise cluster.ClusterCountJobsException
+            # Count the job locally and only ask the cluster from time to time
+            nb_launched += 1
+            if nb_launched % RECOUNT_JOBS_EVERY != 0:
+                cur_job_count += 1
+                continue
+
+            try:
+                cur_job_count = cluster.count_jobs()
+            except cluster.ClusterCountJobsException:
+                LOGGER.error('cannot get count of jobs from cluster, %d jobs launched'
+                             % nb_launched)
+                return
 
     ################## UPDATE Main Method ##################
-    def update_tasks(self, lockfile_prefix, project_local, sessions_local):
+    def update_tasks(self, lockfile_prefix, project_local, sessions_local, xnat=None):
         """
         Main method to Update the tasks
 
@@ -206,6 +290,8 @@ class Launcher(object):
         :param project_local: project to run locally
         :param sessions_local: list of sessions to update tasks associated
          to the project locally
+        :param xnat: pyxnat.Interface object to use (kept open at the end).
+         By default, connect to XNAT and disconnect at the end.
         :return: None
 
         """
@@ -213,29 +299,44 @@ class Launcher(object):
 
         flagfile = os.path.join(RESULTS_DIR, 'FlagFiles', lockfile_prefix+'_'+UPDATE_SUFFIX)
         project_list = self.init_script(flagfile, project_local, type_update=2, start_end=1)
+        keep_xnat = xnat is not None
 
         try:
-            LOGGER.info('Connecting to XNAT at '+self.xnat_host)
-            xnat = XnatUtils.get_interface(self.xnat_host, self.xnat_user, self.xnat_pass)
+            if not keep_xnat:
+                xnat = self.connect_xnat()
+
+            update_project = lambda _xnat, project_id: self.update_project(
+                _xnat, project_id, lockfile_prefix, sessions_local)
+            self.run_projects(project_list, 'update', update_project, xnat)
 
-            if not XnatUtils.has_dax_datatypes(xnat):
-                raise Exception('error: dax datatypes are not installed on your xnat <%s>' % (self.xnat_host))
+        finally:
+            self.finish_script(xnat, flagfile, project_list, 2, 2, project_local, keep_xnat)
 
-            LOGGER.info('Getting task list...')
-            task_list = self.get_tasks(xnat,
-                                       self.is_updatable_tasks,
-                                       project_list,
-                                       sessions_local)
+    def update_project(self, xnat, project_id, lockfile_prefix, sessions_local):
+        """
+        Update the open tasks of one project
 
-            LOGGER.info(str(len(task_list))+' open tasks found')
+        :param xnat: pyxnat.Interface object
+        :param project_id: project ID on XNAT
+        :param lockfile_prefix: prefix of the flag files of the settings
+        :param sessions_local: list of sessions to update tasks associated
+         to the project locally
+        :return: None
+        """
+        LOGGER.info('Getting task list...')
+        task_list = self.get_project_tasks(xnat, project_id, sessions_local,
+                                           self.is_updatable_tasks)
 
-            LOGGER.info('Updating tasks...')
-            for cur_task in task_list:
-                LOGGER.info('     Updating task:'+cur_task.assessor_label)
-                cur_task.update_status()
+        LOGGER.info(str(len(task_list))+' open tasks found')
 
-        finally:
-            self.finish_script(xnat, flagfile, project_list, 2, 2, project_local)
+        LOGGER.info('Updating tasks...')
+        for cur_task in task_list:
+            LOGGER.info('     Updating task:'+cur_task.assessor_label)
+            new_status = cur_task.update_status()
+            # Inputs of the downstream processors changed: rebuild session
+            if cur_task.status_changed and \
+               new_status in [task.COMPLETE, task.NEED_TO_RUN]:
+                self.queue_downstream_rebuild(lockfile_prefix, cur_task)
 
     @staticmethod
     def is_updatable_tasks(assr_info):
@@ -250,7 +351,7 @@ class Launcher(object):
                assr_info['qcstatus'] in task.OPEN_QA_LIST
 
     ################## BUILD Main Method ##################
-    def build(self, lockfile_prefix, project_local, sessions_local):
+    def build(self, lockfile_prefix, project_local, sessions_local, xnat=None):
         """
         Main method to build the tasks and the sessions
 
@@ -258,6 +359,8 @@ class Launcher(object):
         :param project_local: project to run locally
         :param sessions_local: list of sessions to launch tasks
          associated to the project locally
+        :param xnat: pyxnat.Interface object to use (kept open at the end).
+         By default, connect to XNAT and disconnect at the end.
         :return: None
 
         """
@@ -265,13 +368,11 @@ class Launcher(object):
 
         flagfile = os.path.join(RESULTS_DIR, 'FlagFiles', lockfile_prefix+'_'+BUILD_SUFFIX)
         project_list = self.init_script(flagfile, project_local, type_update=1, start_end=1)
+        keep_xnat = xnat is not None
 
         try:
-            LOGGER.info('Connecting to XNAT at '+self.xnat_host)
-            xnat = XnatUtils.get_interface(self.xnat_host, self.xnat_user, self.xnat_pass)
-
-            if not XnatUtils.has_dax_datatypes(xnat):
-                raise Exception('error: dax datatypes are not installed on your xnat <%s>' % (self.xnat_host))
+            if not keep_xnat:
+                xnat = self.connect_xnat()
 
             #Priority if set:
             if self.priority_project and not project_local:
@@ -279,12 +380,12 @@ class Launcher(object):
                 project_list = self.get_project_list(list(unique_list))
 
             # Build projects
-            for project_id in project_list:
-                LOGGER.info('===== PROJECT:'+project_id+' =====')
-                self.build_project(xnat, project_id, lockfile_prefix, sessions_local)
+            build_project = lambda _xnat, project_id: self.build_project(
+                _xnat, project_id, lockfile_prefix, sessions_local)
+            self.run_projects(project_list, 'build', build_project, xnat)
 
         finally:
-            self.finish_script(xnat, flagfile, project_list, 1, 2, project_local)
+            self.finish_script(xnat, flagfile, project_list, 1, 2, project_local, keep_xnat)
 
     def build_project(self, xnat, project_id, lockfile_prefix, sessions_local):
         """
@@ -310,41 +411,114 @@ class Launcher(object):
         # Check for new processors
         has_new = self.has_new_processors(xnat, project_id, exp_procs, scan_procs)
 
+        # Sessions where the inputs of a processor changed
+        rebuild_sessions = self.get_sessions_to_rebuild(xnat, lockfile_prefix, project_id)
+
         # Get the list of sessions:
         sessions = self.get_sessions_list(xnat, project_id, sessions_local)
 
         # Update each session from the list:
-        for sess_info in sessions:
-            last_mod = datetime.strptime(sess_info['last_modified'][0:19], UPDATE_FORMAT)
-            now_date = datetime.today()
-            last_up = self.get_lastupdated(sess_info)
-
-            #If sessions_local is set, skip checking the date
-            if not has_new and last_up != None and \
-               last_mod < last_up and not sessions_local and \
-               now_date < last_mod+timedelta(days=int(self.max_age)):
-                mess = """  +Session:{sess}: skipping, last_mod={mod},last_up={up}"""
-                mess_str = mess.format(sess=sess_info['label'], mod=str(last_mod), up=str(last_up))
-                LOGGER.info(mess_str)
-            else:
-                update_run_count = 0
-                got_updated = False
-                while update_run_count < 3 and not got_updated:
-                    mess = """  +Session:{sess}: updating (count:{count})..."""
-                    LOGGER.info(mess.format(sess=sess_info['label'], count=update_run_count))
-                    # NOTE: we keep the starting time of the update
-                    # and will check if something change during the update
-                    update_start_time = datetime.now()
-                    self.build_session(xnat, sess_info, exp_procs, scan_procs, exp_mods, scan_mods)
-                    got_updated = self.set_session_lastupdated(xnat, sess_info, update_start_time)
-                    update_run_count = update_run_count+1
-                    LOGGER.debug('\n')
+        try:
+            for sess_info in sessions:
+                last_mod = datetime.strptime(sess_info['last_modified'][0:19], UPDATE_FORMAT)
+                now_date = datetime.today()
+                last_up = self.get_lastupdated(sess_info)
+
+                #If sessions_local is set, skip checking the date
+                if not has_new and last_up != None and \
+                   last_mod < last_up and not sessions_local and \
+                   sess_info['label'] not in rebuild_sessions and \
+                   now_date < last_mod+timedelta(days=int(self.max_age)):
+                    mess = """  +Session:{sess}: skipping, last_mod={mod},last_up={up}"""
+                    mess_str = mess.format(sess=sess_info['label'], mod=str(last_mod), up=str(last_up))
+                    LOGGER.info(mess_str)
+                else:
+                    self.update_session(xnat, sess_info, exp_procs, scan_procs, exp_mods, scan_mods)
+                rebuild_sessions.discard(sess_info['label'])
+        except:
+            # Keep the sessions not rebuilt yet for the next build
+            if rebuild_sessions:
+                LOGGER.warn('build of %s stopped, queuing again %d sessions to rebuild'
+                            % (project_id, len(rebuild_sessions)))
+                self.queue_sessions_rebuild(lockfile_prefix, project_id,
+                                            sorted(rebuild_sessions))
+            raise
 
         if not sessions_local or sessions_local.lower() == 'all':
             # Modules after run
             LOGGER.debug('*Modules Afterrun')
             self.module_afterrun(xnat, project_id)
 
+    def build_queued(self, lockfile_prefix, xnat=None):
+        """
+        Build only the sessions where the inputs of a processor changed:
+         upstream assessor COMPLETE or its QA changed (see depends_on for
+         processors)
+
+        :param lockfile_prefix: prefix for flag file to lock the launcher
+        :param xnat: pyxnat.Interface object to use (kept open at the end).
+         By default, connect to XNAT and disconnect at the end.
+        :return: None
+        """
+        LOGGER.info('-------------- Build queued sessions --------------\n')
+
+        # Same lock than dax_build: the queue waits for the end of a build
+        flagfile = os.path.join(RESULTS_DIR, 'FlagFiles', lockfile_prefix+'_'+BUILD_SUFFIX)
+        if not self.lock_flagfile(flagfile):
+            LOGGER.info('dax_build running, queued sessions will be built later.')
+            return
+        project_list = sorted(set(self.project_process_dict.keys()+self.project_modules_dict.keys()))
+        keep_xnat = xnat is not None
+
+        try:
+            if not keep_xnat:
+                xnat = self.connect_xnat()
+
+            for project_id in project_list:
+                rebuild_sessions = self.get_sessions_to_rebuild(xnat, lockfile_prefix, project_id)
+                if not rebuild_sessions:
+                    continue
+
+                LOGGER.info('===== PROJECT:'+project_id+' =====')
+                exp_mods, scan_mods = modules.modules_by_type(self.project_modules_dict[project_id])
+                exp_procs, scan_procs = processors.processors_by_type(self.project_process_dict[project_id])
+                for sess_info in XnatUtils.list_sessions(xnat, project_id):
+                    if sess_info['label'] in rebuild_sessions:
+                        self.update_session(xnat, sess_info, exp_procs, scan_procs, exp_mods, scan_mods)
+
+        finally:
+            self.unlock_flagfile(flagfile)
+            if xnat is not None and not keep_xnat:
+                xnat.disconnect()
+                LOGGER.info('Connection to XNAT closed')
+
+    def update_session(self, xnat, sess_info, sess_proc_list,
+                       scan_proc_list, sess_mod_list, scan_mod_list):
+        """
+        Build a session and set its last update date, trying again if the
+         session changed during the build
+
+        :param xnat: pyxnat.Interface object
+        :param sess_info: python ditionary from XnatUtils.list_sessions method
+        :param sess_proc_list: list of processors running on a session
+        :param scan_proc_list: list of processors running on a scan
+        :param sess_mod_list: list of modules running on a session
+        :param scan_mod_list: list of modules running on a scan
+        :return: None
+        """
+        update_run_count = 0
+        got_updated = False
+        while update_run_count < 3 and not got_updated:
+            mess = """  +Session:{sess}: updating (count:{count})..."""
+            LOGGER.info(mess.format(sess=sess_info['label'], count=update_run_count))
+            # NOTE: we keep the starting time of the update
+            # and will check if something change during the update
+            update_start_time = datetime.now()
+            self.build_session(xnat, sess_info, sess_proc_list, scan_proc_list, sess_mod_list, scan_mod_list)
+            got_updated = self.set_session_lastupdated(xnat, sess_info, update_start_time)
+            update_run_count = update_run_count+1
+            LOGGER.debug('\n')
+
     def build_session(self, xnat, sess_info, sess_proc_list,
                       scan_proc_list, sess_mod_list, scan_mod_list):
         """
@@ -500,6 +674,147 @@ class Launcher(object):
             mod.afterrun(xnat, project_id)
         LOGGER.debug('\n')
 
+    ################## Projects Runner ##################
+    def is_concurrent(self, project_list):
+        """
+        Check if the projects run in concurrent processes
+
+        :param project_list: List of projects to run
+        :return: True if more than one worker and one project, False otherwise
+        """
+        return self.nb_workers > 1 and len(project_list) > 1
+
+    def run_projects(self, project_list, lock_type, run_project, xnat):
+        """
+        Run a method on each project, holding the lock of the project.
+
+        A failure on a project is logged and the other projects still run.
+        With more than one worker, the projects run in concurrent processes
+        with their own XNAT connection.
+
+        :param project_list: List of projects to run
+        :param lock_type: 'build', 'update' or 'launch'
+        :param run_project: method called with (xnat, project_id)
+        :param xnat: pyxnat.Interface object for the sequential run
+        :return: list of the projects that failed or were locked
+        """
+        if self.is_concurrent(project_list):
+            failed = self.run_projects_concurrent(project_list, lock_type,
+                                                  run_project)
+        else:
+            failed = [project_id for project_id in project_list
+                      if not self.run_project(project_id, lock_type,
+                                              run_project, xnat)]
+        if failed:
+            LOGGER.error('%s failed for the project(s): %s'
+                         % (lock_type, ', '.join(failed)))
+        return failed
+
+    def run_project(self, project_id, lock_type, run_project, xnat):
+        """
+        Run a method on one project, holding the lock of the project
+
+        :param project_id: project ID on XNAT
+        :param lock_type: 'build', 'update' or 'launch'
+        :param run_project: method called with (xnat, project_id)
+        :param xnat: pyxnat.Interface object
+        :return: True if the project ran without errors, False otherwise
+        """
+        LOGGER.info('===== PROJECT:'+project_id+' =====')
+        if not self.lock_project(project_id, lock_type):
+            return False
+        try:
+            run_project(xnat, project_id)
+            return True
+        except Exception:
+            LOGGER.exception('%s failed for project %s' % (lock_type, project_id))
+            return False
+        finally:
+            self.unlock_flagfile(self.get_project_flagfile(project_id, lock_type))
+
+    def run_projects_concurrent(self, project_list, lock_type, run_project):
+        """
+        Run a method on the projects with nb_workers processes at a time
+
+        :param project_list: List of projects to run
+        :param lock_type: 'build', 'update' or 'launch'
+        :param run_project: method called with (xnat, project_id)
+        :return: list of the projects that failed or were locked
+        """
+        LOGGER.info('running %s on %d projects with %d workers'
+                    % (lock_type, len(project_list), self.nb_workers))
+        failed = list()
+        running = dict()
+        for project_id in project_list:
+            while len(running) >= self.nb_workers:
+                self.wait_project_processes(running, failed)
+            # Forked: the child gets the launcher/processors without pickling
+            proc = multiprocessing.Process(target=self.project_process,
+                                           args=(project_id, lock_type,
+                                                 run_project),
+                                           name=project_id)
+            proc.start()
+            running[project_id] = proc
+        while running:
+            self.wait_project_processes(running, failed)
+        return failed
+
+    @staticmethod
+    def wait_project_processes(running, failed):
+        """
+        Wait until at least one of the project processes is done
+
+        :param running: dictionary project ID -> running process (updated)
+        :param failed: list of the projects that failed (updated)
+        :return: None
+        """
+        while True:
+            done = [project_id for project_id, proc in running.items()
+                    if not proc.is_alive()]
+            if done:
+                break
+            time.sleep(WORKERS_POLL)
+        for project_id in done:
+            proc = running.pop(project_id)
+            proc.join()
+            if proc.exitcode != 0:
+                failed.append(project_id)
+
+    def project_process(self, project_id, lock_type, run_project):
+        """
+        Body of the process running one project with its own XNAT connection
+
+        :param project_id: project ID on XNAT
+        :param lock_type: 'build', 'update' or 'launch'
+        :param run_project: method called with (xnat, project_id)
+        :return: None (exit code 0 on success, 1 otherwise)
+        """
+        xnat = None
+        success = False
+        try:
+            xnat = XnatUtils.get_interface(self.xnat_host, self.xnat_user, self.xnat_pass)
+            success = self.run_project(project_id, lock_type, run_project, xnat)
+        except Exception:
+            LOGGER.exception('%s failed for project %s' % (lock_type, project_id))
+        finally:
+            if xnat is not None:
+                xnat.disconnect()
+        sys.exit(0 if success else 1)
+
+    def lock_project(self, project_id, lock_type):
+        """
+        Lock one project for build/update/launch
+
+        :param project_id: project ID on XNAT
+        :param lock_type: 'build', 'update' or 'launch'
+        :return: True if the lock was taken, False otherwise
+        """
+        if self.lock_flagfile(self.get_project_flagfile(project_id, lock_type)):
+            return True
+        LOGGER.warn('project %s is locked: %s already running. Skipping.'
+                    % (project_id, lock_type))
+        return False
+
     ################## Generic Methods ##################
     def init_script(self, flagfile, project_local, type_update, start_end):
         """
@@ -540,7 +855,21 @@ The project is not part of the settings."""
             bin.upload_update_date_redcap(project_list, type_update, start_end)
         return project_list
 
-    def finish_script(self, xnat, flagfile, project_list, type_update, start_end, project_local):
+    def connect_xnat(self):
+        """
+        Connect to XNAT and check that the dax datatypes are installed
+
+        :return: pyxnat.Interface object
+        """
+        LOGGER.info('Connecting to XNAT at '+self.xnat_host)
+        xnat = XnatUtils.get_interface(self.xnat_host, self.xnat_user, self.xnat_pass)
+
+        if not XnatUtils.has_dax_datatypes(xnat):
+            xnat.disconnect()
+            raise Exception('error: dax datatypes are not installed on your xnat <%s>' % (self.xnat_host))
+        return xnat
+
+    def finish_script(self, xnat, flagfile, project_list, type_update, start_end, project_local, keep_xnat=False):
         """
         Finish script for any of the main methods: build/update/launch
 
@@ -550,28 +879,202 @@ The project is not part of the settings."""
          dax_update_tasks (2), dax_launch (3)
         :param start_end: starting timestamp (1) and ending timestamp (2)
         :param project_local: project to run locally
+        :param keep_xnat: do not disconnect from XNAT (connection owned by
+         the caller)
         :return: None
         """
         if not project_local:
             self.unlock_flagfile(flagfile)
             #Set the date on REDCAP for update ending
             bin.upload_update_date_redcap(project_list, type_update, start_end)
-        xnat.disconnect()
-        LOGGER.info('Connection to XNAT closed')
+        if xnat is not None and not keep_xnat:
+            xnat.disconnect()
+            LOGGER.info('Connection to XNAT closed')
+
+    ################## Processors dependencies ##################
+    def get_processor_graph(self, project_id):
+        """
+        Get the dependency graph between the processors of a project
+
+        :param project_id: project ID on XNAT
+        :return: processors.ProcessorGraph object
+        """
+        return processors.ProcessorGraph(self.project_process_dict.get(project_id, list()))
+
+    def queue_downstream_rebuild(self, lockfile_prefix, cur_task):
+        """
+        Queue the session of a task for rebuild if processors use the
+         assessor as input
+
+        :param lockfile_prefix: prefix of the flag files of the settings
+        :param cur_task: Task object that changed status
+        :return: None
+        """
+        labels = cur_task.assessor_label.split('-x-')
+        project_id, session_label = labels[0], labels[2]
+        graph = self.get_processor_graph(project_id)
+        if graph.is_upstream(cur_task.get_processor_name()):
+            LOGGER.info('     queuing session %s for rebuild' % session_label)
+            self.queue_sessions_rebuild(lockfile_prefix, project_id, [session_label])
+
+    def get_sessions_to_rebuild(self, xnat, lockfile_prefix, project_id):
+        """
+        Get the sessions to rebuild for a project: sessions queued and
+         sessions where the status or the QA of an upstream assessor changed
+         since the last check
+
+        :param xnat: pyxnat.Interface object
+        :param lockfile_prefix: prefix of the flag files of the settings
+        :param project_id: project ID on XNAT
+        :return: set of sessions labels
+        """
+        graph = self.get_processor_graph(project_id)
+        if graph.is_empty():
+            return set()
+        sessions = self.pop_sessions_rebuild(lockfile_prefix, project_id)
+
+        status_file = os.path.join(RESULTS_DIR, 'FlagFiles', '%s_%s_%s' % (
+            lockfile_prefix, project_id, UPSTREAM_STATUS_SUFFIX))
+        old_status = dict()
+        if os.path.isfile(status_file):
+            with open(status_file, 'r') as f_obj:
+                old_status = json.load(f_obj)
+        new_status = dict()
+        # Only the upstream assessors, versioned or not (see ProcessorGraph.is_match)
+        proctypes = list()
+        for upstream in graph.get_upstream_proctypes():
+            proctypes.extend([upstream, upstream+'_v*'])
+        for assr_info in XnatUtils.list_project_assessors(
+                xnat, project_id, filters={'proctype': proctypes}):
+            if graph.is_upstream(assr_info['proctype']):
+                new_status[assr_info['label']] = [assr_info['procstatus'],
+                                                  assr_info['qcstatus']]
+                old = old_status.get(assr_info['label'])
+                if old is not None and old != new_status[assr_info['label']]:
+                    sessions.add(assr_info['session_label'])
+        with open(status_file, 'w') as f_obj:
+            json.dump(new_status, f_obj)
+
+        if sessions:
+            LOGGER.info('%d sessions to rebuild for %s (inputs changed)'
+                        % (len(sessions), project_id))
+        return sessions
+
+    @staticmethod
+    def queue_sessions_rebuild(lockfile_prefix, project_id, session_labels):
+        """
+        Add sessions to the rebuild queue of a project
+
+        :param lockfile_prefix: prefix of the flag files of the settings
+        :param project_id: project ID on XNAT
+        :param session_labels: list of sessions labels
+        :return: None
+        """
+        queue_file = os.path.join(RESULTS_DIR, 'FlagFiles', '%s_%s_%s' % (
+            lockfile_prefix, project_id, REBUILD_QUEUE_SUFFIX))
+        # one write in append mode: safe with several writers
+        fdesc = os.open(queue_file, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+        try:
+            os.write(fdesc, ''.join([label+'\n' for label in session_labels]))
+        finally:
+            os.close(fdesc)
+
+    @staticmethod
+    def pop_sessions_rebuild(lockfile_prefix, project_id):
+        """
+        Get and empty the rebuild queue of a project
+
+        :param lockfile_prefix: prefix of the flag files of the settings
+        :param project_id: project ID on XNAT
+        :return: set of sessions labels
+        """
+        queue_file = os.path.join(RESULTS_DIR, 'FlagFiles', '%s_%s_%s' % (
+            lockfile_prefix, project_id, REBUILD_QUEUE_SUFFIX))
+        popped_file = '%s.%d' % (queue_file, os.getpid())
+        try:
+            # rename first so labels queued meanwhile go to a new file
+            os.rename(queue_file, popped_file)
+        except OSError:
+            return set()
+        with open(popped_file, 'r') as f_obj:
+            sessions = set(line.strip() for line in f_obj if line.strip())
+        os.remove(popped_file)
+        return sessions
 
     @staticmethod
     def lock_flagfile(lock_file):
         """
-        Create the flagfile to lock the process
+        Create the flagfile to lock the process.
+
+        The file is created atomically and holds the host and the PID of the
+        process. A flagfile left by a dead process on this host is removed.
 
         :param lock_file: flag file use to lock the process
         :return: True if the file didn't exist, False otherwise
         """
-        if os.path.exists(lock_file):
-            return False
-        else:
-            open(lock_file, 'w').close()
+        if Launcher.create_flagfile(lock_file):
             return True
+        # Only one process at a time checks and removes a stale flagfile
+        guard_file = os.path.join(os.path.dirname(lock_file), GUARD_FILE)
+        with open(guard_file, 'a') as guard:
+            fcntl.flock(guard, fcntl.LOCK_EX)
+            try:
+                if not Launcher.is_stale_flagfile(lock_file):
+                    return False
+                try:
+                    os.remove(lock_file)
+                    LOGGER.warn('removed stale flag file %s' % lock_file)
+                except OSError as err:
+                    # Already removed by its owner
+                    if err.errno != errno.ENOENT:
+                        raise
+                return Launcher.create_flagfile(lock_file)
+            finally:
+                fcntl.flock(guard, fcntl.LOCK_UN)
+
+    @staticmethod
+    def create_flagfile(lock_file):
+        """
+        Create the flagfile if it doesn't exist (atomic)
+
+        :param lock_file: flag file use to lock the process
+        :return: True if the file was created, False if it already existed
+        """
+        try:
+            fdesc = os.open(lock_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        except OSError as err:
+            if err.errno == errno.EEXIST:
+                return False
+            raise
+        try:
+            os.write(fdesc, '%s %d\n' % (socket.gethostname(), os.getpid()))
+        finally:
+            os.close(fdesc)
+        return True
+
+    @staticmethod
+    def is_stale_flagfile(lock_file):
+        """
+        Check if the flagfile was left by a process that is not running anymore
+
+        :param lock_file: flag file use to lock the process
+        :return: True if the process of this host that created the flagfile
+         is dead, False otherwise (or if it can't be checked)
+        """
+        try:
+            with open(lock_file, 'r') as f_obj:
+                owner = f_obj.read().split()
+        except IOError as err:
+            # Removed in between: nothing to clean
+            return err.errno == errno.ENOENT
+        if len(owner) != 2 or owner[0] != socket.gethostname() or \
+           not owner[1].isdigit():
+            return False
+        try:
+            os.kill(int(owner[1]), 0)
+        except OSError as err:
+            return err.errno == errno.ESRCH
+        return False
 
     @staticmethod
     def unlock_flagfile(lock_file):
@@ -584,6 +1087,18 @@ The project is not part of the settings."""
         if os.path.exists(lock_file):
             os.remove(lock_file)
 
+    @staticmethod
+    def get_project_flagfile(project_id, lock_type):
+        """
+        Get the flagfile locking one project for build/update/launch
+
+        :param project_id: project ID on XNAT
+        :param lock_type: 'build', 'update' or 'launch'
+        :return: path to the flagfile
+        """
+        return os.path.join(RESULTS_DIR, 'FlagFiles',
+                            '%s_%s%s' % (project_id, lock_type, PROJECT_LOCK_EXT))
+
     def get_tasks(self, xnat, is_valid_assessor, project_list=None, sessions_local=None):
         """
         Get list of tasks for a projects list
@@ -634,16 +1149,43 @@ The project is not part of the settings."""
 
         # Get lists of assessors for this project
         assr_list = self.get_assessors_list(xnat, project_id, sessions_local)
+        assr_list = [assr_info for assr_info in assr_list
+                     if is_valid_assessor(assr_info)]
+
+        # Ask the cluster once about all the jobs of the project
+        self.cache_cluster_info(assr_list)
 
         # Match each assessor to a processor, get a task, and add to list
         for assr_info in assr_list:
-            if is_valid_assessor(assr_info):
-                cur_task = self.generate_task(xnat, assr_info, sess_procs, scan_procs)
-                if cur_task:
-                    task_list.append(cur_task)
+            cur_task = self.generate_task(xnat, assr_info, sess_procs, scan_procs)
+            if cur_task:
+                task_list.append(cur_task)
 
         return task_list
 
+    @staticmethod
+    def cache_cluster_info(assr_list):
+        """
+        Query the cluster in bulk for the status of the running jobs and the
+         resources used by the finished jobs of the assessors
+
+        :param assr_list: list of assessors info (See XnatUtils.list_assessors)
+        :return: None
+        """
+        running = [assr_info['jobid'] for assr_info in assr_list
+                   if assr_info['procstatus'] == task.JOB_RUNNING]
+        finished = [(assr_info['jobid'], assr_info['jobstartdate'])
+                    for assr_info in assr_list
+                    if assr_info['procstatus'] == task.READY_TO_COMPLETE]
+        if running:
+            LOGGER.debug('getting status of %d jobs from cluster'
+                         % len(running))
+            cluster.cache_jobs_status(running)
+        if finished:
+            LOGGER.debug('getting resources used by %d jobs from cluster'
+                         % len(finished))
+            cluster.cache_jobs_usage(finished)
+
     @staticmethod
     def match_proc(assr_info, sess_proc_list, scan_proc_list):
         """
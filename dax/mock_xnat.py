@@ -0,0 +1,999 @@
+""" mock_xnat.py
+
+In-memory stand-in for an XNAT server serving the REST routes used by dax
+through pyxnat/XnatUtils: the listings (*_URI with columns and csv format),
+the session XML read by CachedImageSession, the PUT of the attributes
+(attrs.set/mset), the resources/files PUT/POST/GET/DELETE, the zip of the
+files of a resource (files?format=zip) and the catalog XML of a resource.
+
+Each request is counted by route. The counts are served on /mock/stats.
+"""
+
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__copyright__ = 'Copyright 2013 Vanderbilt University. All Rights Reserved'
+
+import csv
+import fnmatch
+import json
+import urllib
+import urlparse
+import zipfile
+import StringIO
+import threading
+import SocketServer
+import BaseHTTPServer
+from datetime import datetime, timedelta
+from collections import OrderedDict, defaultdict
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+# Datatypes installed on the mock server
+DATATYPES = ['xnat:projectData', 'xnat:subjectData', 'xnat:imageSessionData',
+             'xnat:mrSessionData', 'xnat:petSessionData', 'xnat:ctSessionData',
+             'xnat:imageScanData', 'xnat:mrScanData', 'xnat:resourceCatalog',
+             'proc:genProcData', 'fs:fsData']
+CANONICAL_TYPES = dict((dtype.lower(), dtype) for dtype in DATATYPES)
+# xsiType given to an element created without one
+DEFAULT_TYPES = {'projects': 'xnat:projectData',
+                 'subjects': 'xnat:subjectData',
+                 'experiments': 'xnat:mrSessionData',
+                 'scans': 'xnat:mrScanData',
+                 'assessors': 'proc:genProcData',
+                 'resources': 'xnat:resourceCatalog',
+                 'out_resources': 'xnat:resourceCatalog',
+                 'in_resources': 'xnat:resourceCatalog'}
+CHILDREN = {'projects': ['subjects', 'resources'],
+            'subjects': ['experiments', 'resources'],
+            'experiments': ['scans', 'assessors', 'resources'],
+            'scans': ['resources'],
+            'assessors': ['out_resources', 'in_resources', 'resources'],
+            'resources': [], 'out_resources': [], 'in_resources': []}
+ID_PREFIX = {'subjects': 'MOCK_S', 'experiments': 'MOCK_E',
+             'assessors': 'MOCK_A'}
+# Prefixes of the columns read from the session for scans/assessors
+SESSION_PREFIXES = ['xnat:imagesessiondata', 'xnat:experimentdata',
+                    'xnat:mrsessiondata', 'xnat:petsessiondata',
+                    'xnat:ctsessiondata']
+XML_NS = ('xmlns:xnat="http://nrg.wustl.edu/xnat" '
+          'xmlns:proc="http://nrg.wustl.edu/proc" '
+          'xmlns:fs="http://nrg.wustl.edu/fs" '
+          'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"')
+XML_TAGS = {'xnat:mrSessionData': 'xnat:MRSession',
+            'xnat:petSessionData': 'xnat:PETSession',
+            'xnat:ctSessionData': 'xnat:CTSession',
+            'proc:genProcData': 'proc:genProcData',
+            'fs:fsData': 'fs:Freesurfer'}
+JSESSION = 'MOCKJSESSIONID0000000000000000'
+
+class MockXnatError(Exception):
+    """Custom exception raised to answer a request with an HTTP error"""
+    def __init__(self, code, message):
+        self.code = code
+        Exception.__init__(self, 'ERROR: %s' % message)
+
+class MockElement(object):
+    """ Element of the XNAT hierarchy (project, subject, session, ...) """
+    __slots__ = ('level', 'ID', 'label', 'xsitype', 'parent', 'fields',
+                 'children', 'files', 'last_modified')
+
+    def __init__(self, level, eid, label, xsitype, parent):
+        """
+        Entry point for the MockElement class
+
+        :param level: collection name in the REST path (e.g. 'experiments')
+        :param eid: ID of the element
+        :param label: label of the element
+        :param xsitype: datatype of the element
+        :param parent: parent MockElement, None for a project
+        :return: None
+        """
+        self.level = level
+        self.ID = eid
+        self.label = label
+        self.xsitype = CANONICAL_TYPES.get(xsitype.lower(), xsitype) \
+                       if xsitype else None
+        self.parent = parent
+        self.fields = dict()
+        self.children = None
+        self.files = None
+        self.last_modified = datetime.now()
+
+    def get_children(self, level):
+        """
+        Children of a collection, created on first use
+
+        :param level: collection name
+        :return: OrderedDict label -> MockElement
+        """
+        if self.children is None:
+            self.children = dict()
+        if level not in self.children:
+            self.children[level] = OrderedDict()
+        return self.children[level]
+
+    def ancestor(self, level):
+        """
+        First ancestor (or self) of a level
+
+        :param level: collection name
+        :return: MockElement or None
+        """
+        element = self
+        while element is not None and element.level != level:
+            element = element.parent
+        return element
+
+    def uri(self):
+        """
+        Full URI of the element
+
+        :return: string
+        """
+        if self.parent is None:
+            return '/data/projects/%s' % self.ID
+        level = self.level
+        if level in ['out_resources', 'in_resources']:
+            level = level.replace('_', '/')
+        return '%s/%s/%s' % (self.parent.uri(), level, self.ID)
+
+class MockXnat(object):
+    """ In-memory XNAT database answering the REST requests """
+    def __init__(self):
+        """
+        Entry point for the MockXnat class
+
+        :return: None
+        """
+        self.lock = threading.RLock()
+        self.projects = OrderedDict()
+        self.by_id = defaultdict(dict)
+        self.counters = defaultdict(int)
+        self.stats = defaultdict(int)
+        self.faults = list()
+
+    ################## Database ##################
+    def add(self, parent, level, label, xsitype=None):
+        """
+        Add an element (or get the existing one)
+
+        :param parent: parent MockElement, None for a project
+        :param level: collection name
+        :param label: label of the element
+        :param xsitype: datatype (default from DEFAULT_TYPES)
+        :return: MockElement
+        """
+        collection = self.projects if parent is None else \
+                     parent.get_children(level)
+        if label in collection:
+            return collection[label]
+        if level == 'projects' or level == 'scans':
+            eid = label
+        else:
+            self.counters[level] += 1
+            eid = '%s%06d' % (ID_PREFIX.get(level, ''), self.counters[level])
+        element = MockElement(level, eid, label,
+                              xsitype or DEFAULT_TYPES.get(level), parent)
+        if level.endswith('resources'):
+            element.files = OrderedDict()
+        collection[label] = element
+        self.by_id[level][eid] = element
+        self.touch(element)
+        return element
+
+    def remove(self, element):
+        """
+        Delete an element
+
+        :param element: MockElement
+        :return: None
+        """
+        collection = self.projects if element.parent is None else \
+                     element.parent.get_children(element.level)
+        collection.pop(element.label, None)
+        self.by_id[element.level].pop(element.ID, None)
+        self.touch(element.parent)
+
+    @staticmethod
+    def touch(element):
+        """
+        Change the last modified date of the session of an element
+
+        :param element: MockElement
+        :return: None
+        """
+        session = element.ancestor('experiments') if element else None
+        if session is not None:
+            session.last_modified = datetime.now()
+
+    def find(self, parent, level, name):
+        """
+        Find an element by label or ID
+
+        :param parent: parent MockElement, None for the projects
+        :param level: collection name
+        :param name: label or ID
+        :return: MockElement or None
+        """
+        collection = self.projects if parent is None else \
+                     parent.get_children(level)
+        if name in collection:
+            return collection[name]
+        element = self.by_id[level].get(name)
+        if element is not None and element.parent is parent:
+            return element
+        return None
+
+    def resolve(self, segments):
+        """
+        Walk the REST path
+
+        :param segments: path split on '/' (without /data)
+        :return: tuple (parent MockElement or None, collection name,
+         element name or None, file name or None)
+        """
+        parent = None
+        index = 0
+        while index < len(segments):
+            level = segments[index]
+            if level in ['out', 'in'] and index+1 < len(segments):
+                index += 1
+                level = level+'_'+segments[index]
+            if level == 'files':
+                fname = '/'.join(segments[index+1:]) or None
+                return parent, level, None, fname
+            if level not in CHILDREN or \
+               (parent is not None and level not in CHILDREN[parent.level]):
+                raise MockXnatError(404, 'unknown path %s' % '/'.join(segments))
+            if index+1 >= len(segments):
+                return parent, level, None, None
+            name = urllib.unquote(segments[index+1])
+            element = self.find(parent, level, name)
+            if index+2 >= len(segments):
+                return parent, level, name, None
+            if element is None:
+                raise MockXnatError(404, '%s %s not found' % (level, name))
+            parent = element
+            index += 2
+        return parent, None, None, None
+
+    ################## Synthetic data ##################
+    def populate(self, nb_sessions, projects=None, scan_types=None,
+                 session_type='xnat:mrSessionData', days_old=30):
+        """
+        Add synthetic sessions: one subject per session, one scan per scan
+         type with a NIFTI resource
+
+        :param nb_sessions: number of sessions per project
+        :param projects: list of project IDs (default: ['BENCH'])
+        :param scan_types: list of scan types (default: ['T1', 'fMRI'])
+        :param session_type: xsiType of the sessions
+        :param days_old: age of the last modification of the sessions
+        :return: None
+        """
+        last_modified = datetime.now()-timedelta(days=days_old)
+        with self.lock:
+            for project_id in projects or ['BENCH']:
+                project = self.add(None, 'projects', project_id)
+                for index in range(nb_sessions):
+                    subject = self.add(project, 'subjects',
+                                       '%s_Subj%06d' % (project_id, index))
+                    subject.fields.update({'gender': 'U', 'handedness': 'U',
+                                           'yob': '1970', 'dob': ''})
+                    session = self.add(subject, 'experiments',
+                                       '%s_Sess%06d' % (project_id, index),
+                                       session_type)
+                    session.fields['modality'] = 'MR'
+                    for scan_id, scan_type in enumerate(scan_types or ['T1', 'fMRI']):
+                        scan = self.add(session, 'scans', str(scan_id+1))
+                        scan.fields.update({'type': scan_type,
+                                            'quality': 'usable',
+                                            'series_description': scan_type,
+                                            'frames': '1'})
+                        resource = self.add(scan, 'resources', 'NIFTI')
+                        resource.fields['format'] = 'NIFTI'
+                        resource.files['image.nii.gz'] = ''
+                    session.last_modified = last_modified
+
+    ################## Requests ##################
+    def count(self, method, segments):
+        """
+        Count a request by route (element names replaced by *)
+
+        :param method: HTTP method
+        :param segments: path split on '/'
+        :return: None
+        """
+        route = list()
+        is_name = False
+        for segment in segments:
+            if segment == 'files' and not is_name:
+                route.append(segment)
+                if len(route) < len(segments):
+                    route.append('*')
+                break
+            route.append('*' if is_name else segment)
+            is_name = not is_name and segment in CHILDREN
+        with self.lock:
+            self.stats['%s /%s' % (method, '/'.join(route))] += 1
+
+    def get_stats(self):
+        """
+        Requests counted since the start or the last reset
+
+        :return: dictionary with 'total' and 'routes'
+        """
+        with self.lock:
+            routes = dict(self.stats)
+        return {'total': sum(routes.values()), 'routes': routes}
+
+    def reset_stats(self):
+        """
+        Reset the request counters
+
+        :return: None
+        """
+        with self.lock:
+            self.stats.clear()
+
+    def fail_next(self, count, code=503):
+        """
+        Answer the next requests with an error, to test the retries
+
+        :param count: number of requests failing
+        :param code: HTTP status code of the errors
+        :return: None
+        """
+        with self.lock:
+            self.faults.extend([code]*count)
+
+    def handle(self, method, path, query, body=''):
+        """
+        Answer a REST request
+
+        :param method: HTTP method
+        :param path: path of the URL
+        :param query: dictionary of the query parameters (single values)
+        :param body: body of the request
+        :return: tuple (content type, content)
+        """
+        segments = [seg for seg in path.split('/') if seg]
+        if segments and segments[0] in ['data', 'REST']:
+            segments = segments[1:]
+        if segments[:1] == ['mock']:
+            return self.handle_mock(method, segments[1:])
+        self.count(method, segments)
+        with self.lock:
+            code = self.faults.pop(0) if self.faults else None
+        if code is not None:
+            raise MockXnatError(code, 'injected failure')
+        if segments == ['JSESSION']:
+            return 'text/plain', JSESSION
+        with self.lock:
+            if segments == ['search', 'elements']:
+                rows = [{'ELEMENT_NAME': dtype, 'PLURAL': dtype+'s'}
+                        for dtype in DATATYPES]
+                return self.format_rows(rows, ['ELEMENT_NAME', 'PLURAL'], query)
+            if segments in [['experiments'], ['archive', 'experiments']]:
+                return self.list_archive(query)
+            if segments[:1] == ['experiments'] and len(segments) > 1:
+                segments = self.experiment_path(segments)
+            if len(segments) == 3 and segments[0] == 'projects' and \
+               segments[2] == 'experiments':
+                return self.list_project_experiments(segments[1], query)
+            parent, level, name, fname = self.resolve(segments)
+            if level == 'files':
+                return self.handle_files(method, parent, fname, query, body)
+            if name is None:
+                if method != 'GET':
+                    raise MockXnatError(405, 'method not allowed on a collection')
+                return self.list_collection(parent, level, query)
+            element = self.find(parent, level, name)
+            if method == 'GET':
+                if element is None:
+                    raise MockXnatError(404, '%s %s not found' % (level, name))
+                return 'text/xml', self.to_xml(element)
+            elif method == 'PUT':
+                if element is None:
+                    element = self.add(parent, level, name, query.get('xsiType'))
+                self.set_fields(element, query)
+                return 'text/plain', element.ID
+            elif method == 'DELETE':
+                if element is not None:
+                    self.remove(element)
+                return 'text/plain', ''
+        raise MockXnatError(405, 'method %s not allowed' % method)
+
+    def handle_mock(self, method, segments):
+        """
+        Answer the requests on /mock (not counted)
+
+        :param method: HTTP method
+        :param segments: path after /mock
+        :return: tuple (content type, content)
+        """
+        if segments == ['stats'] and method == 'GET':
+            return 'application/json', json.dumps(self.get_stats())
+        elif segments == ['reset']:
+            self.reset_stats()
+            return 'application/json', json.dumps({'reset': True})
+        raise MockXnatError(404, 'unknown mock request')
+
+    def experiment_path(self, segments):
+        """
+        Full path of /experiments/ID/... requests
+
+        :param segments: path split on '/'
+        :return: segments from /projects
+        """
+        element = self.by_id['experiments'].get(segments[1]) or \
+                  self.by_id['assessors'].get(segments[1])
+        if element is None:
+            raise MockXnatError(404, 'experiment %s not found' % segments[1])
+        path = list()
+        while element is not None:
+            path = [element.level, element.label] + path
+            element = element.parent
+        return path + segments[2:]
+
+    def set_fields(self, element, query):
+        """
+        Set the attributes given in the query of a PUT
+
+        :param element: MockElement
+        :param query: dictionary of the query parameters
+        :return: None
+        """
+        for key, value in query.items():
+            if key in ['xsiType', 'format', 'allowDataDeletion', 'event_reason',
+                       'inbody', 'overwrite', 'content', 'tags']:
+                if key in ['format', 'content'] and element.files is not None:
+                    element.fields[key] = value
+                continue
+            lkey = key.lower()
+            if '/' in lkey:
+                prefix, attr = lkey.split('/', 1)
+                if ':' in prefix:
+                    lkey = attr
+            if lkey == 'label':
+                continue
+            element.fields[lkey] = value
+        self.touch(element)
+
+    ################## Listings ##################
+    def list_collection(self, parent, level, query):
+        """
+        Rows of the children of an element
+
+        :param parent: parent MockElement (None for projects)
+        :param level: collection name
+        :param query: dictionary of the query parameters
+        :return: tuple (content type, content)
+        """
+        collection = self.projects if parent is None else \
+                     parent.get_children(level)
+        return self.list_elements(collection.values(), level, query)
+
+    def list_project_experiments(self, project_id, query):
+        """
+        Rows of the sessions of a project (/projects/ID/experiments)
+
+        :param project_id: project ID
+        :param query: dictionary of the query parameters
+        :return: tuple (content type, content)
+        """
+        project = self.find(None, 'projects', project_id)
+        if project is None:
+            raise MockXnatError(404, 'project %s not found' % project_id)
+        sessions = [session for subject in project.get_children('subjects').values()
+                    for session in subject.get_children('experiments').values()]
+        return self.list_elements(sessions, 'experiments', query)
+
+    def list_archive(self, query):
+        """
+        Rows of /archive/experiments: sessions, or assessors/scans of the
+         sessions depending on the xsiType and the columns
+
+        :param query: dictionary of the query parameters
+        :return: tuple (content type, content)
+        """
+        xsitype = query.get('xsiType', '').lower()
+        projects = self.projects.values()
+        if query.get('project'):
+            projects = [proj for proj in projects if proj.ID == query['project']]
+        if [key for key in query if key.endswith('sharing/share/project')]:
+            # No data shared between the projects of the mock server
+            projects = list()
+        sessions = [session for project in projects
+                    for subject in project.get_children('subjects').values()
+                    for session in subject.get_children('experiments').values()]
+        if xsitype in ['proc:genprocdata', 'fs:fsdata']:
+            assessors = [assr for session in sessions
+                         for assr in session.get_children('assessors').values()
+                         if assr.xsitype.lower() == xsitype]
+            return self.list_elements(assessors, 'assessors', query, False)
+        return self.list_elements(sessions, 'experiments', query)
+
+    def list_elements(self, elements, level, query, filter_type=True):
+        """
+        Format the rows for a list of elements
+
+        :param elements: list of MockElement
+        :param level: collection name
+        :param query: dictionary of the query parameters
+        :param filter_type: filter the elements on the xsiType of the query
+        :return: tuple (content type, content)
+        """
+        columns = [col for col in query.get('columns', '').split(',') if col]
+        if not columns:
+            columns = ['ID', 'label', 'xsiType', 'URI']
+            if level.endswith('resources'):
+                columns = ['xnat_abstractresource_id', 'label', 'format',
+                           'file_count', 'file_size', 'content', 'URI']
+        else:
+            # XNAT always adds the xsiType and the URI to the listings
+            columns.extend([col for col in ['xsiType', 'URI']
+                            if col not in columns])
+        xsitype = query.get('xsiType', '').lower()
+        if filter_type and xsitype and not xsitype.endswith('imagesessiondata'):
+            elements = [element for element in elements
+                        if element.xsitype.lower() == xsitype]
+        rows = list()
+        for element in elements:
+            rows.extend(self.get_rows(element, columns))
+        # Filters on the columns: rows kept if the value matches one of the
+        #  values, * being a wildcard like on XNAT
+        for key, value in query.items():
+            if '/' in key and not key.endswith('sharing/share/project'):
+                values = value.split(',')
+                rows = [row for row in rows
+                        if [val for val in values
+                            if fnmatch.fnmatchcase(row.get(self.header(key), ''), val)]]
+        return self.format_rows(rows, [self.header(col) for col in columns], query)
+
+    @staticmethod
+    def header(column):
+        """
+        Header of a column as given by XNAT (xpaths in lower case)
+
+        :param column: column requested
+        :return: string
+        """
+        lcol = column.lower()
+        if lcol in ['xnat:imagesessiondata/id', 'xnat:imagesessiondata/label']:
+            return 'session_'+column.rsplit('/', 1)[1].replace('id', 'ID')
+        return lcol if '/' in column else column
+
+    def get_rows(self, element, columns):
+        """
+        Rows for one element: one row per scan / out resource when columns
+         of the scans / out files are requested
+
+        :param element: MockElement
+        :param columns: list of columns
+        :return: list of dictionaries
+        """
+        row = dict((self.header(col), self.get_value(element, col))
+                   for col in columns)
+        scan_cols = [col for col in columns
+                     if col.lower().startswith('xnat:imagescandata/') or
+                     col.lower().startswith('xnat:imagesessiondata/scans/scan/')]
+        file_cols = [col for col in columns if col.lower().endswith('/out/file/label')]
+        rows = [row]
+        if scan_cols and element.level == 'experiments':
+            rows = list()
+            for scan in element.get_children('scans').values():
+                for label in scan.get_children('resources').keys() or ['']:
+                    scan_row = dict(row)
+                    for col in scan_cols:
+                        attr = col.lower().rsplit('/', 1)[1]
+                        if attr == 'label':
+                            scan_row[self.header(col)] = label
+                        else:
+                            scan_row[self.header(col)] = self.get_value(scan, 'xnat:imagescandata/'+attr)
+                    rows.append(scan_row)
+        elif file_cols:
+            labels = element.get_children('out_resources').keys() or ['']
+            rows = list()
+            for label in labels:
+                file_row = dict(row)
+                for col in file_cols:
+                    file_row[self.header(col)] = label
+                rows.append(file_row)
+        return rows
+
+    def get_value(self, element, column):
+        """
+        Value of a column for an element
+
+        :param element: MockElement
+        :param column: column requested
+        :return: string
+        """
+        session = element.ancestor('experiments')
+        subject = element.ancestor('subjects')
+        project = element.ancestor('projects')
+        if column == 'ID' or column == 'xnat_abstractresource_id':
+            return element.ID
+        elif column == 'label':
+            return element.label
+        elif column == 'xsiType':
+            return element.xsitype
+        elif column == 'URI':
+            return element.uri()
+        elif column == 'project':
+            return project.ID
+        elif column in ['subject_ID', 'subject_label']:
+            return subject.ID if column == 'subject_ID' else subject.label
+        elif column in ['session_ID', 'session_label']:
+            return session.ID if column == 'session_ID' else session.label
+        elif column == 'file_count' and element.files is not None:
+            return str(len(element.files))
+        elif column == 'file_size' and element.files is not None:
+            return str(sum(len(content) for content in element.files.values()))
+        elif column in ['Name', 'Size']:
+            return ''
+        lcol = column.lower()
+        if '/' not in lcol:
+            return element.fields.get(lcol, '')
+        prefix, attr = lcol.split('/', 1)
+        if prefix in SESSION_PREFIXES and element.level != 'experiments' and \
+           session is not None:
+            element = session
+        if attr == 'meta/last_modified':
+            return element.last_modified.strftime(DATE_FORMAT)[:-5]
+        elif attr == 'subject_id':
+            return subject.ID if subject else ''
+        elif attr in ['id', 'label']:
+            return element.ID if attr == 'id' else element.label
+        elif attr == 'date' and element.level == 'experiments':
+            return element.fields.get('date', '')
+        return element.fields.get(attr, '')
+
+    @staticmethod
+    def format_rows(rows, headers, query):
+        """
+        Format rows as CSV (pyxnat _get_json) or JSON
+
+        :param rows: list of dictionaries
+        :param headers: list of headers
+        :param query: dictionary of the query parameters
+        :return: tuple (content type, content)
+        """
+        if query.get('format') == 'json':
+            result = {'ResultSet': {'Result': rows, 'totalRecords': str(len(rows))}}
+            return 'application/json', json.dumps(result)
+        output = StringIO.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(headers)
+        for row in rows:
+            writer.writerow([unicode(row.get(header, '')).encode('utf-8')
+                             for header in headers])
+        return 'text/csv', output.getvalue()
+
+    ################## Files ##################
+    def handle_files(self, method, resource, fname, query, body):
+        """
+        Answer the requests on resources/<resource>/files
+
+        :param method: HTTP method
+        :param resource: resource MockElement
+        :param fname: file name or None for the listing
+        :param query: dictionary of the query parameters
+        :param body: body of the request
+        :return: tuple (content type, content)
+        """
+        if resource is None or resource.files is None:
+            raise MockXnatError(404, 'resource not found')
+        if fname is None:
+            if method != 'GET':
+                raise MockXnatError(405, 'method not allowed on files')
+            if query.get('format') == 'zip':
+                return 'application/zip', self.resource_zip(resource)
+            rows = [{'Name': name, 'Size': str(len(content)),
+                     'URI': '%s/files/%s' % (resource.uri(), name),
+                     'collection': resource.label,
+                     'file_content': '', 'file_format': ''}
+                    for name, content in resource.files.items()]
+            return self.format_rows(rows, ['Name', 'Size', 'URI', 'collection',
+                                           'file_content', 'file_format'], query)
+        fname = urllib.unquote(fname)
+        if method == 'GET':
+            if fname not in resource.files:
+                raise MockXnatError(404, 'file %s not found' % fname)
+            return 'application/octet-stream', resource.files[fname]
+        elif method in ['PUT', 'POST']:
+            if query.get('extract') == 'true' and fname.endswith('.zip'):
+                archive = zipfile.ZipFile(StringIO.StringIO(body))
+                for name in archive.namelist():
+                    if not name.endswith('/'):
+                        resource.files[name] = archive.read(name)
+            else:
+                resource.files[fname] = body
+            resource.last_modified = datetime.now()
+            self.touch(resource)
+            return 'text/plain', ''
+        elif method == 'DELETE':
+            resource.files.pop(fname, None)
+            resource.last_modified = datetime.now()
+            self.touch(resource)
+            return 'text/plain', ''
+        raise MockXnatError(405, 'method %s not allowed' % method)
+
+    @staticmethod
+    def resource_zip(resource):
+        """
+        Zip of the files of a resource with the paths given by XNAT:
+         <parent label>/[out/]resources/<resource label>/files/<file>
+
+        :param resource: MockElement of the resource
+        :return: string
+        """
+        level = resource.level.replace('_', '/')
+        prefix = '%s/%s/%s/files/' % (resource.parent.label, level, resource.label)
+        output = StringIO.StringIO()
+        archive = zipfile.ZipFile(output, 'w')
+        for name, content in resource.files.items():
+            archive.writestr(prefix+name, content)
+        archive.close()
+        return output.getvalue()
+
+    ################## XML ##################
+    def to_xml(self, element):
+        """
+        XML document of an element (format read by CachedImageSession)
+
+        :param element: MockElement
+        :return: string
+        """
+        if element.level == 'experiments':
+            return self.session_xml(element)
+        elif element.level == 'assessors':
+            return self.assessor_xml(element, True)
+        elif element.files is not None:
+            return self.catalog_xml(element)
+        tag = element.xsitype.replace('Data', '')
+        return '<%s %s ID="%s" label="%s"/>' % (tag, XML_NS, element.ID,
+                                                escape(element.label))
+
+    def session_xml(self, session):
+        """
+        XML document of a session with its scans and assessors
+
+        :param session: MockElement of the session
+        :return: string
+        """
+        tag = XML_TAGS.get(session.xsitype, 'xnat:MRSession')
+        xml = ['<?xml version="1.0" encoding="UTF-8"?>',
+               '<%s %s ID="%s" project="%s" label="%s" modality="%s" original="%s">'
+               % (tag, XML_NS, session.ID, session.ancestor('projects').ID,
+                  escape(session.label), escape(session.fields.get('modality', '')),
+                  escape(session.fields.get('original', '')))]
+        xml.append('<xnat:subject_ID>%s</xnat:subject_ID>'
+                   % session.ancestor('subjects').ID)
+        xml.extend(self.resources_xml(session.get_children('resources'),
+                                      'xnat:resources', 'xnat:resource'))
+        scans = session.get_children('scans').values()
+        if scans:
+            xml.append('<xnat:scans>')
+            for scan in scans:
+                xml.append('<xnat:scan ID="%s" type="%s" xsi:type="%s">'
+                           % (scan.ID, escape(scan.fields.get('type', '')),
+                              scan.xsitype))
+                xml.extend(self.resources_xml(scan.get_children('resources'),
+                                              None, 'xnat:file'))
+                for attr in ['quality', 'series_description', 'frames', 'note']:
+                    if attr in scan.fields:
+                        xml.append('<xnat:%s>%s</xnat:%s>'
+                                   % (attr, escape(scan.fields[attr]), attr))
+                xml.append('</xnat:scan>')
+            xml.append('</xnat:scans>')
+        assessors = session.get_children('assessors').values()
+        if assessors:
+            xml.append('<xnat:assessors>')
+            xml.extend(self.assessor_xml(assr) for assr in assessors)
+            xml.append('</xnat:assessors>')
+        xml.append('</%s>' % tag)
+        return '\n'.join(xml)
+
+    def assessor_xml(self, assessor, root=False):
+        """
+        XML of an assessor
+
+        :param assessor: MockElement of the assessor
+        :param root: XML document of the assessor alone
+        :return: string
+        """
+        prefix = assessor.xsitype.split(':')[0]
+        if root:
+            xml = ['<%s %s ID="%s" project="%s" label="%s">'
+                   % (XML_TAGS.get(assessor.xsitype, assessor.xsitype), XML_NS,
+                      assessor.ID, assessor.ancestor('projects').ID,
+                      escape(assessor.label))]
+        else:
+            xml = ['<xnat:assessor ID="%s" project="%s" label="%s" xsi:type="%s">'
+                   % (assessor.ID, assessor.ancestor('projects').ID,
+                      escape(assessor.label), assessor.xsitype)]
+        xml.extend(self.resources_xml(assessor.get_children('in_resources'),
+                                      'xnat:in', 'xnat:file'))
+        xml.extend(self.resources_xml(assessor.get_children('out_resources'),
+                                      'xnat:out', 'xnat:file'))
+        for attr, value in sorted(assessor.fields.items()):
+            if attr == 'validation/status':
+                xml.append('<xnat:validation status="%s"/>' % escape(value))
+            elif '/' not in attr:
+                xml.append('<%s:%s>%s</%s:%s>' % (prefix, attr, escape(value),
+                                                  prefix, attr))
+        xml.append('</%s>' % (XML_TAGS.get(assessor.xsitype, assessor.xsitype)
+                              if root else 'xnat:assessor'))
+        return '\n'.join(xml)
+
+    @staticmethod
+    def catalog_xml(resource):
+        """
+        Catalog XML of a resource: one entry per file, all the entries with
+         the last modified date of the resource
+
+        :param resource: MockElement of the resource
+        :return: string
+        """
+        date = resource.last_modified.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
+        xml = ['<cat:Catalog xmlns:cat="http://nrg.wustl.edu/catalog" '
+               'ID="%s" label="%s"><cat:entries>' % (resource.ID, escape(resource.label))]
+        for name in resource.files:
+            xml.append('<cat:entry URI="%s" name="%s" createdTime="%s" modifiedTime="%s"/>'
+                       % (escape(name), escape(name), date, date))
+        xml.append('</cat:entries></cat:Catalog>')
+        return ''.join(xml)
+
+    @staticmethod
+    def resources_xml(resources, parent_tag, tag):
+        """
+        XML of the resources of an element
+
+        :param resources: OrderedDict label -> MockElement
+        :param parent_tag: tag grouping the resources (None for none)
+        :param tag: tag of a resource
+        :return: list of strings
+        """
+        if not resources:
+            return list()
+        xml = ['<%s>' % parent_tag] if parent_tag else list()
+        for resource in resources.values():
+            xml.append('<%s xsi:type="xnat:resourceCatalog" label="%s" '
+                       'format="%s" file_count="%d" URI="%s"/>'
+                       % (tag, escape(resource.label),
+                          escape(resource.fields.get('format', '')),
+                          len(resource.files), resource.uri()))
+        if parent_tag:
+            xml.append('</%s>' % parent_tag)
+        return xml
+
+def escape(value):
+    """
+    Escape a value for XML
+
+    :param value: string
+    :return: escaped string
+    """
+    return value.replace('&', '&amp;').replace('<', '&lt;')\
+                .replace('>', '&gt;').replace('"', '&quot;')
+
+class MockXnatHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ HTTP handler passing the requests to the MockXnat of the server """
+    protocol_version = 'HTTP/1.1'
+    # Buffered writes and no Nagle: one packet per answer on keep-alive
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        """ GET request """
+        self.answer('GET')
+
+    def do_PUT(self):
+        """ PUT request """
+        self.answer('PUT')
+
+    def do_POST(self):
+        """ POST request """
+        self.answer('POST')
+
+    def do_DELETE(self):
+        """ DELETE request """
+        self.answer('DELETE')
+
+    def do_HEAD(self):
+        """ HEAD request """
+        self.answer('HEAD')
+
+    def answer(self, method):
+        """
+        Answer a request
+
+        :param method: HTTP method
+        :return: None
+        """
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            body = self.read_chunks()
+        else:
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else ''
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query, keep_blank_values=True))
+        # Form encoded PUT/POST parameters
+        if body and 'form-urlencoded' in (self.headers.get('Content-Type') or ''):
+            query.update(urlparse.parse_qsl(body, keep_blank_values=True))
+        try:
+            content_type, content = self.server.xnat.handle(
+                'GET' if method == 'HEAD' else method, url.path, query, body)
+            code = 200
+        except MockXnatError as err:
+            content_type, content, code = 'text/plain', str(err), err.code
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        if method != 'HEAD':
+            self.wfile.write(content)
+
+    def read_chunks(self):
+        """
+        Read a body sent with the chunked transfer encoding
+
+        :return: string
+        """
+        chunks = list()
+        while True:
+            size = int(self.rfile.readline().split(';')[0], 16)
+            if size == 0:
+                self.rfile.readline()
+                return ''.join(chunks)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+
+    def log_message(self, *args):
+        """ No log for each request """
+        pass
+
+class MockXnatServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Threaded HTTP server for a MockXnat """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, xnat=None, host='127.0.0.1', port=0):
+        """
+        Entry point for the MockXnatServer class
+
+        :param xnat: MockXnat object (new empty one by default)
+        :param host: interface to listen on
+        :param port: port (0 for a free one)
+        :return: None
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), MockXnatHandler)
+        self.xnat = xnat if xnat is not None else MockXnat()
+        self.thread = None
+
+    @property
+    def url(self):
+        """ URL of the server to use as XNAT_HOST """
+        return 'http://%s:%d' % self.server_address
+
+    def start(self):
+        """
+        Serve in a background thread
+
+        :return: None
+        """
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       name='mock_xnat')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop serving
+
+        :return: None
+        """
+        self.shutdown()
+        self.server_close()
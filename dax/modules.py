@@ -6,8 +6,8 @@ import logging
 import XnatUtils
 from datetime import datetime
 from email.mime.text import MIMEText
-from dax_settings import DAX_Settings
-DAX_SETTINGS = DAX_Settings()
+from dax_settings import get_settings
+DAX_SETTINGS = get_settings()
 SMTP_HOST = DAX_SETTINGS.get_smtp_host()
 SMTP_FROM = DAX_SETTINGS.get_smtp_from()
 SMTP_PASS = DAX_SETTINGS.get_smtp_pass()
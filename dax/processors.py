@@ -12,7 +12,7 @@ class Processor(object):
     """ Base class for processor """
     def __init__(self, walltime_str, memreq_mb, spider_path,
                  version=None, ppn=1, suffix_proc='',
-                 xsitype='proc:genProcData'):
+                 xsitype='proc:genProcData', depends_on=None):
         """
         Entry point of the Base class for processor.
 
@@ -23,6 +23,8 @@ class Processor(object):
         :param ppn: Number of processors per not to use.
         :param suffix_proc: Processor suffix (if desired)
         :param xsitype: the XNAT xsiType.
+        :param depends_on: list of the proctypes of the assessors used as
+         inputs (e.g: ['fMRIQA_v2'] or ['FreeSurfer'] for any version)
         :return: None
 
         """
@@ -47,6 +49,7 @@ class Processor(object):
         self.spider_path = spider_path
         self.ppn = ppn
         self.xsitype = xsitype
+        self.depends_on = depends_on if depends_on else list()
         #getting name and version from spider_path
         self.set_spider_settings(spider_path, version)
         #if suffix_proc is empty, set it to "" for the spider call:
@@ -129,7 +132,7 @@ class Processor(object):
 
 class ScanProcessor(Processor):
     """ Scan Processor class for processor on a scan on XNAT """
-    def __init__(self, scan_types, walltime_str, memreq_mb, spider_path, version=None, ppn=1, suffix_proc=''):
+    def __init__(self, scan_types, walltime_str, memreq_mb, spider_path, version=None, ppn=1, suffix_proc='', depends_on=None):
         """
         Entry point of the ScanProcessor Class.
 
@@ -140,10 +143,12 @@ class ScanProcessor(Processor):
         :param version: Version of the spider (taken from the file name)
         :param ppn: Number of processors per node to request
         :param suffix_proc: Processor suffix
+        :param depends_on: list of the proctypes of the assessors used as inputs
         :return: None
 
         """
-        super(ScanProcessor, self).__init__(walltime_str, memreq_mb, spider_path, version, ppn, suffix_proc)
+        super(ScanProcessor, self).__init__(walltime_str, memreq_mb, spider_path, version, ppn, suffix_proc,
+                                            depends_on=depends_on)
         if isinstance(scan_types, list):
             self.scan_types = scan_types
         elif isinstance(scan_types, str):
@@ -211,7 +216,7 @@ class ScanProcessor(Processor):
 
 class SessionProcessor(Processor):
     """ Session Processor class for processor on a session on XNAT """
-    def __init__(self, walltime_str, memreq_mb, spider_path, version=None, ppn=1, suffix_proc=''):
+    def __init__(self, walltime_str, memreq_mb, spider_path, version=None, ppn=1, suffix_proc='', depends_on=None):
         """
         Entry point for the session processor
 
@@ -221,10 +226,12 @@ class SessionProcessor(Processor):
         :param version: Version of the spider (taken from the file name)
         :param ppn: Number of processors per node to request
         :param suffix_proc: Processor suffix
+        :param depends_on: list of the proctypes of the assessors used as inputs
         :return: None
 
         """
-        super(SessionProcessor, self).__init__(walltime_str, memreq_mb, spider_path, version, ppn, suffix_proc)
+        super(SessionProcessor, self).__init__(walltime_str, memreq_mb, spider_path, version, ppn, suffix_proc,
+                                               depends_on=depends_on)
 
     def has_inputs(self):
         """
@@ -298,3 +305,73 @@ def processors_by_type(proc_list):
             LOGGER.warn('unknown processor type:'+proc)
 
     return sess_proc_list, scan_proc_list
+
+class ProcessorGraph(object):
+    """ Dependency graph between the processors of a project """
+    def __init__(self, proc_list):
+        """
+        Entry point for the ProcessorGraph class
+
+        :param proc_list: List of Processor classes from the DAX settings file
+        :return: None
+
+        """
+        # upstream proctype declared -> names of the processors using it
+        self.downstream = dict()
+        for proc in proc_list:
+            for upstream in proc.depends_on:
+                self.downstream.setdefault(upstream, set()).add(proc.name)
+
+    @staticmethod
+    def is_match(proctype, upstream):
+        """
+        Check if a proctype matches an upstream proctype declared
+
+        :param proctype: proctype of an assessor
+        :param upstream: proctype declared in depends_on, with or without the
+         version
+        :return: True if it matches, False otherwise
+
+        """
+        return proctype == upstream or proctype.startswith(upstream+'_v')
+
+    def get_upstream_proctypes(self):
+        """
+        Get the upstream proctypes declared by the processors
+
+        :return: sorted list of proctypes, with or without the version
+        """
+        return sorted(self.downstream.keys())
+
+    def get_downstream(self, proctype):
+        """
+        Get the processors using the assessors of a proctype as input
+
+        :param proctype: proctype of an assessor
+        :return: set of processors names
+
+        """
+        names = set()
+        for upstream, downstream in self.downstream.items():
+            if self.is_match(proctype, upstream):
+                names.update(downstream)
+        return names
+
+    def is_upstream(self, proctype):
+        """
+        Check if any processor uses the assessors of a proctype as input
+
+        :param proctype: proctype of an assessor
+        :return: True if it is an upstream proctype, False otherwise
+
+        """
+        return len(self.get_downstream(proctype)) > 0
+
+    def is_empty(self):
+        """
+        Check if no processor declared dependencies
+
+        :return: True if no dependencies, False otherwise
+
+        """
+        return len(self.downstream) == 0
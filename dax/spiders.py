@@ -18,12 +18,18 @@ import os
 import re
 import sys
 import time
+import gzip
+import shutil
 import getpass
 import collections
+import multiprocessing
 import subprocess as sb
 from dax import XnatUtils
 from datetime import datetime
 
+# Directory in the jobdir for the uncompressed copies of the .nii.gz
+NIFTI_CACHE_DIR = 'nifti_cache'
+
 class Spider(object):
     """ Base class for spider """
     def __init__(self, spider_path, jobdir, xnat_project, xnat_subject, xnat_session,
@@ -394,7 +400,7 @@ class Spider(object):
 
     def plot_images_page(self, pdf_path, page_index, nii_images, title,
                          image_labels, slices=None, cmap='gray',
-                         vmins=None, vmaxs=None):
+                         vmins=None, vmaxs=None, nifti_cache=False):
         """Plot list of images (3D-4D) on a figure (PDF page).
 
         plot_images_figure will create one pdf page with only images.
@@ -415,8 +421,13 @@ class Spider(object):
             of cmaps for each images with the indices as key
         :param vmins: define vmin for display (dict)
         :param vmaxs: define vmax for display (dict)
+        :param nifti_cache: uncompress the .nii.gz images once in the jobdir
+            so that the slices are read from a memory-mapped file
         :return: pdf path created
 
+        Only the slices displayed are read from the images (mid volume for
+        4D images), the full volumes are never loaded in memory.
+
         E.g for two images:
         images = [imag1, image2]
         slices = {'0':[50, 80, 100, 130],
@@ -430,99 +441,14 @@ class Spider(object):
         vmaxs = {'0':100,
                  '1':150}
         """
-        self.time_writer('INFO: generating pdf page %d with images.'
-                         % page_index)
-        fig = plt.figure(page_index, figsize=(7.5, 10))
-        # Titles:
-        if not isinstance(cmap, dict):
-            default_cmap = cmap
-            cmap = {}
-        else:
-            default_cmap = 'gray'
-        if not isinstance(vmins, dict):
-            self.time_writer("Warning: vmins wasn't a dictionary. \
-Using default.")
-            vmins = {}
-        if not isinstance(vmins, dict):
-            self.time_writer("Warning: vmaxs wasnt' a dictionary. \
-Using default.")
-            vmaxs = {}
-        if isinstance(nii_images, str):
-            nii_images = [nii_images]
-        number_im = len(nii_images)
-        for index, image in enumerate(nii_images):
-            # Open niftis with nibabel
-            f_img = nib.load(image)
-            data = f_img.get_data()
-            if len(data.shape) == 4:
-                data = data[:, :, :, data.shape[3]/2]
-            default_slices = [data.shape[2]/4, data.shape[2]/2,
-                              3*data.shape[2]/4]
-            default_label = 'Line %s' % index
-
-            if slices:
-                if not isinstance(slices, dict):
-                    self.time_writer("Warning: slices wasn't a dictionary. \
-Using default.")
-                    slices = {}
-                self.time_writer('INFO: showing different slices.')
-                li_slices = slices.get(str(index), default_slices)
-                slices_number = len(li_slices)
-                for slice_ind, slice_value in enumerate(li_slices):
-                    ind = slices_number*index+slice_ind+1
-                    ax = fig.add_subplot(number_im, slices_number, ind)
-                    data_z_rot = np.rot90(data[:, :, slice_value])
-                    ax.imshow(data_z_rot,
-                              cmap=cmap.get(str(index), default_cmap),
-                              vmin=vmins.get(str(index), None),
-                              vmax=vmaxs.get(str(index), None))
-                    ax.set_title('Slice %d' % slice_value, fontsize=7)
-                    ax.set_xticks([])
-                    ax.set_yticks([])
-                    if slice_ind == 0:
-                        ax.set_ylabel(image_labels.get(str(index),
-                                      default_label), fontsize=9)
-            else:
-                self.time_writer('INFO: display different plan view \
-(ax/sag/cor) of the mid slice.')
-                ax = fig.add_subplot(number_im, 3, 3*index+1)
-                data_z_rot = np.rot90(data[:, :, data.shape[2]/2])
-                ax.imshow(data_z_rot, cmap=cmap.get(str(index), default_cmap),
-                          vmin=vmins.get(str(index), None),
-                          vmax=vmaxs.get(str(index), None))
-                ax.set_title('Axial', fontsize=7)
-                ax.set_ylabel(image_labels.get(str(index), default_label),
-                              fontsize=9)
-                ax.set_xticks([])
-                ax.set_yticks([])
-                ax = fig.add_subplot(number_im, 3, 3*index+2)
-                data_y_rot = np.rot90(data[:, data.shape[1]/2, :])
-                ax.imshow(data_y_rot, cmap=cmap.get(str(index), default_cmap),
-                          vmin=vmins.get(str(index), None),
-                          vmax=vmaxs.get(str(index), None))
-                ax.set_title('Coronal', fontsize=7)
-                ax.set_axis_off()
-                ax = fig.add_subplot(number_im, 3, 3*index+3)
-                data_x_rot = np.rot90(data[data.shape[0]/2, :, :])
-                ax.imshow(data_x_rot, cmap=cmap.get(str(index), default_cmap),
-                          vmin=vmins.get(str(index), None),
-                          vmax=vmaxs.get(str(index), None))
-                ax.set_title('Sagittal', fontsize=7)
-                ax.set_axis_off()
-
-        fig.tight_layout()
-        date = datetime.now()
-        # Titles page
-        plt.figtext(0.5, 0.985, '-- %s PDF report --' % title,
-                    horizontalalignment='center', fontsize=12)
-        plt.figtext(0.5, 0.02, 'Date: %s -- page %d' % (str(date), page_index),
-                    horizontalalignment='center', fontsize=8)
-        plt.show()
-        fig.savefig(pdf_path, transparent=True, orientation='portrait',
-                    dpi=100)
-        plt.close(fig)
-        return pdf_path
-        
+        cache_dir = None
+        if nifti_cache:
+            cache_dir = os.path.join(self.jobdir, NIFTI_CACHE_DIR)
+        return render_images_page(pdf_path, page_index, nii_images, title,
+                                  image_labels, slices=slices, cmap=cmap,
+                                  vmins=vmins, vmaxs=vmaxs, cache_dir=cache_dir,
+                                  time_writer=self.time_writer)
+
     def plot_stats_page(self, pdf_path, page_index, stats_dict, title,
                         tables_number=3, columns_header=['Header', 'Value'],
                         limit_size_text_column1=30,
@@ -546,49 +472,54 @@ Using default.")
         :param limit_size_text_column2: limit of text display in column 2
         :return: pdf path created
         """
-        self.time_writer('INFO: generating pdf page %d with stats.'
-                         % page_index)
-        cell_text = list()
-        for key, value in stats_dict.items():
-            txt = smaller_str(key.strip().replace('"', ''),
-                              size=limit_size_text_column1)
-            val = smaller_str(str(value),
-                              size=limit_size_text_column2)
-            cell_text.append([txt, "%s" % val])
-
-        # Make the table
-        fig = plt.figure(page_index, figsize=(7.5, 10))
-        nb_stats = len(stats_dict.keys())
-        for i in range(tables_number):
-            ax = fig.add_subplot(1, tables_number, i+1)
-            ax.xaxis.set_visible(False)
-            ax.yaxis.set_visible(False)
-            ax.axis('off')
-            the_table = ax.table(
-                    cellText=cell_text[nb_stats/3*i:nb_stats/3*(i+1)],
-                    colColours=[(0.8, 0.4, 0.4), (1.0, 1.0, 0.4)],
-                    colLabels=columns_header,
-                    colWidths=[0.8, 0.32],
-                    loc='center',
-                    rowLoc='left',
-                    colLoc='left',
-                    cellLoc='left')
-
-            the_table.auto_set_font_size(False)
-            the_table.set_fontsize(6)
-
-        # Set footer and title
-        date = datetime.now()
-        plt.figtext(0.5, 0.985, '-- %s PDF report --' % title,
-                    horizontalalignment='center', fontsize=12)
-        plt.figtext(0.5, 0.02, 'Date: %s -- page %d' % (str(date), page_index),
-                    horizontalalignment='center', fontsize=8)
-        plt.show()
-        fig.savefig(pdf_path, transparent=True, orientation='portrait',
-                    dpi=300)
-        plt.close(fig)
-        return pdf_path
-        
+        return render_stats_page(pdf_path, page_index, stats_dict, title,
+                                 tables_number=tables_number,
+                                 columns_header=columns_header,
+                                 limit_size_text_column1=limit_size_text_column1,
+                                 limit_size_text_column2=limit_size_text_column2,
+                                 time_writer=self.time_writer)
+
+    def plot_pdf_pages(self, pages, pdf_final=None, processes=None):
+        """Render several PDF pages in a pool of processes.
+
+        Each page is a tuple (kind, kwargs) with kind 'images' or 'stats' and
+        kwargs the arguments of plot_images_page or plot_stats_page:
+          pages = [('images', {'pdf_path': page1, 'page_index': 1, ...}),
+                   ('stats', {'pdf_path': page2, 'page_index': 2, ...})]
+
+        :param pages: python list of pages to render
+        :param pdf_final: final PDF path to merge the pages into (optional)
+        :param processes: number of processes (default: one per page up to
+            the number of cpus)
+        :return: pdf_final if set, list of pdf pages created otherwise
+        """
+        jobs = list()
+        for kind, kwargs in pages:
+            if kind not in PAGE_RENDERERS:
+                raise Exception('Wrong kind of page %s (images or stats).'
+                                % kind)
+            kwargs = dict(kwargs)
+            if kind == 'images' and kwargs.pop('nifti_cache', False):
+                kwargs['cache_dir'] = os.path.join(self.jobdir, NIFTI_CACHE_DIR)
+            kwargs['time_writer'] = self.time_writer
+            jobs.append((kind, kwargs))
+        if processes is None:
+            processes = min(len(jobs), multiprocessing.cpu_count())
+        self.time_writer('INFO: rendering %d pdf pages with %d processes.'
+                         % (len(jobs), max(1, processes)))
+        if processes > 1 and len(jobs) > 1:
+            pool = multiprocessing.Pool(processes)
+            try:
+                pdf_pages = pool.map(render_page, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            pdf_pages = [render_page(job) for job in jobs]
+        if pdf_final:
+            return self.merge_pdf_pages(pdf_pages, pdf_final)
+        return pdf_pages
+
     def merge_pdf_pages(self, pdf_pages, pdf_final):
         """Concatenate all pdf pages in the list into a final pdf.
 
@@ -596,23 +527,27 @@ Using default.")
         with each page specify by a number:
           pdf_pages = {'1': pdf_page1, '2': pdf_page2}
 
+        The pages are merged in-process with PyPDF2 when it is installed,
+        with ghostscript otherwise.
+
         :param pdf_pages: python list or dictionary of pdf page path
         :param pdf_final: final PDF path
         :return: pdf path created
         """
         self.time_writer('INFO: Concatenate all pdfs pages.')
-        pages = ''
         if isinstance(pdf_pages, dict):
-            for order, page in sorted(pdf_pages):
-                pages += '%s %s ' % (pages, page)
-        elif isinstance(pdf_pages, list):
-            pages = ' '.join(pdf_pages)
-        else:
+            pdf_pages = [pdf_pages[order] for order in
+                         sorted(pdf_pages, key=lambda order: int(order))]
+        elif not isinstance(pdf_pages, list):
             raise Exception('Wrong type for pdf_pages (list or dict).')
-        cmd = 'gs -q -sPAPERSIZE=letter -dNOPAUSE -dBATCH \
-    -sDEVICE=pdfwrite -sOutputFile=%s %s' % (pdf_final, pages)
-        self.time_writer('INFO:saving final PDF: %s ' % cmd)
-        self.run_system_cmd(cmd)
+        if get_pdf_merger() is not None:
+            self.time_writer('INFO:saving final PDF: %s ' % pdf_final)
+            merge_pdfs(pdf_pages, pdf_final)
+        else:
+            cmd = 'gs -q -sPAPERSIZE=letter -dNOPAUSE -dBATCH \
+    -sDEVICE=pdfwrite -sOutputFile=%s %s' % (pdf_final, ' '.join(pdf_pages))
+            self.time_writer('INFO:saving final PDF: %s ' % cmd)
+            self.run_system_cmd(cmd)
         return pdf_final
 
     @staticmethod
@@ -871,6 +806,286 @@ def get_scan_argparser(name, description):
     ap.add_argument('-c', dest='scan_label', help='Scan label', required=True)
     return ap
 
+def get_uncompressed_nifti(image, cache_dir):
+    """
+    Uncompressed copy of a .nii.gz in cache_dir (written once, reused while
+     newer than the image) that nibabel can memory-map
+
+    :param image: path to the .nii.gz
+    :param cache_dir: directory for the uncompressed copies
+    :return: path to the .nii
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    nii_path = os.path.join(cache_dir, os.path.basename(image)[:-3])
+    if not os.path.isfile(nii_path) or \
+       os.path.getmtime(nii_path) < os.path.getmtime(image):
+        with open(nii_path+'.tmp', 'wb') as f_out:
+            f_in = gzip.open(image, 'rb')
+            try:
+                shutil.copyfileobj(f_in, f_out, 1024*1024)
+            finally:
+                f_in.close()
+        os.rename(nii_path+'.tmp', nii_path)
+    return nii_path
+
+def load_nifti(image, cache_dir=None):
+    """
+    Open a nifti image without reading its data
+
+    :param image: path to the nifti image
+    :param cache_dir: directory to uncompress .nii.gz images (see
+        get_uncompressed_nifti). Default: read the .nii.gz directly.
+    :return: nibabel image
+    """
+    import nibabel as nib
+    if cache_dir and image.endswith('.nii.gz'):
+        image = get_uncompressed_nifti(image, cache_dir)
+    return nib.load(image)
+
+def get_nifti_slice(nii, axis, index, volume=None):
+    """
+    Read one 2D slice of a 3D/4D nifti through the nibabel array proxy
+     (only the bytes of the slice are read for uncompressed images)
+
+    :param nii: nibabel image from load_nifti
+    :param axis: axis of the slice (0: sagittal, 1: coronal, 2: axial)
+    :param index: index of the slice on the axis
+    :param volume: volume for a 4D image (default: the mid volume)
+    :return: numpy 2D array
+    """
+    import numpy as np
+    slicer = [slice(None)]*3
+    slicer[axis] = index
+    if len(nii.shape) == 4:
+        slicer.append(nii.shape[3]/2 if volume is None else volume)
+    return np.asarray(nii.dataobj[tuple(slicer)])
+
+def get_pyplot():
+    """
+    matplotlib.pyplot with the non-interactive Agg backend (set only if
+     pyplot was not imported before, e.g. by the spider itself)
+
+    :return: matplotlib.pyplot module
+    """
+    import matplotlib
+    if 'matplotlib.pyplot' not in sys.modules:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+def render_images_page(pdf_path, page_index, nii_images, title, image_labels,
+                       slices=None, cmap='gray', vmins=None, vmaxs=None,
+                       cache_dir=None, time_writer=None):
+    """
+    Plot list of images (3D-4D) on a PDF page (see Spider.plot_images_page)
+
+    :param pdf_path: path to the pdf to save this figure to
+    :param page_index: page index for PDF
+    :param nii_images: python list of nifty images
+    :param title: Title for the report page
+    :param image_labels: list of titles for each images
+    :param slices: dictionary of list of slices to display
+    :param cmap: cmap to use to display images or dict of cmaps
+    :param vmins: define vmin for display (dict)
+    :param vmaxs: define vmax for display (dict)
+    :param cache_dir: directory to uncompress the .nii.gz images
+    :param time_writer: TimedWriter to print the messages
+    :return: pdf path created
+    """
+    import numpy as np
+    plt = get_pyplot()
+    if time_writer is None:
+        time_writer = TimedWriter()
+    time_writer('INFO: generating pdf page %d with images.' % page_index)
+    fig = plt.figure(page_index, figsize=(7.5, 10))
+    # Titles:
+    if not isinstance(cmap, dict):
+        default_cmap = cmap
+        cmap = {}
+    else:
+        default_cmap = 'gray'
+    if not isinstance(vmins, dict):
+        time_writer("Warning: vmins wasn't a dictionary. Using default.")
+        vmins = {}
+    if not isinstance(vmaxs, dict):
+        time_writer("Warning: vmaxs wasnt' a dictionary. Using default.")
+        vmaxs = {}
+    if isinstance(nii_images, str):
+        nii_images = [nii_images]
+    number_im = len(nii_images)
+    for index, image in enumerate(nii_images):
+        # Open niftis with nibabel (header only, data read by slice)
+        f_img = load_nifti(image, cache_dir)
+        shape = f_img.shape
+        default_slices = [shape[2]/4, shape[2]/2, 3*shape[2]/4]
+        default_label = 'Line %s' % index
+
+        if slices:
+            if not isinstance(slices, dict):
+                time_writer("Warning: slices wasn't a dictionary. \
+Using default.")
+                slices = {}
+            time_writer('INFO: showing different slices.')
+            li_slices = slices.get(str(index), default_slices)
+            slices_number = len(li_slices)
+            for slice_ind, slice_value in enumerate(li_slices):
+                ind = slices_number*index+slice_ind+1
+                ax = fig.add_subplot(number_im, slices_number, ind)
+                data_z_rot = np.rot90(get_nifti_slice(f_img, 2, slice_value))
+                ax.imshow(data_z_rot,
+                          cmap=cmap.get(str(index), default_cmap),
+                          vmin=vmins.get(str(index), None),
+                          vmax=vmaxs.get(str(index), None))
+                ax.set_title('Slice %d' % slice_value, fontsize=7)
+                ax.set_xticks([])
+                ax.set_yticks([])
+                if slice_ind == 0:
+                    ax.set_ylabel(image_labels.get(str(index),
+                                  default_label), fontsize=9)
+        else:
+            time_writer('INFO: display different plan view \
+(ax/sag/cor) of the mid slice.')
+            ax = fig.add_subplot(number_im, 3, 3*index+1)
+            data_z_rot = np.rot90(get_nifti_slice(f_img, 2, shape[2]/2))
+            ax.imshow(data_z_rot, cmap=cmap.get(str(index), default_cmap),
+                      vmin=vmins.get(str(index), None),
+                      vmax=vmaxs.get(str(index), None))
+            ax.set_title('Axial', fontsize=7)
+            ax.set_ylabel(image_labels.get(str(index), default_label),
+                          fontsize=9)
+            ax.set_xticks([])
+            ax.set_yticks([])
+            ax = fig.add_subplot(number_im, 3, 3*index+2)
+            data_y_rot = np.rot90(get_nifti_slice(f_img, 1, shape[1]/2))
+            ax.imshow(data_y_rot, cmap=cmap.get(str(index), default_cmap),
+                      vmin=vmins.get(str(index), None),
+                      vmax=vmaxs.get(str(index), None))
+            ax.set_title('Coronal', fontsize=7)
+            ax.set_axis_off()
+            ax = fig.add_subplot(number_im, 3, 3*index+3)
+            data_x_rot = np.rot90(get_nifti_slice(f_img, 0, shape[0]/2))
+            ax.imshow(data_x_rot, cmap=cmap.get(str(index), default_cmap),
+                      vmin=vmins.get(str(index), None),
+                      vmax=vmaxs.get(str(index), None))
+            ax.set_title('Sagittal', fontsize=7)
+            ax.set_axis_off()
+
+    fig.tight_layout()
+    date = datetime.now()
+    # Titles page
+    plt.figtext(0.5, 0.985, '-- %s PDF report --' % title,
+                horizontalalignment='center', fontsize=12)
+    plt.figtext(0.5, 0.02, 'Date: %s -- page %d' % (str(date), page_index),
+                horizontalalignment='center', fontsize=8)
+    fig.savefig(pdf_path, transparent=True, orientation='portrait', dpi=100)
+    plt.close(fig)
+    return pdf_path
+
+def render_stats_page(pdf_path, page_index, stats_dict, title,
+                      tables_number=3, columns_header=['Header', 'Value'],
+                      limit_size_text_column1=30, limit_size_text_column2=10,
+                      time_writer=None):
+    """
+    Display a dictionary of stats on a PDF page (see Spider.plot_stats_page)
+
+    :param pdf_path: path to the pdf to save this figure to
+    :param page_index: page index for PDF
+    :param stats_dict: python dictionary of key=value to display
+    :param title: Title for the report page
+    :param tables_number: number of columns to display (def:3)
+    :param columns_header: list of header for the column
+    :param limit_size_text_column1: limit of text display in column 1
+    :param limit_size_text_column2: limit of text display in column 2
+    :param time_writer: TimedWriter to print the messages
+    :return: pdf path created
+    """
+    plt = get_pyplot()
+    if time_writer is None:
+        time_writer = TimedWriter()
+    time_writer('INFO: generating pdf page %d with stats.' % page_index)
+    cell_text = list()
+    for key, value in stats_dict.items():
+        txt = smaller_str(key.strip().replace('"', ''),
+                          size=limit_size_text_column1)
+        val = smaller_str(str(value), size=limit_size_text_column2)
+        cell_text.append([txt, "%s" % val])
+
+    # Make the table
+    fig = plt.figure(page_index, figsize=(7.5, 10))
+    nb_stats = len(stats_dict.keys())
+    for i in range(tables_number):
+        ax = fig.add_subplot(1, tables_number, i+1)
+        ax.xaxis.set_visible(False)
+        ax.yaxis.set_visible(False)
+        ax.axis('off')
+        the_table = ax.table(
+                cellText=cell_text[nb_stats/3*i:nb_stats/3*(i+1)],
+                colColours=[(0.8, 0.4, 0.4), (1.0, 1.0, 0.4)],
+                colLabels=columns_header,
+                colWidths=[0.8, 0.32],
+                loc='center',
+                rowLoc='left',
+                colLoc='left',
+                cellLoc='left')
+
+        the_table.auto_set_font_size(False)
+        the_table.set_fontsize(6)
+
+    # Set footer and title
+    date = datetime.now()
+    plt.figtext(0.5, 0.985, '-- %s PDF report --' % title,
+                horizontalalignment='center', fontsize=12)
+    plt.figtext(0.5, 0.02, 'Date: %s -- page %d' % (str(date), page_index),
+                horizontalalignment='center', fontsize=8)
+    fig.savefig(pdf_path, transparent=True, orientation='portrait', dpi=300)
+    plt.close(fig)
+    return pdf_path
+
+# Renderers of the pages for Spider.plot_pdf_pages
+PAGE_RENDERERS = {'images': render_images_page,
+                  'stats': render_stats_page}
+
+def render_page(page):
+    """
+    Render one page in a worker of Spider.plot_pdf_pages
+
+    :param page: tuple (kind, kwargs) with kind a key of PAGE_RENDERERS
+    :return: pdf path created
+    """
+    kind, kwargs = page
+    return PAGE_RENDERERS[kind](**kwargs)
+
+def get_pdf_merger():
+    """
+    PdfFileMerger class of PyPDF2 if installed (optional dependency)
+
+    :return: PdfFileMerger class or None
+    """
+    try:
+        from PyPDF2 import PdfFileMerger
+    except ImportError:
+        return None
+    return PdfFileMerger
+
+def merge_pdfs(pdf_pages, pdf_final):
+    """
+    Concatenate pdf files in-process with PyPDF2
+
+    :param pdf_pages: python list of pdf paths in order
+    :param pdf_final: final PDF path
+    :return: pdf path created
+    """
+    merger = get_pdf_merger()()
+    try:
+        for page in pdf_pages:
+            merger.append(page)
+        with open(pdf_final, 'wb') as f_obj:
+            merger.write(f_obj)
+    finally:
+        merger.close()
+    return pdf_final
+
 def smaller_str(str_option, size=10, end=False):
     """Method to shorten a string into a smaller size.
 
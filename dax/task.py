@@ -7,8 +7,8 @@ from datetime import date
 import cluster
 from cluster import PBS
 
-from dax_settings import DAX_Settings
-DAX_SETTINGS = DAX_Settings()
+from dax_settings import get_settings
+DAX_SETTINGS = get_settings()
 RESULTS_DIR = DAX_SETTINGS.get_results_dir()
 DEFAULT_EMAIL_OPTS = DAX_SETTINGS.get_email_opts()
 JOB_EXTENSION_FILE = DAX_SETTINGS.get_job_extension_file()
@@ -86,6 +86,8 @@ class Task(object):
         # Cache for convenience
         self.assessor_id = assessor.id()
         self.assessor_label = assessor.label()
+        # Set by update_status
+        self.status_changed = False
 
     def get_processor_name(self):
         """
@@ -351,6 +353,7 @@ class Task(object):
         else:
             LOGGER.warn('   * unknown status for '+self.assessor_label+': '+old_status)
 
+        self.status_changed = new_status != old_status
         if new_status != old_status:
             LOGGER.info('   * changing status from '+old_status+' to '+new_status)
 
@@ -0,0 +1,43 @@
+from unittest import TestCase
+
+from dax import cluster
+
+class TestClusterBackends(TestCase):
+    def test_memory_in_kb(self):
+        self.assertEqual(cluster.get_memory_in_kb('2048K'), '2048')
+        self.assertEqual(cluster.get_memory_in_kb('1.5M'), '1536')
+        self.assertEqual(cluster.get_memory_in_kb('100kb'), '100')
+        self.assertEqual(cluster.get_memory_in_kb(''), '')
+
+    def test_parse_jobid(self):
+        self.assertEqual(cluster.SLURMBackend().parse_jobid(
+            'Submitted batch job 1234\n'), '1234')
+        self.assertEqual(cluster.PBSBackend().parse_jobid(
+            '1234.vmpsched\n'), '1234')
+        self.assertEqual(cluster.SGEBackend().parse_jobid(
+            'Your job 1234 ("test") has been submitted'), '1234')
+
+    def test_job_cache(self):
+        cache = cluster.JobCache(timeout=60)
+        cache.update({'1': 'R', '2': None})
+        self.assertEqual(cache.get('1'), 'R')
+        self.assertEqual(cache.get('2'), None)
+
+    def test_abstract_backend(self):
+        self.assertRaises(TypeError, cluster.ClusterBackend)
+        cluster.TemplateBackend()
+
+    def test_slurm_usage(self):
+        run_cmd = cluster.run_cmd
+        cmds = list()
+        def sacct(cmd):
+            cmds.append(cmd)
+            return 0, '1234|0|01:00:00|node1\n1234.batch|2048K|01:00:00|node1\n', ''
+        cluster.run_cmd = sacct
+        try:
+            usages = cluster.SLURMBackend().jobs_usage(['1234'], 1)
+        finally:
+            cluster.run_cmd = run_cmd
+        self.assertIn('JobID,MaxRSS,Elapsed,NodeList', cmds[0])
+        self.assertEqual(usages['1234'], {'mem_used': '2048', 'walltime_used': '01:00:00',
+                                          'jobnode': 'node1'})
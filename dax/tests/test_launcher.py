@@ -0,0 +1,128 @@
+import os
+import socket
+import shutil
+import tempfile
+from unittest import TestCase
+
+from dax import cluster, launcher
+from dax.launcher import Launcher
+
+class TestFlagFiles(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.flagfile = os.path.join(self.tmp_dir, 'PROJ_build.lock')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_lock(self):
+        self.assertTrue(Launcher.lock_flagfile(self.flagfile))
+        self.assertFalse(Launcher.lock_flagfile(self.flagfile))
+        with open(self.flagfile) as f_obj:
+            self.assertEqual(f_obj.read().split(),
+                             [socket.gethostname(), str(os.getpid())])
+        Launcher.unlock_flagfile(self.flagfile)
+        self.assertTrue(Launcher.lock_flagfile(self.flagfile))
+
+    def test_stale_lock(self):
+        # PID of a process that is done
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        with open(self.flagfile, 'w') as f_obj:
+            f_obj.write('%s %d\n' % (socket.gethostname(), pid))
+        self.assertTrue(Launcher.lock_flagfile(self.flagfile))
+
+    def test_removed_lock(self):
+        # Flag file removed by its owner between the checks
+        open(self.flagfile, 'w').close()
+        is_stale_flagfile = Launcher.is_stale_flagfile
+        def removed(lock_file):
+            os.remove(lock_file)
+            return is_stale_flagfile(lock_file)
+        Launcher.is_stale_flagfile = staticmethod(removed)
+        try:
+            self.assertTrue(Launcher.lock_flagfile(self.flagfile))
+        finally:
+            Launcher.is_stale_flagfile = staticmethod(is_stale_flagfile)
+        # One guard for all the flag files of the folder
+        self.assertTrue(Launcher.lock_flagfile(self.flagfile+'2'))
+        self.assertFalse(Launcher.lock_flagfile(self.flagfile+'2'))
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+                         ['.flagfiles.guard', 'PROJ_build.lock', 'PROJ_build.lock2'])
+
+    def test_legacy_lock(self):
+        # Empty flag files from older versions are never removed
+        open(self.flagfile, 'w').close()
+        self.assertFalse(Launcher.lock_flagfile(self.flagfile))
+
+class FakeTask(object):
+    assessor_label = 'PROJ-x-Subj-x-Sess-x-Proc_v1'
+
+    def __init__(self):
+        self.launched = False
+
+    def launch(self, *args):
+        self.launched = True
+        return True
+
+class TestLaunchTasks(TestCase):
+    def setUp(self):
+        self.count_jobs = cluster.count_jobs
+        self.launcher = Launcher.__new__(Launcher)
+        self.launcher.queue_limit = 10
+        self.launcher.root_job_dir = self.launcher.job_email = None
+        self.launcher.job_email_options = self.launcher.xnat_host = None
+
+    def tearDown(self):
+        cluster.count_jobs = self.count_jobs
+
+    def test_no_job_count(self):
+        def count_jobs():
+            raise cluster.ClusterCountJobsException()
+        cluster.count_jobs = count_jobs
+        task = FakeTask()
+        self.launcher.launch_tasks([task])
+        self.assertFalse(task.launched)
+
+    def test_launch(self):
+        cluster.count_jobs = lambda: 0
+        task = FakeTask()
+        self.launcher.launch_tasks([task])
+        self.assertTrue(task.launched)
+
+class TestRebuildQueue(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmp_dir, 'FlagFiles'))
+        self.results_dir = launcher.RESULTS_DIR
+        launcher.RESULTS_DIR = self.tmp_dir
+        self.launcher = Launcher.__new__(Launcher)
+        self.launcher.project_process_dict = {'PROJ': []}
+        self.launcher.project_modules_dict = {'PROJ': []}
+        self.launcher.max_age = 7
+        self.launcher.module_prerun = lambda *args: None
+        self.launcher.has_new_processors = lambda *args: False
+        self.launcher.get_sessions_to_rebuild = lambda *args: set(['Sess1', 'Sess2'])
+        self.launcher.get_sessions_list = lambda *args: [
+            {'label': label, 'last_modified': '2016-01-01 00:00:00'}
+            for label in ['Sess1', 'Sess2']]
+        self.launcher.get_lastupdated = lambda sess_info: None
+
+    def tearDown(self):
+        launcher.RESULTS_DIR = self.results_dir
+        shutil.rmtree(self.tmp_dir)
+
+    def test_failed_build(self):
+        built = list()
+        def update_session(xnat, sess_info, *args):
+            if sess_info['label'] == 'Sess2':
+                raise ValueError('build failed')
+            built.append(sess_info['label'])
+        self.launcher.update_session = update_session
+        self.assertRaises(ValueError, self.launcher.build_project,
+                          None, 'PROJ', 'settings', None)
+        self.assertEqual(built, ['Sess1'])
+        self.assertEqual(Launcher.pop_sessions_rebuild('settings', 'PROJ'),
+                         set(['Sess2']))
@@ -0,0 +1,95 @@
+import StringIO
+from unittest import TestCase
+
+from dax import XnatUtils
+from dax.mock_xnat import MockXnat, MockXnatServer
+
+class TestMockXnat(TestCase):
+    def setUp(self):
+        self.mock = MockXnat()
+        self.mock.populate(3, scan_types=['T1'])
+        self.server = MockXnatServer(self.mock)
+        self.server.start()
+        self.intf = XnatUtils.get_interface(self.server.url, 'user', 'pass')
+
+    def tearDown(self):
+        self.intf.disconnect()
+        # Close the kept-alive connections served by the handler threads
+        self.intf._http.close()
+        self.server.stop()
+
+    def test_listings(self):
+        sessions = XnatUtils.list_sessions(self.intf, 'BENCH')
+        self.assertEqual(len(sessions), 3)
+        scans = XnatUtils.list_project_scans(self.intf, 'BENCH')
+        self.assertEqual(sorted(scan['scan_type'] for scan in scans), ['T1']*3)
+        self.assertEqual(scans[0]['resources'], ['NIFTI'])
+
+    def test_assessor(self):
+        sess = XnatUtils.list_sessions(self.intf, 'BENCH')[0]
+        label = 'BENCH-x-%s-x-%s-x-Proc_v1' % (sess['subject_label'], sess['label'])
+        assessor = XnatUtils.select_obj(self.intf, 'BENCH', sess['subject_label'],
+                                        sess['label'], assessor_id=label)
+        assessor.create(assessors='proc:genProcData')
+        assessor.attrs.mset({'proc:genProcData/proctype': 'Proc_v1',
+                             'proc:genProcData/procstatus': 'NEED_TO_RUN'})
+        assessors = XnatUtils.list_project_assessors(self.intf, 'BENCH')
+        self.assertEqual([(assr['label'], assr['procstatus']) for assr in assessors],
+                         [(label, 'NEED_TO_RUN')])
+        csess = XnatUtils.CachedImageSession(self.intf, 'BENCH',
+                                             sess['subject_label'], sess['label'])
+        self.assertEqual([assr.info()['proctype'] for assr in csess.assessors()],
+                         ['Proc_v1'])
+        self.assertGreater(self.mock.get_stats()['total'], 0)
+
+    def test_request_pool(self):
+        sessions = XnatUtils.list_sessions(self.intf, 'BENCH')
+        with XnatUtils.XnatRequestPool(self.intf, 4) as pool:
+            results = [pool.list_scans('BENCH', sess['subject_label'], sess['label'])
+                       for sess in sessions]
+            scans = [result.get() for result in results]
+            self.assertEqual([len(scan_list) for scan_list in scans], [1, 1, 1])
+            self.assertEqual(pool.get_attrs(scans[0][0], ['xnat:mrScanData/type']).get(),
+                             ['T1'])
+
+    def test_listing_filters(self):
+        scans = XnatUtils.list_project_scans(
+            self.intf, 'BENCH', filters={'xnat:imagescandata/type': ['T1']})
+        self.assertEqual(len(scans), 3)
+        scans = XnatUtils.list_project_scans(
+            self.intf, 'BENCH', filters={'xnat:imagescandata/type': ['DTI']})
+        self.assertEqual(scans, [])
+        assessors = XnatUtils.list_project_assessors(
+            self.intf, 'BENCH', filters={'procstatus': ['COMPLETE']})
+        self.assertEqual(assessors, [])
+
+    def test_request_governor(self):
+        governor = XnatUtils.RequestGovernor(failure_threshold=3, open_seconds=0.2)
+        self.intf.governor = governor
+        self.intf._http.mount('http://', XnatUtils.GovernedHTTPAdapter(governor, backoff_base=0.01))
+        # Retried until XNAT answers, through the open circuit
+        self.mock.fail_next(4)
+        self.assertEqual(len(XnatUtils.list_sessions(self.intf, 'BENCH')), 3)
+        self.assertFalse(governor.is_open())
+        self.assertLess(governor.rate, governor.max_rate)
+
+    def test_request_governor_streamed_body(self):
+        governor = XnatUtils.RequestGovernor()
+        self.intf._http.mount('http://', XnatUtils.GovernedHTTPAdapter(governor, backoff_base=0.01))
+        scan = XnatUtils.list_project_scans(self.intf, 'BENCH')[0]
+        uri = '%s/data/projects/BENCH/subjects/%s/experiments/%s/scans/%s/resources/NIFTI/files/%s' \
+              % (self.server.url, scan['subject_label'], scan['session_label'], scan['ID'], '%s')
+        # A str body is sent again after the failure
+        self.mock.fail_next(1)
+        response = self.intf._http.put(uri % 'str.txt', data='content')
+        self.assertEqual(response.status_code, 200)
+        # A streamed body is consumed by the first attempt: not retried
+        self.mock.fail_next(1)
+        response = self.intf._http.put(uri % 'stream.txt', data=StringIO.StringIO('content'))
+        self.assertEqual(response.status_code, 503)
+        self.mock.fail_next(1)
+        response = self.intf._http.put(uri % 'chunks.txt', data=iter(['con', 'tent']))
+        self.assertEqual(response.status_code, 503)
+        response = self.intf._http.put(uri % 'chunks.txt', data=iter(['con', 'tent']))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.intf._http.get(uri % 'chunks.txt').content, 'content')
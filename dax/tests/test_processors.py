@@ -0,0 +1,23 @@
+from unittest import TestCase
+
+from dax.processors import ProcessorGraph
+
+class FakeProcessor(object):
+    def __init__(self, name, depends_on=None):
+        self.name = name
+        self.depends_on = depends_on or list()
+
+class TestProcessorGraph(TestCase):
+    def test_downstream(self):
+        graph = ProcessorGraph([FakeProcessor('fMRIQA_v2'),
+                                FakeProcessor('fMRI_stats_v1', ['fMRIQA_v2']),
+                                FakeProcessor('Thickness_v1', ['FreeSurfer'])])
+        self.assertEqual(graph.get_downstream('fMRIQA_v2'),
+                         set(['fMRI_stats_v1']))
+        self.assertEqual(graph.get_downstream('FreeSurfer_v5'),
+                         set(['Thickness_v1']))
+        self.assertFalse(graph.is_upstream('fMRI_stats_v1'))
+        self.assertFalse(graph.is_upstream('FreeSurferX'))
+
+    def test_empty(self):
+        self.assertTrue(ProcessorGraph([FakeProcessor('dtiQA_v2')]).is_empty())
@@ -0,0 +1,44 @@
+import os
+import re
+import shutil
+import tempfile
+from distutils.spawn import find_executable
+from unittest import TestCase, SkipTest
+
+from dax import spiders
+
+class TestPdfPages(TestCase):
+    def setUp(self):
+        try:
+            import matplotlib
+            import nibabel
+            import numpy
+        except ImportError:
+            raise SkipTest('matplotlib, nibabel or numpy not installed')
+        if spiders.get_pdf_merger() is None and not find_executable('gs'):
+            raise SkipTest('PyPDF2 or ghostscript needed to merge the pages')
+        self.tmp_dir = tempfile.mkdtemp()
+        self.spider = spiders.Spider('Spider_Test_v1_0_0.py', self.tmp_dir,
+                                     'PROJ', 'Subj', 'Sess', xnat_host='http://xnat',
+                                     xnat_user='user', xnat_pass='pass', subdir=False)
+        self.nii_path = os.path.join(self.tmp_dir, 'image.nii.gz')
+        data = numpy.arange(8*8*8, dtype=numpy.float32).reshape((8, 8, 8))
+        nibabel.save(nibabel.Nifti1Image(data, numpy.eye(4)), self.nii_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_plot_pdf_pages(self):
+        pdf_final = os.path.join(self.tmp_dir, 'report.pdf')
+        pages = [('images', {'pdf_path': os.path.join(self.tmp_dir, 'page1.pdf'),
+                             'page_index': 1, 'nii_images': [self.nii_path],
+                             'title': 'Images', 'image_labels': {'0': 'T1'},
+                             'nifti_cache': True}),
+                 ('stats', {'pdf_path': os.path.join(self.tmp_dir, 'page2.pdf'),
+                            'page_index': 2, 'title': 'Stats',
+                            'stats_dict': dict(('stat%d' % ind, ind) for ind in range(6))})]
+        self.assertEqual(self.spider.plot_pdf_pages(pages, pdf_final, processes=2),
+                         pdf_final)
+        self.assertTrue(os.path.isfile(pdf_final))
+        with open(pdf_final, 'rb') as f_obj:
+            self.assertEqual(len(re.findall(r'/Type\s*/Page\b', f_obj.read())), 2)
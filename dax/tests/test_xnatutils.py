@@ -0,0 +1,41 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from dax import XnatUtils
+
+class TestStaging(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp_dir, 'src')
+        os.makedirs(os.path.join(self.src, 'sub'))
+        for name in ['a.nii', os.path.join('sub', 'b.txt')]:
+            with open(os.path.join(self.src, name), 'w') as f_obj:
+                f_obj.write('data')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_stage_file(self):
+        src = os.path.join(self.src, 'a.nii')
+        dest = os.path.join(self.tmp_dir, 'a.nii')
+        self.assertEqual(XnatUtils.stage_file(src, dest, 'link'), 'link')
+        self.assertEqual(os.stat(dest).st_ino, os.stat(src).st_ino)
+        self.assertEqual(XnatUtils.stage_file(src, dest, 'copy'), 'copy')
+        self.assertNotEqual(os.stat(dest).st_ino, os.stat(src).st_ino)
+        self.assertEqual(XnatUtils.stage_file(dest, dest, 'move'), 'move')
+        self.assertTrue(os.path.isfile(dest))
+        XnatUtils.compress_staged_file(dest)
+        self.assertTrue(os.path.isfile(dest+'.gz'))
+        self.assertFalse(os.path.exists(dest))
+
+    def test_stage_tree(self):
+        dest = os.path.join(self.tmp_dir, 'dest')
+        XnatUtils.stage_tree(self.src, dest, 'link')
+        self.assertTrue(os.path.isfile(os.path.join(dest, 'sub', 'b.txt')))
+        self.assertRaises(OSError, XnatUtils.stage_tree, self.src, dest, 'link')
+        moved = os.path.join(self.tmp_dir, 'moved')
+        XnatUtils.stage_tree(self.src, moved, 'move')
+        self.assertFalse(os.path.exists(self.src))
+        self.assertTrue(os.path.isfile(os.path.join(moved, 'a.nii')))
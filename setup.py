@@ -47,6 +47,8 @@ if __name__ == '__main__':
                    'bin/dax_tools/dax_launch',
                    'bin/dax_tools/dax_update_tasks', 
                    'bin/dax_tools/dax_upload',
+                   'bin/dax_tools/dax_daemon',
+                   'bin/dax_tools/dax_benchmark',
                    'bin/dax_tools/run_spider',
                    'bin/dax_tools/dax_setup',
                    'bin/dax_tools/GenerateModuleTemplate',